@@ -0,0 +1,226 @@
+"""
+End-to-end benchmark of generate -> run -> repair, fully offline.
+
+The sources of testfiles/ are copied into a scratch project and bugs are
+injected into them. src/main.py then runs against the fake LLM backend:
+
+- the generation of modules that have tests in tests/unit replays those tests
+  (written to a recordings file first), the others get smoke tests;
+- the repair requests are answered with the edits that restore the original
+  sources, so each bug can be fixed.
+
+Every run reports the throughput, the iterations per fix and the time spent
+per stage, taken from the telemetry spans. Usage:
+
+    python benchmarks/bench_pipeline.py --runs 3 --latency 0.2 --failure-rate 0.05
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+# importing wolverine must not need credentials
+os.environ.setdefault("LLM_BACKEND", "fake")
+
+from wolverine.cache import ResponseCache  # noqa: E402
+from wolverine.languages import SOURCE_DIR, TEST_DIR, discover_files, get_backend  # noqa: E402
+
+MODEL_NAME = "fake-model"
+
+# (text, replacement) tried in order on the return statements of a source
+MUTATIONS = [(" + ", " - "), (" - ", " + "), (" * ", " + "), (" == ", " != "), ("[::-1]", "")]
+
+
+def inject_bugs(path: str, bugs: int) -> int:
+    """
+    Break up to `bugs` return statements of path. Returns how many were broken.
+    """
+    with open(path, "r") as f:
+        lines = f.readlines()
+    injected = 0
+    for number, line in enumerate(lines):
+        if injected == bugs:
+            break
+        if not line.lstrip().startswith("return "):
+            continue
+        for text, replacement in MUTATIONS:
+            if text in line:
+                lines[number] = line.replace(text, replacement, 1)
+                injected += 1
+                break
+    with open(path, "w") as f:
+        f.writelines(lines)
+    return injected
+
+
+def prepare_project(workdir: str, bugs: int) -> dict:
+    """
+    Copy the sources into workdir/project, keep pristine copies in
+    workdir/reference, inject the bugs and record the generation answers.
+    """
+    project = os.path.join(workdir, "project")
+    reference = os.path.join(workdir, "reference")
+    shutil.copytree(os.path.join(REPO_ROOT, SOURCE_DIR), os.path.join(project, SOURCE_DIR))
+    shutil.copytree(os.path.join(REPO_ROOT, SOURCE_DIR), os.path.join(reference, SOURCE_DIR))
+    shutil.copy(os.path.join(REPO_ROOT, "project_paths.py"), project)
+    os.makedirs(os.path.join(project, TEST_DIR))
+
+    recordings = os.path.join(workdir, "recordings.jsonl")
+    sources, injected, recorded = 0, 0, 0
+    with open(recordings, "w") as out:
+        for name in discover_files(os.path.join(project, SOURCE_DIR)):
+            sources += 1
+            backend = get_backend(name)
+            recorded_test = os.path.join(REPO_ROOT, backend.test_path(name))
+            if not os.path.exists(recorded_test):
+                continue
+            path = os.path.join(project, SOURCE_DIR, name)
+            injected += inject_bugs(path, bugs)
+            with open(path, "r") as f:
+                messages = [{"role": "system", "content": backend.generation_prompt(f.read(), name)}]
+            with open(recorded_test, "r") as f:
+                content = f.read()
+            key = ResponseCache.key(MODEL_NAME, 0.1, messages)
+            # answers are recorded as the JSON of their response model, a GeneratedTest here
+            out.write(json.dumps({"key": key, "content": json.dumps({"code": content})}) + "\n")
+            recorded += 1
+    return {
+        "project": project,
+        "reference": reference,
+        "recordings": recordings,
+        "sources": sources,
+        "recorded": recorded,
+        "bugs": injected,
+    }
+
+
+def run_once(args, workdir: str) -> dict:
+    setup = prepare_project(workdir, args.bugs)
+    env = dict(
+        os.environ,
+        LLM_BACKEND="fake",
+        MODEL_NAME=MODEL_NAME,
+        LLM_RECORDINGS=setup["recordings"],
+        FAKE_LLM_REFERENCE_DIR=setup["reference"],
+        FAKE_LLM_LATENCY=str(args.latency),
+        FAKE_LLM_FAILURE_RATE=str(args.failure_rate),
+        FAKE_LLM_INVALID_RATE=str(args.invalid_rate),
+        FAKE_LLM_SEED=str(args.seed),
+        LLM_CACHE="0",
+        GENERATION_CONCURRENCY=str(args.concurrency),
+        TEST_WORKERS=str(args.workers),
+        PYTHONPATH=os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get("PYTHONPATH")])),
+    )
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, os.path.join(REPO_ROOT, "src", "main.py")],
+        cwd=setup["project"],
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+    )
+    wall = time.perf_counter() - start
+    if args.verbose or result.returncode != 0:
+        print(result.stdout)
+
+    spans = []
+    spans_path = os.path.join(setup["project"], ".telemetry.jsonl")
+    if os.path.exists(spans_path):
+        with open(spans_path, "r") as f:
+            spans = [json.loads(line) for line in f if line.strip()]
+
+    stages = {}
+    for span in spans:
+        stage = span["kind"] + (f":{span['stage']}" if span.get("stage") else "")
+        stages[stage] = stages.get(stage, 0.0) + span.get("duration", 0.0)
+    stops = [span["stop"] for span in spans if "stop" in span]
+    fixed = [stop for stop in stops if stop["reason"] == "passed" and stop["iterations"]]
+    return {
+        "returncode": result.returncode,
+        # a run that crashed or left failing tests is not a valid sample
+        "valid": result.returncode == 0,
+        "wall_seconds": wall,
+        "sources": setup["sources"],
+        "bugs": setup["bugs"],
+        "files_per_second": setup["sources"] / wall if wall else 0.0,
+        "llm_calls": sum(1 for span in spans if span["kind"] == "llm"),
+        "tokens": sum(span.get("prompt_tokens", 0) + span.get("completion_tokens", 0) for span in spans),
+        "repairs": len(stops),
+        "fixed": len(fixed),
+        "iterations_per_fix": (
+            statistics.mean(stop["iterations"] for stop in fixed) if fixed else 0.0
+        ),
+        "stop_reasons": {stop["file"]: stop["reason"] for stop in stops},
+        "stage_seconds": stages,
+    }
+
+
+def summarize(runs: list) -> dict:
+    numbers = ["wall_seconds", "files_per_second", "llm_calls", "tokens", "fixed", "iterations_per_fix"]
+    summary = {key: statistics.median(run[key] for run in runs) for key in numbers}
+    stage_names = sorted({stage for run in runs for stage in run["stage_seconds"]})
+    summary["stage_seconds"] = {
+        stage: statistics.median(run["stage_seconds"].get(stage, 0.0) for run in runs)
+        for stage in stage_names
+    }
+    return summary
+
+
+def print_report(summary: dict, runs: list):
+    print(f"\n===== Benchmark ({len(runs)} run(s), medians) =====")
+    print(f"sources            {runs[0]['sources']} ({runs[0]['bugs']} bug(s) injected)")
+    print(f"wall time          {summary['wall_seconds']:.2f}s")
+    print(f"throughput         {summary['files_per_second']:.2f} source files/s")
+    print(f"LLM calls          {summary['llm_calls']:.0f} ({summary['tokens']:.0f} tokens)")
+    print(f"fixed              {summary['fixed']:.0f} test file(s)")
+    print(f"iterations per fix {summary['iterations_per_fix']:.2f}")
+    print("time per stage (summed over workers):")
+    for stage, seconds in summary["stage_seconds"].items():
+        print(f"  {stage:<20} {seconds:.2f}s")
+    print("stop reasons of the last run:")
+    for file, reason in sorted(runs[-1]["stop_reasons"].items()):
+        print(f"  {file}: {reason}")
+    print("=" * 44)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=1)
+    parser.add_argument("--bugs", type=int, default=1, help="bugs injected per source with recorded tests")
+    parser.add_argument("--latency", type=float, default=0.0, help="mean fake LLM latency in seconds")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--invalid-rate", type=float, default=0.0)
+    parser.add_argument("--seed", default="0")
+    parser.add_argument("--concurrency", type=int, default=1, help="GENERATION_CONCURRENCY")
+    parser.add_argument("--workers", type=int, default=1, help="TEST_WORKERS")
+    parser.add_argument("--output", default="benchmark_report.json")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    runs = []
+    for _ in range(args.runs):
+        with tempfile.TemporaryDirectory(prefix="wolverine-bench-") as workdir:
+            runs.append(run_once(args, workdir))
+    valid = [run for run in runs if run["valid"]]
+    summary = summarize(valid) if valid else None
+    if summary:
+        print_report(summary, valid)
+    with open(args.output, "w") as f:
+        json.dump({"settings": vars(args), "summary": summary, "runs": runs}, f, indent=2)
+    print(f"Benchmark report saved as {args.output}")
+    if len(valid) < len(runs):
+        codes = ", ".join(str(run["returncode"]) for run in runs if not run["valid"])
+        print(f"{len(runs) - len(valid)}/{len(runs)} run(s) exited with a non-zero code ({codes})", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
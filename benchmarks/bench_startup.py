@@ -0,0 +1,102 @@
+"""
+Startup budget of the `python -m wolverine` entry point.
+
+Imports wolverine/__main__.py (the fire entry point, without running it) in
+new interpreters with `-X importtime`, and fails when the median time spent
+importing it goes over the budget, or when it loads a module that only LLM
+requests need. Usage:
+
+    python benchmarks/bench_startup.py --runs 5 --budget-ms 250
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENTRY_POINT = "wolverine.__main__"
+
+# Budget of the cumulative import time of the entry point, in milliseconds
+STARTUP_BUDGET_MS = float(os.getenv("STARTUP_BUDGET_MS", 250))
+
+# Client libraries, only imported once a request is sent
+DEFERRED_MODULES = ("openai", "instructor", "httpx", "pydantic")
+
+
+def import_times(module: str = ENTRY_POINT) -> dict:
+    """
+    Cumulative import time in microseconds of module and of every module
+    loaded while importing it, in a new interpreter.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=REPO_ROOT,
+        env=dict(os.environ, PYTHONPATH=REPO_ROOT),
+        capture_output=True,
+        text=True,
+    )
+    lines = result.stderr.splitlines()
+    if result.returncode != 0:
+        errors = [line for line in lines if not line.startswith("import time:")]
+        raise RuntimeError(f"Importing {module} failed:\n" + "\n".join(errors[-5:]))
+    times = {}
+    for line in lines:
+        if not line.startswith("import time:") or line.count("|") != 2:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue  # the header
+        # modules are listed as they finish loading, nested ones indented:
+        # a top level module ends the imports of the interpreter startup
+        if not name.startswith("  ") and name.strip() != module:
+            times = {}
+            continue
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=STARTUP_BUDGET_MS)
+    parser.add_argument("--top", type=int, default=10, help="number of slowest imports to list")
+    parser.add_argument("--output", default="", help="also save the results as JSON")
+    args = parser.parse_args()
+
+    runs = [import_times() for _ in range(args.runs)]
+    startup_ms = statistics.median(run[ENTRY_POINT] for run in runs) / 1000
+    deferred = sorted(
+        {name for run in runs for name in run if name.split(".")[0] in DEFERRED_MODULES}
+    )
+
+    # everything it imports, slowest first, the entry point itself excluded
+    last = runs[-1]
+    slowest = sorted(last.items(), key=lambda item: item[1], reverse=True)[1:args.top + 1]
+
+    print(f"{ENTRY_POINT} imported in {startup_ms:.1f}ms (median of {args.runs}), budget {args.budget_ms:.0f}ms")
+    print("slowest imports of the last run (cumulative):")
+    for name, microseconds in slowest:
+        print(f"  {name:<40} {microseconds / 1000:.1f}ms")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {"startup_ms": startup_ms, "budget_ms": args.budget_ms, "deferred_loaded": deferred, "runs": runs},
+                f,
+                indent=2,
+            )
+
+    failed = False
+    if deferred:
+        print(f"Loaded at startup, should only be loaded by LLM requests: {', '.join(deferred)}")
+        failed = True
+    if startup_ms > args.budget_ms:
+        print(f"Startup over budget by {startup_ms - args.budget_ms:.1f}ms")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""
+Make the project's modules importable from anywhere in the tree without
+walking it on every start. Generated tests call install_paths() instead of
+appending every directory of the repository to sys.path.
+
+The index maps each top-level module or package name to the directory that
+holds it. It is cached in .path_index.json at the project root with the
+mtime of every directory. On the next start only the directories whose
+mtime changed are listed again, so an unchanged tree costs one stat per
+directory. Only the standard library is used, so importing this module
+costs nothing.
+"""
+import importlib.machinery
+import json
+import os
+import sys
+from typing import Dict, List, Optional, Tuple
+
+PATH_INDEX_FILE = os.getenv("PATH_INDEX_FILE", ".path_index.json")
+INDEX_VERSION = 1
+
+# Directories never searched for modules, on top of hidden ones
+SKIPPED_DIRS = {"__pycache__", "node_modules", "site-packages", "venv", "env"}
+
+PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+MODULE_SUFFIXES = tuple(importlib.machinery.all_suffixes())
+
+
+def _skipped(entry: os.DirEntry) -> bool:
+    if entry.name in SKIPPED_DIRS or entry.name.startswith("."):
+        return True
+    # any other virtualenv
+    return os.path.exists(os.path.join(entry.path, "pyvenv.cfg"))
+
+
+def scan_dir(path: str) -> Dict:
+    """
+    The modules and packages defined directly in path, and the
+    subdirectories to search next.
+    """
+    modules = []
+    subdirs = []
+    mtime = os.stat(path).st_mtime_ns
+    with os.scandir(path) as entries:
+        for entry in sorted(entries, key=lambda entry: entry.name):
+            if entry.is_dir():
+                if _skipped(entry):
+                    continue
+                subdirs.append(entry.name)
+                if os.path.exists(os.path.join(entry.path, "__init__.py")):
+                    modules.append(entry.name)
+            elif entry.name.endswith(MODULE_SUFFIXES) and entry.name != "__init__.py":
+                modules.append(entry.name.split(".")[0])
+    return {"mtime": mtime, "modules": modules, "subdirs": subdirs}
+
+
+def refresh_index(root: str, dirs: Dict[str, Dict]) -> Tuple[Dict[str, Dict], bool]:
+    """
+    Bring the per-directory entries of an index up to date, listing only the
+    directories that are new or whose mtime changed. Also returns whether any
+    module or subdirectory was added or removed.
+    """
+    refreshed = {}
+    changed = False
+    pending = ["."]
+    while pending:
+        rel_dir = pending.pop()
+        try:
+            mtime = os.stat(os.path.join(root, rel_dir)).st_mtime_ns
+        except OSError:
+            continue
+        entry = dirs.get(rel_dir)
+        if entry is None or entry["mtime"] != mtime:
+            scanned = scan_dir(os.path.join(root, rel_dir))
+            # a new mtime alone (e.g. a temporary file came and went) isn't
+            # worth rewriting the cache for
+            changed = changed or entry is None or (
+                (entry["modules"], entry["subdirs"]) != (scanned["modules"], scanned["subdirs"])
+            )
+            entry = scanned
+        refreshed[rel_dir] = entry
+        pending.extend(os.path.normpath(os.path.join(rel_dir, d)) for d in entry["subdirs"])
+    return refreshed, changed or set(refreshed) != set(dirs)
+
+
+def module_paths(dirs: Dict[str, Dict]) -> Dict[str, str]:
+    """
+    Map each module name to the first directory, top-down, that defines it,
+    like appending the directories to sys.path in os.walk order did.
+    """
+    modules = {}
+    for rel_dir in sorted(dirs, key=lambda d: [] if d == "." else d.split(os.sep)):
+        for name in dirs[rel_dir]["modules"]:
+            modules.setdefault(name, rel_dir)
+    return modules
+
+
+def load_index(root: str = PROJECT_ROOT, path: Optional[str] = None) -> Dict[str, str]:
+    """
+    The module index of root, read from the cache and refreshed. The cache
+    is rewritten when modules or directories were added or removed.
+    """
+    path = os.path.join(root, path or PATH_INDEX_FILE)
+    dirs = {}
+    try:
+        with open(path, "r") as f:
+            cached = json.load(f)
+        if cached.get("version") == INDEX_VERSION:
+            dirs = cached["dirs"]
+    except (OSError, ValueError, KeyError):
+        pass
+    dirs, changed = refresh_index(root, dirs)
+    if changed:
+        # imported here, most starts don't write the cache
+        import tempfile
+
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=root, prefix=".", suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump({"version": INDEX_VERSION, "dirs": dirs}, f)
+            os.replace(temp_path, path)
+        except OSError:
+            # a read-only checkout still works, it just lists every directory
+            pass
+    return module_paths(dirs)
+
+
+class ProjectFinder:
+    """
+    Import hook resolving top-level names through the index. It sits after
+    the regular finders, so the standard library and installed packages win
+    like they did when the directories were appended to sys.path.
+    """
+
+    def __init__(self, root: str, modules: Dict[str, str]):
+        self.root = root
+        self.modules = modules
+
+    def find_spec(self, fullname: str, path: Optional[List[str]] = None, target=None):
+        if path is not None or fullname not in self.modules:
+            return None
+        directory = os.path.join(self.root, self.modules[fullname])
+        return importlib.machinery.PathFinder.find_spec(fullname, [directory])
+
+
+def install_paths(root: str = PROJECT_ROOT) -> ProjectFinder:
+    """
+    Make every module of the project importable by its name. A finder
+    installed earlier in this interpreter (e.g. a long running worker) is
+    reused with its index refreshed, so modules added since are found.
+    """
+    root = os.path.abspath(root)
+    for finder in sys.meta_path:
+        # compared by name, this module may have been imported again since
+        if type(finder).__name__ == "ProjectFinder" and getattr(finder, "root", None) == root:
+            finder.modules = load_index(root)
+            return finder
+    finder = ProjectFinder(root, load_index(root))
+    sys.meta_path.append(finder)
+    return finder
@@ -1,8 +1,24 @@
 import subprocess
 import difflib
+import json
+import os
 import shutil
+import sys
+import tempfile
+import urllib.request
+import venv
+import zipfile
+import fire
 from termcolor import cprint
 
+# Wheels built or downloaded for the isolated environment, reused by the next runs
+WHEEL_CACHE_DIR = os.getenv("WHEEL_CACHE_DIR", ".wheel_cache")
+# Local mirror of the OSV advisories of PyPI packages, checked instead of an online service
+VULN_DB_DIR = os.getenv("VULN_DB_DIR", ".vulndb")
+VULN_DB_URL = os.getenv("VULN_DB_URL", "https://osv-vulnerabilities.storage.googleapis.com/PyPI/all.zip")
+# Rounds of audit and upgrade at most, an upgrade may pull in new vulnerable dependencies
+SECURE_MAX_ITERATIONS = int(os.getenv("SECURE_MAX_ITERATIONS", 5))
+
 def read_requirements(file_path):
     """Read the requirements.txt file and return its contents as a list."""
     try:
@@ -40,34 +56,262 @@ def run_pip_audit():
         print(f"Error running pip-audit: {e.stderr}")
         return False
     
-def fix_vulnerabilities():
-    """Run pip-audit --fix in a loop until no vulnerabilities remain."""
-    while True:
+def fix_vulnerabilities(max_iterations=SECURE_MAX_ITERATIONS):
+    """Run pip-audit --fix in a loop until no vulnerabilities remain, max_iterations times at most."""
+    for _ in range(max_iterations):
         print("Running pip-audit --fix...")
         result = subprocess.run(["pip-audit", "--fix"], capture_output=True, text=True, check=False)
         print(result.stdout)
         if "No known vulnerabilities found" in result.stdout:
-            break
+            return True
+    cprint(f"Vulnerabilities remain after {max_iterations} rounds of fixes.", "yellow")
+    return False
+
+def update_vulnerability_db(db_dir=VULN_DB_DIR, url=VULN_DB_URL):
+    """Download the OSV advisories of PyPI and index their affected versions by package."""
+    from packaging.utils import canonicalize_name
+
+    os.makedirs(db_dir, exist_ok=True)
+    archive = os.path.join(db_dir, "all.zip")
+    print(f"Downloading {url}...")
+    urllib.request.urlretrieve(url, archive)
+    index = {}
+    with zipfile.ZipFile(archive) as advisories:
+        for name in advisories.namelist():
+            advisory = json.loads(advisories.read(name))
+            if advisory.get("withdrawn"):
+                continue
+            for affected in advisory.get("affected", []):
+                package = affected.get("package", {})
+                if package.get("ecosystem") != "PyPI":
+                    continue
+                index.setdefault(canonicalize_name(package["name"]), []).append({
+                    "id": advisory["id"],
+                    "aliases": advisory.get("aliases", []),
+                    "versions": affected.get("versions", []),
+                    "ranges": [r["events"] for r in affected.get("ranges", []) if r.get("type") == "ECOSYSTEM"],
+                })
+    with open(os.path.join(db_dir, "pypi.json"), "w") as f:
+        json.dump(index, f)
+    os.remove(archive)
+    print(f"{sum(len(entries) for entries in index.values())} advisories for {len(index)} packages saved in {db_dir}.")
+
+def load_vulnerability_db(db_dir=VULN_DB_DIR):
+    """The package index of the local mirror, or None before update_vulnerability_db ran."""
+    try:
+        with open(os.path.join(db_dir, "pypi.json"), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def is_affected(version, entry):
+    """True if version falls in one of the versions or ranges of the advisory entry."""
+    from packaging.version import InvalidVersion, Version
+
+    if str(version) in entry["versions"]:
+        return True
+    for events in entry["ranges"]:
+        # "introduced" opens a range, "fixed" closes it before and "last_affected" after its version
+        bounds = []
+        for event in events:
+            kind, value = next(iter(event.items()))
+            try:
+                bounds.append((Version("0") if value == "0" else Version(value), kind))
+            except InvalidVersion:
+                continue
+        affected = False
+        for bound, kind in sorted(bounds, key=lambda b: b[0]):
+            if kind == "introduced" and bound <= version:
+                affected = True
+            elif kind == "fixed" and bound <= version:
+                affected = False
+            elif kind == "last_affected" and bound < version:
+                affected = False
+        if affected:
+            return True
+    return False
+
+def fix_versions(version, entry):
+    """The versions that fix the advisory entry after version."""
+    from packaging.version import InvalidVersion, Version
+
+    fixes = []
+    for events in entry["ranges"]:
+        for event in events:
+            try:
+                fixed = Version(event.get("fixed", ""))
+            except InvalidVersion:
+                continue
+            if fixed > version:
+                fixes.append(str(fixed))
+    return fixes
+
+def audit_with_db(packages, db):
+    """The vulnerabilities of the (name, version) packages found in the local mirror."""
+    from packaging.utils import canonicalize_name
+    from packaging.version import InvalidVersion, Version
+
+    findings = []
+    for name, version in packages:
+        try:
+            parsed = Version(version)
+        except InvalidVersion:
+            continue
+        for entry in db.get(canonicalize_name(name), []):
+            if is_affected(parsed, entry):
+                findings.append({"name": name, "version": version, "id": entry["id"],
+                                 "fix_versions": fix_versions(parsed, entry)})
+    return findings
+
+def audit_with_pip_audit(site_packages):
+    """The vulnerabilities pip-audit finds in site_packages, from its online service."""
+    pip_audit_path = shutil.which("pip-audit")
+    if not pip_audit_path:
+        raise RuntimeError("pip-audit not found. Install it with 'pip install pip-audit', "
+                           "or mirror the vulnerability database with --update_db")
+    result = subprocess.run([pip_audit_path, "--path", site_packages, "--format", "json", "--progress-spinner", "off"],
+                            capture_output=True, text=True, check=False)
+    try:
+        report = json.loads(result.stdout)
+    except json.JSONDecodeError:
+        raise RuntimeError(f"Error running pip-audit: {result.stderr}")
+    return [
+        {"name": dependency["name"], "version": dependency["version"], "id": vuln["id"],
+         "fix_versions": vuln.get("fix_versions", [])}
+        for dependency in report.get("dependencies", [])
+        for vuln in dependency.get("vulns", [])
+    ]
+
+def create_isolated_env(env_dir):
+    """Create a throwaway virtual environment, and return its interpreter and the pip command managing it."""
+    from pip import __version__ as pip_version
+    from packaging.version import Version
+
+    print(f"Creating an isolated environment in {env_dir}...")
+    python = os.path.join(env_dir, "Scripts" if sys.platform == "win32" else "bin", "python")
+    # pip 22.3 can manage another interpreter, which saves installing pip in the environment
+    if Version(pip_version) >= Version("22.3"):
+        venv.EnvBuilder(with_pip=False).create(env_dir)
+        return python, [sys.executable, "-m", "pip", "--python", python]
+    venv.EnvBuilder(with_pip=True).create(env_dir)
+    return python, [python, "-m", "pip"]
+
+def pip_install_cached(pip, args, offline=False, cache_dir=WHEEL_CACHE_DIR):
+    """Install args with pip, from the wheel cache, adding the missing wheels to it first."""
+    os.makedirs(cache_dir, exist_ok=True)
+    links = ["--find-links", cache_dir]
+    # wheels already in the cache are neither downloaded nor built again
+    subprocess.run([*pip, "wheel", "--quiet", "--wheel-dir", cache_dir, *links,
+                    *(["--no-index"] if offline else []), *args], check=True)
+    subprocess.run([*pip, "install", "--quiet", "--no-index", *links, *args], check=True)
+
+def freeze(pip):
+    result = subprocess.run([*pip, "freeze", "--exclude-editable"], capture_output=True, text=True, check=True)
+    return result.stdout
+
+def installed_packages(pip):
+    """The (name, version) pairs pip freeze reports."""
+    return [tuple(line.split("==", 1)) for line in freeze(pip).splitlines() if "==" in line]
+
+def site_packages_dir(python):
+    result = subprocess.run([python, "-c", "import sysconfig; print(sysconfig.get_paths()['purelib'])"],
+                            capture_output=True, text=True, check=True)
+    return result.stdout.strip()
+
+def upgrades_for(findings):
+    """The version each vulnerable package is upgraded to: the lowest one fixing all its advisories."""
+    from packaging.version import Version
+
+    upgrades = {}
+    for finding in findings:
+        if not finding["fix_versions"]:
+            continue
+        lowest = min(finding["fix_versions"], key=Version)
+        current = upgrades.get(finding["name"])
+        if current is None or Version(lowest) > Version(current):
+            upgrades[finding["name"]] = lowest
+    return upgrades
+
+def secure_in_isolated_env(requirements="requirements.txt", offline=False, max_iterations=SECURE_MAX_ITERATIONS):
+    """
+    Install requirements in a throwaway environment, upgrade its vulnerable
+    packages max_iterations times at most, and return the pinned packages of
+    the result with the vulnerabilities left. The running interpreter is not
+    touched.
+    """
+    db = load_vulnerability_db()
+    if db is None and offline:
+        raise RuntimeError(f"No vulnerability database in {VULN_DB_DIR}, run with --update_db while online first")
+    with tempfile.TemporaryDirectory(prefix="secure-requirements-") as env_dir:
+        python, pip = create_isolated_env(env_dir)
+        print(f"Installing packages from {requirements}...")
+        pip_install_cached(pip, ["-r", requirements], offline)
+
+        def audit():
+            if db is not None:
+                return audit_with_db(installed_packages(pip), db)
+            return audit_with_pip_audit(site_packages_dir(python))
+
+        findings = []
+        for iteration in range(1, max_iterations + 1):
+            findings = audit()
+            if not findings:
+                print("No known vulnerabilities found.")
+                break
+            for finding in findings:
+                fixes = ", ".join(finding["fix_versions"]) or "no fix"
+                print(f"{finding['name']} {finding['version']}: {finding['id']} ({fixes})")
+            upgrades = upgrades_for(findings)
+            if not upgrades:
+                break
+            print(f"Round {iteration}: upgrading {', '.join(f'{n}=={v}' for n, v in upgrades.items())}...")
+            pip_install_cached(pip, [f"{name}=={version}" for name, version in upgrades.items()], offline)
+        else:
+            # the last upgrades were never audited
+            findings = audit()
+        if findings:
+            cprint(f"{len(findings)} known vulnerabilities remain, check them by hand.", "yellow")
+        frozen = freeze(pip)
+    return frozen.splitlines(keepends=True), findings
 
 def show_requirements_diff(original, updated):
     """Show the difference between the original and final requirements.txt."""
-    diff = difflib.unified_diff(original, updated, fromfile="Original", tofile="Updated", lineterm="")
-    diff_output = "\n".join(diff)
+    diff = difflib.unified_diff(original, updated, fromfile="Original", tofile="Updated")
     print("\n===== Requirements.txt Changes =====")
     # Iterate over the diff and color-code lines
     for line in diff:
+        line = line.rstrip("\n")
         if line.startswith("+"):
-            cprint(line, "green", end="")  # Additions in green
+            cprint(line, "green")  # Additions in green
         elif line.startswith("-"):
-            cprint(line, "red", end="")  # Deletions in red
+            cprint(line, "red")  # Deletions in red
         else:
-            print(line, end="")  # No change lines in default format
+            print(line)  # No change lines in default format
     print("====================================")
 
-def main():
+def main(in_place=False, offline=False, update_db=False, max_iterations=SECURE_MAX_ITERATIONS):
+    """
+    Pin requirements.txt to versions without known vulnerabilities. By
+    default they are resolved in a throwaway environment, with --offline
+    using only the wheel cache and the local vulnerability database that
+    --update_db downloads. --in_place reinstalls every package of the
+    current environment instead.
+    """
+    if update_db:
+        update_vulnerability_db()
+
     # Backup original requirements
     original_requirements = read_requirements("requirements.txt")
 
+    if not in_place:
+        updated_requirements, findings = secure_in_isolated_env("requirements.txt", offline, max_iterations)
+        with open("requirements.txt", "w") as f:
+            f.writelines(updated_requirements)
+        show_requirements_diff(original_requirements, updated_requirements)
+        if findings:
+            sys.exit(1)
+        return
+
     # Uninstall all packages
     uninstall_all_packages()
 
@@ -76,7 +320,7 @@ def main():
 
     # Run pip-audit and attempt fixes
     if run_pip_audit():
-        fix_vulnerabilities()
+        fix_vulnerabilities(max_iterations)
 
     # Backup final requirements
     subprocess.run(["pip", "freeze"], stdout=open("requirements.txt", "w"), check=True)
@@ -86,4 +330,4 @@ def main():
     show_requirements_diff(original_requirements, updated_requirements)
 
 if __name__ == "__main__":
-    main()
+    fire.Fire(main)
@@ -0,0 +1,207 @@
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Make main.py and the wolverine package importable when running "python src/daemon.py"
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import main
+from wolverine import telemetry
+from wolverine.languages import (
+    SOURCE_DIR, backend_for, discover_files, get_backend, invalidate_source_index, source_name
+)
+from wolverine.manifest import Manifest, source_dependencies
+from wolverine.watcher import debounced_changes, make_watcher
+from wolverine.wolverine import main as repair
+from wolverine.worker import get_worker
+
+# Address of the status endpoint, local only
+DAEMON_HOST = os.getenv("DAEMON_HOST", "127.0.0.1")
+DAEMON_PORT = int(os.getenv("DAEMON_PORT", 8765))
+
+# Seconds without a save before a burst of saves is handled
+DAEMON_DEBOUNCE = float(os.getenv("DAEMON_DEBOUNCE", 0.5))
+
+# Hash of every source, to tell real edits from the daemon's own repairs and
+# from saves that changed nothing
+def source_hashes():
+    hashes = {}
+    for file_name in discover_files(SOURCE_DIR):
+        with open(os.path.join(SOURCE_DIR, file_name), 'rb') as f:
+            hashes[file_name] = hashlib.sha256(f.read()).hexdigest()
+    return hashes
+
+# The modules to regenerate and rerun after some sources changed: the changed
+# ones that still exist, and the ones importing them
+def affected_modules(changed_names):
+    modules = set()
+    for file_name in discover_files(SOURCE_DIR):
+        dependencies = {
+            os.path.relpath(path, SOURCE_DIR)
+            for path in source_dependencies(os.path.join(SOURCE_DIR, file_name), SOURCE_DIR)
+        }
+        if file_name in changed_names or dependencies & changed_names:
+            modules.add(file_name)
+    return sorted(modules)
+
+# Run and repair a test file inside the daemon, so the client, the caches and
+# the warm test worker stay loaded between runs. Returns a result like
+# main.run_test_file.
+def repair_in_process(test_file, workers=1):
+    print(f"Running test: {test_file}")
+    start = time.monotonic()
+    returncode = 0
+    with telemetry.span("subprocess", source_name(test_file), stage="wolverine", mode="daemon"):
+        try:
+            repair(test_file, warm=True)
+        except SystemExit as e:
+            returncode = e.code if isinstance(e.code, int) else 1
+        except Exception as e:
+            print(f"Repairing {test_file} failed: {e}")
+            returncode = 1
+    return {"test_file": test_file, "returncode": returncode, "merged": [], "conflicts": [],
+            "duration": time.monotonic() - start}
+
+
+class Daemon:
+    """
+    Watches SOURCE_DIR and keeps the tests of the changed modules current:
+    each burst of saves regenerates the stale tests of the affected modules,
+    then runs and repairs them in this process.
+    """
+
+    def __init__(self, debounce=DAEMON_DEBOUNCE):
+        self.debounce = debounce
+        self.watcher = make_watcher(SOURCE_DIR)
+        self.hashes = source_hashes()
+        self._lock = threading.Lock()
+        self.state = {
+            "state": "starting",
+            "watcher": self.watcher.name,
+            "started": time.time(),
+            "runs": 0,
+            "last_run": None,
+            "tests": {},
+        }
+
+    def status(self):
+        with self._lock:
+            return json.loads(json.dumps(self.state))
+
+    def _set(self, **values):
+        with self._lock:
+            self.state.update(values)
+
+    # Regenerate, run and repair the given modules, and record the outcome
+    def handle(self, modules, changed=()):
+        start = time.monotonic()
+        self._set(state="running", current=modules)
+        results = []
+
+        def run_test(test_file, workers):
+            result = repair_in_process(test_file, workers)
+            results.append(result)
+            return result
+
+        error = None
+        telemetry.start_run()
+        try:
+            main.generate_and_test_files(workers=1, batch=False, files=iter(modules), run_test=run_test)
+        except Exception as e:
+            # failing tests raise once every module was handled, keep watching
+            error = str(e)
+        finally:
+            telemetry.write_report()
+        # the repairs may have edited sources, they are not new edits
+        self.hashes = source_hashes()
+        with self._lock:
+            for result in results:
+                self.state["tests"][result["test_file"]] = {
+                    "passed": result["returncode"] == 0,
+                    "seconds": round(result["duration"], 2),
+                    "finished": time.time(),
+                }
+            self.state.update(
+                state="idle",
+                current=[],
+                runs=self.state["runs"] + 1,
+                last_run={
+                    "changed": sorted(changed),
+                    "modules": modules,
+                    "passed": all(result["returncode"] == 0 for result in results) and error is None,
+                    "error": error,
+                    "seconds": round(time.monotonic() - start, 2),
+                },
+            )
+
+    # Sources that really changed since the last look, relative to SOURCE_DIR
+    def changed_sources(self, paths):
+        hashes = source_hashes()
+        names = {os.path.relpath(path, SOURCE_DIR) for path in paths}
+        changed = {name for name in names if hashes.get(name) != self.hashes.get(name)}
+        self.hashes = hashes
+        return changed
+
+    def serve_status(self, host=DAEMON_HOST, port=DAEMON_PORT):
+        daemon = self
+
+        class StatusHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip("/") not in ("", "/status"):
+                    self.send_error(404)
+                    return
+                body = json.dumps(daemon.status(), indent=2).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), StatusHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f"Status available at http://{host}:{server.server_address[1]}/status")
+        return server
+
+    def run(self):
+        server = self.serve_status()
+        try:
+            # modules edited while the daemon was down
+            manifest = Manifest()
+            stale = [
+                file_name for file_name in discover_files(SOURCE_DIR)
+                if manifest.is_stale(file_name, get_backend(file_name).test_path(file_name))
+            ]
+            if stale:
+                self.handle(stale)
+            self._set(state="idle")
+            print(f"Watching {SOURCE_DIR} ({self.watcher.name})...")
+            for paths in debounced_changes(self.watcher, self.debounce):
+                # sources may have been added, renamed or removed
+                invalidate_source_index()
+                changed = self.changed_sources(paths)
+                if not changed:
+                    continue
+                # the warm worker reloads the edited modules before its next run
+                get_worker().invalidate(
+                    os.path.join(SOURCE_DIR, name) for name in changed if backend_for(name)
+                )
+                modules = affected_modules(changed)
+                print(f"Changed: {', '.join(sorted(changed))}; updating {', '.join(modules) or 'nothing'}")
+                if modules:
+                    self.handle(modules, changed)
+        except KeyboardInterrupt:
+            print("Stopping.")
+        finally:
+            server.shutdown()
+            self.watcher.close()
+
+
+if __name__ == "__main__":
+    Daemon().run()
@@ -1,121 +1,527 @@
 import openai
 from pydantic import BaseModel
-from openai import AzureOpenAI
 from dotenv import load_dotenv
+from collections import deque
+import asyncio
 import os
-import instructor
+import time
+import sys
+import threading
 import subprocess
 
-load_dotenv()
+# Make the wolverine package importable when running "python src/main.py"
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-# Setup instructor and OpenAI API clients
-client = instructor.from_openai(
-    AzureOpenAI(
-        api_key=os.getenv("API_KEY"),
-        api_version=os.getenv("LLM_API_VERSION"),
-        azure_endpoint=os.getenv("BASE_URL"),
-        azure_deployment=os.getenv("MODEL_DEPLOYMENT"),
-    )
+from wolverine.cache import get_cache
+from wolverine.clients import get_client, make_client
+from wolverine.context import estimate_tokens
+from wolverine.coverage_gaps import (
+    COVERAGE_ROUNDS,
+    COVERAGE_TARGET,
+    append_tests,
+    coverage_available,
+    existing_tests,
+    format_gaps,
+    measure_coverage,
+    print_coverage_summary,
+    uncovered_functions,
 )
+from wolverine.languages import SOURCE_DIR, discover_files, get_backend, is_test_file, source_name
+from wolverine.manifest import Manifest
+from wolverine.mutation import run_mutation_testing
+from wolverine.parallel import TEST_WORKERS, merge_back, print_summary, run_isolated, run_tests_parallel
+from wolverine.pipeline import run_pipeline
+from wolverine.schemas import GeneratedTest, parse_cached
+from wolverine import telemetry
+
+load_dotenv()
 
 # Load API keys from environment variables
 openai.api_key = os.getenv("API_KEY")
 github_token = os.getenv("GITHUB_TOKEN")
 
-# Fetch files from the local 'test-files' folder
-def fetch_files():
-    folder_path = "testfiles"  # Path to the folder where test files are located
-    files = []
-    
-    # Iterate over files in the directory
-    for file_name in os.listdir(folder_path):
-        file_path = os.path.join(folder_path, file_name)
-        # Check if it's a .py or .js file
-        if (file_name.endswith(".py") or file_name.endswith(".js")) and os.path.isfile(file_path):
-            with open(file_path, 'r') as file:
-                content = file.read()
-            files.append({'name': file_name, 'content': content})
-    
-    return files
+# Concurrent generation settings. A concurrency of 1 keeps the sequential mode,
+# a limit of 0 disables the corresponding per-minute cap.
+GENERATION_CONCURRENCY = int(os.getenv("GENERATION_CONCURRENCY", 1))
+GENERATION_TIMEOUT = float(os.getenv("GENERATION_TIMEOUT", 120))
+MAX_REQUESTS_PER_MINUTE = int(os.getenv("MAX_REQUESTS_PER_MINUTE", 0))
+MAX_TOKENS_PER_MINUTE = int(os.getenv("MAX_TOKENS_PER_MINUTE", 0))
 
-# Generate test cases using the 'client' instance and the AzureOpenAI model
-def generate_test(code_snippet, test_type="unit"):
-    prompt = f"""
-    Understand the code snippet well and write unit test cases that cover all possible edge cases and scenarios in the manner below:
-     Write a comprehensive, almost exhaustive unit test script for the following code:
-    ```{code_snippet}```
-    Only return the python test script, no extra messages. Inline comments are allowed.
-    Add the below snippet at the beginning of the test script:
-    ```
-    import sys
-    import os
-
-    # Walk through all directories starting from the project root and add them to sys.path
-    root_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))  # Adjust path to project root
-
-    # Walk through all directories under root_path and add them to sys.path
-    for dirpath, dirnames, filenames in os.walk(root_path):
-        sys.path.append(dirpath)
-    ```
-    """
-    # Use the client to generate a response from the model
-    response = client.chat.completions.create(
-        model=os.getenv("MODEL_NAME"),
-        response_model=None,
-        messages=[{"role": "system", "content": prompt}],
-        temperature=0.1
-    )
-    print(response.choices[0].message.content)
-    test_script = response.choices[0].message.content.strip()
-    
-    # Remove the markdown code block (```python) if present
-    if test_script.startswith("```python"):
-        test_script = test_script[9:].strip()  # Remove the "```python" part
+# Number of tries to get a generated test script that passes the pre-flight checks
+GENERATION_ATTEMPTS = int(os.getenv("GENERATION_ATTEMPTS", 3))
+
+# Repair all failing tests in one wolverine process, grouped by the module they import
+BATCH_REPAIR = os.getenv("BATCH_REPAIR", "0") == "1"
+
+# Score the tests by the share of mutants of their modules they detect
+MUTATION_TESTING = os.getenv("MUTATION_TESTING", "0") == "1"
+
+# Fetch files from the local 'test-files' folder, walking it recursively and
+# skipping what .gitignore excludes. Files are read as they are found, and the
+# names are relative to the folder.
+def fetch_files(folder_path=SOURCE_DIR):
+    for file_name in discover_files(folder_path):
+        with open(os.path.join(folder_path, file_name), 'r') as file:
+            content = file.read()
+        yield {'name': file_name, 'content': content}
+
+# Build the prompt used to generate a test script for a code snippet, in the
+# language of the source file
+def build_generation_prompt(code_snippet, file_name="source.py"):
+    return get_backend(file_name).generation_prompt(code_snippet, file_name)
+
+# Remove the markdown code block (```python, ```javascript...) if present
+def strip_code_fences(test_script):
+    test_script = test_script.strip()
+    if test_script.startswith("```"):
+        test_script = test_script.split("\n", 1)[1].strip() if "\n" in test_script else ""  # Remove the "```python" line
     if test_script.endswith("```"):
         test_script = test_script[:-3].strip()  # Remove the closing "```"
-
     return test_script
 
-# Save generated test script to a file
+# Messages of a generation request. A rejected script is sent back with the
+# problems found in it, so the model only has to correct it.
+def build_generation_messages(code_snippet, previous_script=None, problems=None, file_name="source.py"):
+    messages = [{"role": "system", "content": build_generation_prompt(code_snippet, file_name)}]
+    if previous_script is not None:
+        messages += [
+            {"role": "assistant", "content": previous_script},
+            {
+                "role": "user",
+                "content": "The test script has the following problems:\n"
+                + "\n".join(f"- {problem}" for problem in problems)
+                + "\nReturn the corrected complete test script only.",
+            },
+        ]
+    return messages
+
+# Send a request for test code, reusing the previous answer if this exact
+# prompt was already sent, and return the code without its markdown fences.
+# The answer is a GeneratedTest, so the code never has to be cut out of prose.
+def request_test_code(messages, file_name, stage="generate", retry=False):
+    cache = get_cache()
+    cache_key = cache.key(os.getenv("MODEL_NAME"), 0.1, messages) if cache else None
+    content = cache.get(cache_key) if cache else None
+    cached = parse_cached(content, GeneratedTest) if content is not None else None
+    if cached is not None:
+        with telemetry.span("llm", file_name, stage=stage, cached=True):
+            return strip_code_fences(cached.code)
+
+    # Use the client to generate a response from the model
+    with telemetry.span("llm", file_name, stage=stage, retry=retry) as llm_span:
+        generated, completion = get_client().chat.completions.create_with_completion(
+            model=os.getenv("MODEL_NAME"),
+            response_model=GeneratedTest,
+            messages=messages,
+            temperature=0.1
+        )
+        telemetry.record_usage(llm_span, completion)
+    print(generated.code)
+    if cache:
+        cache.set(cache_key, generated.model_dump_json())
+    return strip_code_fences(generated.code)
+
+# Generate test cases using the 'client' instance and the AzureOpenAI model
+def generate_test(code_snippet, test_type="unit", previous_script=None, problems=None, file_name=None):
+    messages = build_generation_messages(code_snippet, previous_script, problems, file_name or "source.py")
+    return request_test_code(messages, file_name, retry=previous_script is not None)
+
+# Problems found in a generated test script, empty if it can be saved.
+# The checks depend on the language of the source.
+def check_test_script(file, test_script):
+    problems = get_backend(file['name']).check_test(file['name'], file['content'], test_script)
+    if problems:
+        print(f"Generated tests for {file['name']} are invalid: {'; '.join(problems)}")
+    return problems
+
+# Generate a test script that passes the checks, asking the model to correct it
+# up to GENERATION_ATTEMPTS times. Returns None if the request failed or every
+# attempt was invalid, so one file never stops the run.
+def generate_valid_test(file, attempts=GENERATION_ATTEMPTS):
+    test_script, problems = None, None
+    for attempt in range(attempts):
+        try:
+            test_script = generate_test(
+                file['content'], previous_script=test_script, problems=problems, file_name=file['name']
+            )
+        except Exception as e:
+            print(f"Generating tests for {file['name']} failed: {e}")
+            return None
+        problems = check_test_script(file, test_script)
+        if not problems:
+            return test_script
+    print(f"Giving up on {file['name']}: no valid test script after {attempts} attempts")
+    return None
+
+# Ask for tests of the functions the test file leaves uncovered and append them,
+# until the module reaches the coverage target or a request adds nothing. Each
+# request only carries the uncovered functions, so the tokens follow the gaps.
+def improve_coverage(file_name, test_file, target=COVERAGE_TARGET, rounds=COVERAGE_ROUNDS):
+    source_file = os.path.join(SOURCE_DIR, file_name)
+    with open(source_file, 'r') as f:
+        file = {'name': file_name, 'content': f.read()}
+    backend = get_backend(file_name)
+    telemetry.set_file(file_name)
+    measured = measure_coverage(source_file, test_file)
+    result = {'source': file_name, 'test_file': test_file, 'before': measured['percent'],
+              'after': measured['percent'], 'rounds': 0, 'added': 0, 'stop': None}
+    while result['after'] < target:
+        gaps = uncovered_functions(file['content'], measured['missing_lines'], measured['missing_branches'])
+        if not gaps:
+            result['stop'] = "the uncovered lines are outside functions"
+            break
+        if result['rounds'] == rounds:
+            result['stop'] = f"target not reached after {rounds} request(s)"
+            break
+        result['rounds'] += 1
+        with open(test_file, 'r') as f:
+            test_script = f.read()
+        print(f"{file_name}: {result['after']:.0f}% covered, asking for tests of "
+              f"{', '.join(gap['name'] for gap in gaps)}")
+        messages = [{"role": "system", "content": backend.coverage_prompt(
+            format_gaps(file['content'], gaps), file_name, existing_tests(test_script))}]
+        new_tests = request_test_code(messages, file_name, stage="coverage")
+        try:
+            extended = append_tests(test_script, new_tests)
+        except SyntaxError:
+            extended = None
+        if extended is None or check_test_script(file, extended):
+            result['stop'] = "the follow-up tests were invalid"
+            break
+        with open(test_file, 'w') as f:
+            f.write(extended)
+        measured = measure_coverage(source_file, test_file)
+        if measured['percent'] <= result['after']:
+            # nothing gained, keep the test file as it was
+            with open(test_file, 'w') as f:
+                f.write(test_script)
+            result['stop'] = "the follow-up tests covered nothing new"
+            break
+        result['added'] += len(existing_tests(extended)) - len(existing_tests(test_script))
+        result['after'] = measured['percent']
+    telemetry.set_file(None)
+    return result
+
+# Raise the coverage of every Python module with a test file up to the target.
+# Returns the test files that got new tests.
+def improve_test_coverage(target=COVERAGE_TARGET):
+    if not coverage_available():
+        print("coverage is not installed, skipping the coverage target.")
+        return []
+    results = []
+    for file_name in discover_files(SOURCE_DIR):
+        backend = get_backend(file_name)
+        test_file = backend.test_path(file_name)
+        if backend.name == "python" and os.path.exists(test_file):
+            results.append(improve_coverage(file_name, test_file, target))
+    print_coverage_summary(results)
+    return [result['test_file'] for result in results if result['added']]
+
+class RateLimiter:
+    """
+    Sliding one-minute window over the requests sent and the tokens they used.
+    A limit of 0 disables that check.
+    """
+
+    def __init__(self, max_requests=0, max_tokens=0, window=60.0):
+        self.max_requests = max_requests
+        self.max_tokens = max_tokens
+        self.window = window
+        self._events = deque()  # [timestamp, tokens] per request
+        self._lock = asyncio.Lock()
+
+    def _allows(self, tokens):
+        if self.max_requests and len(self._events) >= self.max_requests:
+            return False
+        used = sum(event[1] for event in self._events)
+        # A single request above the token budget still goes through on an empty window
+        if self.max_tokens and self._events and used + tokens > self.max_tokens:
+            return False
+        return True
+
+    async def acquire(self, tokens):
+        """Wait for room in the window, then reserve it. Returns the reservation."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                while self._events and now - self._events[0][0] >= self.window:
+                    self._events.popleft()
+                if self._allows(tokens):
+                    event = [now, tokens]
+                    self._events.append(event)
+                    return event
+                await asyncio.sleep(self._events[0][0] + self.window - now)
+
+    def settle(self, event, tokens):
+        """Replace the estimated token count of a reservation with the real usage."""
+        event[1] = tokens
+
+# Async client for the concurrent generation mode. LLM_BACKEND=fake answers offline.
+def make_async_client():
+    return make_client(asynchronous=True)
+
+# Generate a test script without blocking the event loop
+async def generate_test_async(
+    async_client,
+    code_snippet,
+    limiter,
+    timeout=GENERATION_TIMEOUT,
+    previous_script=None,
+    problems=None,
+    file_name=None,
+):
+    messages = build_generation_messages(code_snippet, previous_script, problems, file_name or "source.py")
+
+    # Cache hits skip both the rate limiter and the request
+    cache = get_cache()
+    cache_key = cache.key(os.getenv("MODEL_NAME"), 0.1, messages) if cache else None
+    content = cache.get(cache_key) if cache else None
+    cached = parse_cached(content, GeneratedTest) if content is not None else None
+    if cached is not None:
+        with telemetry.span("llm", file_name, stage="generate", cached=True):
+            return strip_code_fences(cached.code)
+
+    reservation = await limiter.acquire(estimate_tokens("".join(m["content"] for m in messages)))
+    with telemetry.span("llm", file_name, stage="generate", retry=previous_script is not None) as llm_span:
+        generated, completion = await asyncio.wait_for(
+            async_client.chat.completions.create_with_completion(
+                model=os.getenv("MODEL_NAME"),
+                response_model=GeneratedTest,
+                messages=messages,
+                temperature=0.1
+            ),
+            timeout=timeout,
+        )
+        telemetry.record_usage(llm_span, completion)
+    if completion.usage is not None:
+        limiter.settle(reservation, completion.usage.total_tokens)
+    if cache:
+        cache.set(cache_key, generated.model_dump_json())
+    return strip_code_fences(generated.code)
+
+# Async counterpart of generate_valid_test. Returns None if the request failed,
+# timed out or every attempt was invalid.
+async def generate_valid_test_async(async_client, file, limiter, timeout=GENERATION_TIMEOUT):
+    test_script, problems = None, None
+    for attempt in range(GENERATION_ATTEMPTS):
+        try:
+            test_script = await generate_test_async(
+                async_client, file['content'], limiter, timeout, test_script, problems, file['name']
+            )
+        except asyncio.TimeoutError:
+            print(f"Generating tests for {file['name']} timed out after {timeout}s")
+            return None
+        except Exception as e:
+            print(f"Generating tests for {file['name']} failed: {e}")
+            return None
+        problems = check_test_script(file, test_script)
+        if not problems:
+            print(f"Generated tests for {file['name']}")
+            return test_script
+    print(f"Giving up on {file['name']}: no valid test script after {GENERATION_ATTEMPTS} attempts")
+    return None
+
+# Save generated test script to a file named after the source, in its language
 def save_test(file_name, test_script, test_type="unit"):
-    test_dir = f"tests/{test_type}"
-    os.makedirs(test_dir, exist_ok=True)
-    
-    test_file_name = f"{test_dir}/{file_name.replace('.py', '').replace('.js', '')}_test.py"
-    with open(test_file_name, "w") as f:
-        f.write(test_script)
+    test_file_name = get_backend(file_name).save_test(file_name, test_script, f"tests/{test_type}")
     print(f"Test script saved as {test_file_name}")
+    return test_file_name
 
-# Run unit tests with Wolverine
-def run_tests():
+# Run unit tests with Wolverine. Several test files run at once (one per CPU
+# core by default), each in its own working copy; TEST_WORKERS=1 runs them in place.
+# In batch mode a single wolverine process repairs all of them, one conversation
+# per source module. Every test file runs even if some fail, the results carry
+# the return codes for raise_for_failures.
+def run_tests(workers=TEST_WORKERS, batch=BATCH_REPAIR):
     test_dir = "tests/unit"
-    test_files = [os.path.join(test_dir, f) for f in os.listdir(test_dir) if f.endswith("_test.py")]
+    test_files = sorted(os.path.join(test_dir, f) for f in os.listdir(test_dir) if is_test_file(f))
+    workers = workers or os.cpu_count() or 1
 
-    for test_file in test_files:
-        print(f"Running test: {test_file}")
-        subprocess.run(["python", "-m", "wolverine", test_file], check=True)
+    if batch:
+        # the batch session runs pytest, the tests of other languages are repaired one by one
+        python_files = [f for f in test_files if get_backend(f).name == "python"]
+        results = [run_test_file(f, 1) for f in test_files if f not in python_files]
+        if python_files:
+            start = time.monotonic()
+            returncode = subprocess.run([sys.executable, "-m", "wolverine", *python_files, "--batch"]).returncode
+            results.append({"test_file": " ".join(python_files), "returncode": returncode, "merged": [],
+                            "conflicts": [], "duration": time.monotonic() - start})
+    elif workers == 1:
+        results = [run_test_file(test_file, 1) for test_file in test_files]
+    else:
+        results = run_tests_parallel(test_files, workers)
+    print_summary(results)
+    return results
+
+# Raise CalledProcessError for the first wolverine run that didn't pass, or
+# RuntimeError for a module whose tests could not be generated
+def raise_for_failures(results):
+    for result in results:
+        if result.get("error"):
+            raise RuntimeError(result["error"])
+        if result["returncode"] != 0:
+            raise subprocess.CalledProcessError(
+                result["returncode"], ["python", "-m", "wolverine", *result["test_file"].split()]
+            )
 
 # Generate unit tests for all files in the repo and run them
 def generate_and_run_tests():
-    files = fetch_files()
-    
-    for file in files:
-        content = file['content']
-        original_filename = file['name']
-        
-        test_file_name = f"tests/unit/{original_filename.replace('.py', '').replace('.js', '')}_test.py"
-
-        # Check if the test file already exists, skip if exists
-        if os.path.exists(test_file_name):
-            print(f"Skipping {original_filename}: Test file already exists.")
-            continue  
-
-        # Generate and save only unit tests
-        unit_test_script = generate_test(content, test_type="unit")
-        save_test(file['name'], unit_test_script, test_type="unit")
-    
-    # Run all generated unit tests
-    run_tests()
+    # Spans of this run and of the wolverine subprocesses go to one report
+    telemetry.start_run()
+    try:
+        generate_and_test_files()
+        if COVERAGE_TARGET:
+            # the new tests may fail, they go through wolverine like the others
+            results = [run_test_file(test_file, 1) for test_file in improve_test_coverage()]
+            print_summary(results)
+            raise_for_failures(results)
+        if MUTATION_TESTING:
+            run_mutation_testing()
+    finally:
+        telemetry.write_report()
+
+# Run wolverine on one test file and return its result. With several workers
+# each run gets its own working copy whose edits are merged back afterwards.
+def run_test_file(test_file, workers):
+    if workers > 1:
+        result = merge_back(run_isolated(test_file))
+        print(f"===== {test_file} =====")
+        print(result["output"])
+    else:
+        print(f"Running test: {test_file}")
+        start = time.monotonic()
+        with telemetry.span("subprocess", source_name(test_file), stage="wolverine"):
+            returncode = subprocess.run([sys.executable, "-m", "wolverine", test_file]).returncode
+        result = {"test_file": test_file, "returncode": returncode, "merged": [], "conflicts": []}
+        result["duration"] = time.monotonic() - start
+    # the output was printed, only the summary is kept
+    result.pop("output", None)
+    return result
+
+# Generate the missing or stale unit tests and run them as a pipeline:
+# discover -> read -> generate and validate -> save -> run. Bounded queues sit
+# between the stages, so the tests of one file run while the next ones are
+# generated, and only a few files are in memory at any time.
+# files limits the run to some modules of SOURCE_DIR, and run_test replaces the
+# way a test file is run and repaired (a wolverine subprocess by default).
+def generate_and_test_files(workers=TEST_WORKERS, batch=BATCH_REPAIR, files=None, run_test=run_test_file):
+    manifest = Manifest()
+    manifest_lock = threading.Lock()
+    seen = []
+    # modules whose tests were generated or found up to date in this run
+    current = set()
+    results = []
+    generation_failures = []
+    workers = workers or os.cpu_count() or 1
+
+    # Modules whose source and dependencies are unchanged since their tests were
+    # generated go straight to the run stage
+    def read(file_name, emit):
+        index = len(seen)
+        seen.append(file_name)
+        test_file_name = get_backend(file_name).test_path(file_name)
+        with manifest_lock:
+            stale = manifest.is_stale(file_name, test_file_name)
+            if not stale and file_name not in manifest.entries:
+                manifest.record(file_name, test_file_name)
+        if not stale:
+            current.add(file_name)
+            print(f"Skipping {file_name}: Tests are up to date.")
+            emit({'index': index, 'name': file_name, 'test_file': test_file_name})
+            return
+        with open(os.path.join(SOURCE_DIR, file_name), 'r') as f:
+            emit({'index': index, 'name': file_name, 'content': f.read()})
+
+    if GENERATION_CONCURRENCY > 1:
+        # The requests of the generation workers share one event loop, and its rate limits
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        async_client = make_async_client()
+        limiter = RateLimiter(MAX_REQUESTS_PER_MINUTE, MAX_TOKENS_PER_MINUTE)
+
+    def generate(file, emit):
+        if 'test_file' not in file:
+            if GENERATION_CONCURRENCY > 1:
+                file['script'] = asyncio.run_coroutine_threadsafe(
+                    generate_valid_test_async(async_client, file, limiter), loop
+                ).result()
+            else:
+                file['script'] = generate_valid_test(file)
+        emit(file)
+
+    # The generation workers finish in any order, the scripts are saved in the
+    # order the files were discovered. Only the files generated ahead of a slow
+    # one wait here.
+    reorder = {'next': 0, 'pending': {}}
+
+    def save(file, emit):
+        reorder['pending'][file['index']] = file
+        while reorder['next'] in reorder['pending']:
+            save_one(reorder['pending'].pop(reorder['next']), emit)
+            reorder['next'] += 1
+
+    def save_one(file, emit):
+        if 'test_file' not in file:
+            test_file_name = get_backend(file['name']).test_path(file['name'])
+            if file['script'] is not None:
+                test_file_name = save_test(file['name'], file['script'], test_type="unit")
+                with manifest_lock:
+                    manifest.record(file['name'], test_file_name)
+                    current.add(file['name'])
+            else:
+                # counted as failed, even when the previous tests still run
+                print(f"No new tests for {file['name']}, its generation failed")
+                generation_failures.append({
+                    "test_file": test_file_name, "returncode": 1, "merged": [], "conflicts": [],
+                    "duration": 0.0, "error": f"test generation for {file['name']} failed",
+                })
+                if not os.path.exists(test_file_name):
+                    return
+            # an invalid new script leaves the previous tests to run
+            file = {'name': file['name'], 'test_file': test_file_name}
+        emit(file['test_file'])
+
+    def run(test_file, emit):
+        if not batch:
+            results.append(run_test(test_file, workers))
+
+    try:
+        run_pipeline(
+            discover_files(SOURCE_DIR) if files is None else files,
+            [
+                ("read", read, 1),
+                ("generate", generate, max(1, GENERATION_CONCURRENCY)),
+                ("save", save, 1),
+                ("run", run, 1 if batch else workers),
+            ],
+        )
+    finally:
+        if GENERATION_CONCURRENCY > 1:
+            loop.call_soon_threadsafe(loop.stop)
+        if files is None:
+            # only a full run knows which modules are gone
+            manifest.prune(seen)
+        manifest.save()
+
+    cache = get_cache()
+    if cache:
+        print(f"LLM cache: {cache.hits} hits, {cache.misses} misses")
+
+    try:
+        if batch:
+            # one wolverine process needs every test file, it can only start now
+            results = generation_failures + run_tests(batch=True)
+        else:
+            results = sorted(generation_failures + results, key=lambda result: result["test_file"])
+            print_summary(results)
+    finally:
+        # wolverine may have repaired the tests or the sources, keep their hashes
+        # current, also for the tests that passed when others didn't. Modules
+        # whose regeneration failed keep their old hashes and stay stale.
+        manifest.refresh(current)
+        manifest.save()
+
+    raise_for_failures(results)
 
 if __name__ == "__main__":
     generate_and_run_tests()
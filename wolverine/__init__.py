@@ -1 +1 @@
-from .wolverine import apply_changes, json_validated_response # noqa
\ No newline at end of file
+from .wolverine import apply_changes, apply_response, json_validated_response # noqa
@@ -0,0 +1,164 @@
+import os
+import shutil
+from typing import TYPE_CHECKING, Dict, List
+
+from termcolor import cprint
+
+from . import telemetry
+from .context import build_batch_source_context
+from .clients import client_errors
+from .convergence import LLM_ERROR, PASSED, RepairBudget
+from .failed_tests import failed_test_source
+from .inprocess import failed_results, format_failures, run_tests_in_process
+from .languages import get_backend, module_path, source_name
+from .patching import get_engine
+from .wolverine import (
+    DEFAULT_MODEL,
+    apply_response,
+    get_imported_files,
+    get_system_prompt,
+    json_validated_response,
+)
+
+if TYPE_CHECKING:
+    from .schemas import RepairResponse
+
+BATCH_INSTRUCTIONS = (
+    "The failures below come from several test files that import the same code. "
+    "Fix their common cause once. Set the file of every edit to the path of the "
+    "file it applies to."
+)
+
+
+def source_of(test_file: str, source_dir: str = "testfiles") -> str:
+    """
+    The first testfiles module imported by test_file, or the test file itself
+    when it imports none.
+    """
+    for module in get_imported_files(test_file):
+        path = module_path(module, test_file, source_dir)
+        if path:
+            return path
+    return test_file
+
+
+def group_by_source(test_files: List[str]) -> Dict[str, List[str]]:
+    groups = {}
+    for test_file in test_files:
+        groups.setdefault(source_of(test_file), []).append(test_file)
+    return groups
+
+
+def run_group(test_files: List[str]) -> Dict[str, List[Dict]]:
+    """
+    Run the test files together in one pytest session and return the failures
+    of each file.
+    """
+    results = run_tests_in_process(test_files[0], list(test_files))
+    failures = {os.path.normpath(test_file): [] for test_file in test_files}
+    for result in failed_results(results):
+        path = os.path.normpath(result["id"].split("::")[0])
+        failures.setdefault(path, []).append(result)
+    return {path: found for path, found in failures.items() if found}
+
+
+def send_batch_to_gpt(
+    failures: Dict[str, List[Dict]],
+    imported_files: List[str],
+    model: str = DEFAULT_MODEL,
+    note: str = "",
+) -> "RepairResponse":
+    """
+    Send the failures of several test files and the code they share in a
+    single request. note is added at the end of the prompt.
+    """
+    prompt = BATCH_INSTRUCTIONS + "\n\n"
+    failed_cases = []
+    for test_file, test_failures in failures.items():
+        failed_test_case = "\n".join(failure["id"] for failure in test_failures)
+        failed_cases.append((test_file, failed_test_case))
+        prompt += (
+            f"Here is the failed test case from {test_file}:\n\n"
+            f"{failed_test_source(test_file, failed_test_case)}\n\n"
+            "Here is the error message:\n\n"
+            f"{format_failures(test_failures)}\n\n"
+        )
+    prompt += "Here is the code from the imported files:\n\n"
+    prompt += build_batch_source_context(failed_cases, imported_files)
+    if note:
+        prompt += f"\n{note}\n"
+
+    messages = [
+        {"role": "system", "content": get_system_prompt()},
+        {"role": "user", "content": prompt},
+    ]
+    return json_validated_response(model, messages)
+
+
+def batch_repair(
+    test_files: List[str], model: str = DEFAULT_MODEL, confirm: bool = False, **budget_limits
+) -> List[Dict]:
+    """
+    Repair several test files with one conversation per source file: the
+    failures of all the tests importing the same module are sent together,
+    the edits are applied to each file they name, and the group is rerun.
+    Each group stops on its own budget (see RepairBudget), and the reason
+    each one stopped is returned.
+    """
+    stops = []
+    # the group runs in one pytest session, other languages are repaired one file at a time
+    for test_file in [t for t in test_files if get_backend(t).name != "python"]:
+        cprint(f"Skipping {test_file}: batch mode only repairs Python tests", "yellow")
+        stops.append(RepairBudget(source_name(test_file), **budget_limits).report("unsupported_language"))
+    test_files = [t for t in test_files if get_backend(t).name == "python"]
+
+    for test_file in test_files:
+        shutil.copy(test_file, test_file + ".bak")
+    engine = get_engine("batch")
+    engine.reset()
+
+    for source, group in group_by_source(test_files).items():
+        cprint(f"Repairing {len(group)} test file(s) importing {source}", "blue")
+        imported_files = list(
+            dict.fromkeys(m for test_file in group for m in get_imported_files(test_file))
+        )
+        note = ""
+        # the spans of the group are attributed to the source file it shares
+        name = source_name(source)
+        budget = RepairBudget(name, **budget_limits)
+        telemetry.set_file(name)
+        with telemetry.span("repair", name, tests=len(group)) as repair_span:
+            while True:
+                failures = run_group(group)
+                errors = sorted(failure["id"] for found in failures.values() for failure in found)
+                stop_reason = budget.observe(group + [source], errors, note)
+                if stop_reason == PASSED:
+                    repair_span["passed"] = True
+                    cprint("Tests ran successfully.", "blue")
+                    break
+                if stop_reason:
+                    cprint(f"Tests still failing, giving up: {stop_reason}.", "red")
+                    break
+                count = sum(len(test_failures) for test_failures in failures.values())
+                cprint(
+                    f"{count} test(s) failed in {len(failures)} file(s). Trying to fix...",
+                    "blue",
+                )
+                engine.iteration += 1
+                repair_span["iterations"] = repair_span.get("iterations", 0) + 1
+                try:
+                    response = send_batch_to_gpt(failures, imported_files, model, note)
+                except client_errors() as e:
+                    cprint(f"The repair request failed, giving up: {e}", "red")
+                    stop_reason = LLM_ERROR
+                    break
+                rejected = apply_response(response, confirm=confirm)
+                note = "".join(f"Your previous changes were not applied: {problem}\n" for problem in rejected)
+                if len(rejected) < len(response.edits_by_file()):
+                    cprint("Changes applied. Rerunning...", "blue")
+                else:
+                    # the budget stops the group if the answers keep being rejected
+                    cprint("No changes applied, asking again with the reasons.", "yellow")
+            repair_span["stop"] = budget.report(stop_reason)
+        stops.append(repair_span["stop"])
+    return stops
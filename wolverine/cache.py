@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+# Location and limits of the on-disk LLM response cache
+CACHE_PATH = os.getenv("LLM_CACHE_PATH", ".llm_cache.sqlite3")
+CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", 100 * 1024 * 1024))
+# Time to live in seconds, 0 keeps entries until they are evicted
+CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", 30 * 24 * 3600))
+# Set LLM_CACHE=0 to always call the API
+CACHE_ENABLED = os.getenv("LLM_CACHE", "1") != "0"
+
+
+def _normalize_message(message) -> Dict:
+    """
+    Messages can be plain dicts or response objects from the client.
+    Only the role and content take part in the cache key.
+    """
+    if not isinstance(message, dict):
+        message = message.model_dump()
+    return {"role": message.get("role"), "content": message.get("content")}
+
+
+class ResponseCache:
+    """
+    Persistent cache of LLM completions keyed on a hash of
+    (model, temperature, messages). Entries are evicted least recently used
+    first once the stored content exceeds max_bytes, and expire after ttl seconds.
+    """
+
+    def __init__(
+        self,
+        path: str = CACHE_PATH,
+        max_bytes: int = CACHE_MAX_BYTES,
+        ttl: float = CACHE_TTL,
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # shared by the threads of a run (concurrent generation, speculative fixes)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._lock = threading.RLock()
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, content TEXT, size INTEGER, "
+            "created REAL, accessed REAL)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def key(model: str, temperature: float, messages: List) -> str:
+        payload = json.dumps(
+            {
+                "model": model,
+                "temperature": temperature,
+                "messages": [_normalize_message(m) for m in messages],
+            },
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            return self._get(key)
+
+    def _get(self, key: str) -> Optional[str]:
+        row = self._conn.execute(
+            "SELECT content, created FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        now = time.time()
+        if row is None or (self.ttl and now - row[1] > self.ttl):
+            if row is not None:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._conn.commit()
+            self.misses += 1
+            return None
+        self._conn.execute(
+            "UPDATE responses SET accessed = ? WHERE key = ?", (now, key)
+        )
+        self._conn.commit()
+        self.hits += 1
+        return row[0]
+
+    def set(self, key: str, content: str):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (key, content, len(content.encode("utf-8")), now, now),
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        total = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._conn.execute(
+            "SELECT key, size FROM responses ORDER BY accessed ASC"
+        ).fetchall()
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+
+    def stats(self) -> Dict:
+        with self._lock:
+            entries, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": entries,
+            "bytes": size,
+        }
+
+
+_cache = None
+
+
+def get_cache() -> Optional[ResponseCache]:
+    """
+    Return the shared cache for this process, or None when caching is disabled.
+    """
+    global _cache
+    if not CACHE_ENABLED:
+        return None
+    if _cache is None:
+        _cache = ResponseCache()
+    return _cache
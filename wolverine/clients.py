@@ -0,0 +1,422 @@
+import ast
+import json
+import os
+import random
+import re
+import threading
+import time
+from functools import lru_cache
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .cache import ResponseCache
+from .context import estimate_tokens
+from .languages import SOURCE_DIR, discover_files, get_backend
+
+# Which client the pipeline talks to: "azure" (default) or "fake"
+LLM_BACKEND = os.getenv("LLM_BACKEND", "azure")
+# Answers saved by LLM_RECORD and replayed by the fake backend, one JSON line each
+LLM_RECORDINGS = os.getenv("LLM_RECORDINGS", "llm_recordings.jsonl")
+# Set LLM_RECORD=1 to save the answers of the real client to LLM_RECORDINGS
+LLM_RECORD = os.getenv("LLM_RECORD", "0") == "1"
+
+# Behaviour of the fake backend
+FAKE_LLM_LATENCY = float(os.getenv("FAKE_LLM_LATENCY", 0))
+FAKE_LLM_FAILURE_RATE = float(os.getenv("FAKE_LLM_FAILURE_RATE", 0))
+FAKE_LLM_INVALID_RATE = float(os.getenv("FAKE_LLM_INVALID_RATE", 0))
+FAKE_LLM_SEED = os.getenv("FAKE_LLM_SEED", "0")
+# Pristine copies of the sources, used to answer repair requests
+FAKE_LLM_REFERENCE_DIR = os.getenv("FAKE_LLM_REFERENCE_DIR", "")
+
+CODE_FROM = re.compile(r"^Code from (\S+):$")
+NUMBERED_LINE = re.compile(r"^(\d+): (.*)$")
+
+
+class FakeAPIError(RuntimeError):
+    """
+    Raised by the fake backend for the requests picked to fail.
+    """
+
+
+def client_errors() -> Tuple[type, ...]:
+    """
+    Errors of a request that failed, or whose answers never fit the response
+    model within the retries. Only evaluated once something was raised, so
+    the client libraries are not loaded for it.
+    """
+    from pydantic import ValidationError
+
+    errors = [FakeAPIError, ValidationError]
+    try:
+        from openai import OpenAIError
+
+        errors.append(OpenAIError)
+    except ImportError:
+        pass
+    try:
+        from instructor.exceptions import InstructorRetryException
+
+        errors.append(InstructorRetryException)
+    except ImportError:
+        pass
+    return tuple(errors)
+
+
+def _message_content(message) -> str:
+    if not isinstance(message, dict):
+        message = message.model_dump()
+    return message.get("content") or ""
+
+
+def load_recordings(path: str = LLM_RECORDINGS) -> Dict[str, str]:
+    recordings = {}
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    recordings[record["key"]] = record["content"]
+    return recordings
+
+
+def smoke_test(code_snippet: str) -> Optional[str]:
+    """
+    Answer to a generation request, as a GeneratedTest: a test checking that
+    every top level function and class of the source exists. The source is
+    found in SOURCE_DIR by its content, since the prompt doesn't name it.
+    """
+    for name in discover_files(SOURCE_DIR):
+        with open(os.path.join(SOURCE_DIR, name), "r") as f:
+            if f.read().strip() != code_snippet.strip():
+                continue
+        if not name.endswith(".py"):
+            return None
+        module = os.path.splitext(os.path.basename(name))[0]
+        try:
+            tree = ast.parse(code_snippet)
+        except SyntaxError:
+            return None
+        names = [
+            node.name
+            for node in tree.body
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef))
+        ]
+        lines = get_backend(name).preamble.splitlines()
+        lines += ["import unittest", f"import {module}", "", "", f"class Test{module.title().replace('_', '')}(unittest.TestCase):"]
+        for defined in names or ["__name__"]:
+            lines += [
+                f"    def test_{defined.lower()}_exists(self):",
+                f"        self.assertTrue(hasattr({module}, {defined!r}))",
+                "",
+            ]
+        lines += ["", 'if __name__ == "__main__":', "    unittest.main()"]
+        return json.dumps({"code": "\n".join(lines)})
+    return None
+
+
+def reference_fix(prompt: str, reference_dir: str = FAKE_LLM_REFERENCE_DIR) -> Optional[str]:
+    """
+    Answer to a repair request, as a RepairResponse: the edits that bring the
+    first source in the prompt whose numbered lines differ from its copy in
+    reference_dir back to that copy.
+    """
+    if not reference_dir:
+        return None
+    file_path, changes = None, []
+    for line in prompt.splitlines():
+        header = CODE_FROM.match(line)
+        if header:
+            if changes:
+                break
+            file_path = header.group(1)
+            reference = os.path.join(reference_dir, file_path)
+            expected = None
+            if os.path.exists(reference):
+                with open(reference, "r") as f:
+                    expected = f.read().splitlines()
+            continue
+        numbered = NUMBERED_LINE.match(line)
+        if not numbered or file_path is None or expected is None:
+            continue
+        number, content = int(numbered.group(1)), numbered.group(2)
+        if number <= len(expected) and expected[number - 1] != content:
+            changes.append({"operation": "Replace", "line": number, "content": expected[number - 1]})
+    if not changes:
+        return None
+    return json.dumps(
+        {
+            "explanations": [f"Restore {len(changes)} line(s) of {file_path}"],
+            "file": file_path,
+            "edits": changes,
+        }
+    )
+
+
+class FakeLLM:
+    """
+    Deterministic stand-in for the chat completion API. Answers come from the
+    recordings when the request was recorded, then from the responders (test
+    generation and repair), and "{}" otherwise. Latency, failures and invalid
+    answers are drawn from a random generator seeded with the request, so a
+    run can be replayed exactly.
+    """
+
+    def __init__(
+        self,
+        recordings: Optional[Dict[str, str]] = None,
+        latency: float = FAKE_LLM_LATENCY,
+        failure_rate: float = FAKE_LLM_FAILURE_RATE,
+        invalid_rate: float = FAKE_LLM_INVALID_RATE,
+        seed: str = FAKE_LLM_SEED,
+        responders: Optional[List[Callable[[List], Optional[str]]]] = None,
+    ):
+        self.recordings = load_recordings() if recordings is None else recordings
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.invalid_rate = invalid_rate
+        self.seed = seed
+        self.responders = responders if responders is not None else [self._generation, self._repair]
+        self.calls = 0
+        self._attempts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _generation(messages: List) -> Optional[str]:
+        prompt = _message_content(messages[0])
+        if "write unit test cases" not in prompt or "```" not in prompt:
+            return None
+        return smoke_test(prompt.split("```")[1])
+
+    @staticmethod
+    def _repair(messages: List) -> Optional[str]:
+        # the failures are in the first user message, a retry appends the
+        # rejected answer and the validation errors after it
+        for message in messages:
+            if not isinstance(message, dict):
+                message = message.model_dump()
+            if message.get("role") == "user":
+                return reference_fix(_message_content(message))
+        return None
+
+    def answer(self, model: str, messages: List, temperature: float) -> Tuple[str, float]:
+        """
+        The content of the answer to a request and how long to wait before it.
+        """
+        key = ResponseCache.key(model, temperature, messages)
+        with self._lock:
+            self.calls += 1
+            attempt = self._attempts.get(key, 0)
+            self._attempts[key] = attempt + 1
+        rng = random.Random(f"{self.seed}:{key}:{attempt}")
+        delay = self.latency * (0.5 + rng.random()) if self.latency else 0.0
+        if rng.random() < self.failure_rate:
+            raise FakeAPIError(f"Simulated API failure (attempt {attempt + 1})")
+        content = self.recordings.get(key)
+        for responder in self.responders:
+            if content is not None:
+                break
+            content = responder(messages)
+        content = "{}" if content is None else content
+        if rng.random() < self.invalid_rate:
+            # cut the answer short, as a dropped connection would
+            content = content[: max(1, len(content) // 2)]
+        return content, delay
+
+    @staticmethod
+    def completion(messages: List, content: str):
+        prompt_tokens = estimate_tokens("".join(_message_content(m) for m in messages))
+        completion_tokens = estimate_tokens(content)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(role="assistant", content=content))],
+            usage=SimpleNamespace(
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                total_tokens=prompt_tokens + completion_tokens,
+            ),
+        )
+
+
+class _Completions:
+    """
+    The chat.completions interface of a client wrapped by instructor: with
+    a response_model the answer is validated by it, and asked again up to
+    max_retries times when it doesn't fit.
+    """
+
+    def __init__(self, llm: FakeLLM, asynchronous: bool):
+        self._llm = llm
+        self._asynchronous = asynchronous
+
+    def _respond(self, model, messages, temperature, response_model, max_retries):
+        attempts = max(1, max_retries)
+        delay = 0.0
+        for attempt in range(attempts):
+            content, wait = self._llm.answer(model, messages, temperature)
+            delay += wait
+            completion = self._llm.completion(messages, content)
+            if response_model is None:
+                return completion, completion, delay
+            try:
+                return response_model.model_validate_json(content), completion, delay
+            except ValueError:
+                # pydantic's ValidationError, the request is sent again
+                if attempt == attempts - 1:
+                    raise
+
+    def create_with_completion(
+        self, model=None, messages=(), temperature=1.0, response_model=None, max_retries=3, **kwargs
+    ):
+        if self._asynchronous:
+            return self._create_async(model, messages, temperature, response_model, max_retries)
+        response, completion, delay = self._respond(model, messages, temperature, response_model, max_retries)
+        time.sleep(delay)
+        return response, completion
+
+    def create(self, *args, **kwargs):
+        if self._asynchronous:
+            return self._first(self.create_with_completion(*args, **kwargs))
+        return self.create_with_completion(*args, **kwargs)[0]
+
+    def create_partial(self, *args, **kwargs):
+        """
+        The answer in a single piece, where a real stream would fill it in
+        little by little.
+        """
+        yield self.create(*args, **kwargs)
+
+    async def _create_async(self, model, messages, temperature, response_model, max_retries):
+        import asyncio
+
+        response, completion, delay = self._respond(model, messages, temperature, response_model, max_retries)
+        await asyncio.sleep(delay)
+        return response, completion
+
+    @staticmethod
+    async def _first(pair):
+        return (await pair)[0]
+
+
+class FakeClient:
+    """
+    Client with the chat.completions interface of the instructor wrapped
+    OpenAI clients, answered by a FakeLLM.
+    """
+
+    def __init__(self, llm: Optional[FakeLLM] = None, asynchronous: bool = False):
+        self.llm = llm or FakeLLM()
+        self.chat = SimpleNamespace(completions=_Completions(self.llm, asynchronous))
+
+
+class RecordingClient:
+    """
+    Wraps a synchronous client and appends every answer to a recordings file
+    that the fake backend can replay. Validated answers are recorded as the
+    JSON of their response model.
+    """
+
+    def __init__(self, client, path: str = LLM_RECORDINGS):
+        self._client = client
+        self._path = path
+        self._lock = threading.Lock()
+        self.chat = SimpleNamespace(
+            completions=SimpleNamespace(
+                create=self._create,
+                create_with_completion=self._create_with_completion,
+                create_partial=self._create_partial,
+            )
+        )
+
+    def _record(self, model, temperature, messages, response):
+        if hasattr(response, "choices"):
+            content = response.choices[0].message.content
+        else:
+            content = response.model_dump_json()
+        line = json.dumps({"key": ResponseCache.key(model, temperature, messages), "content": content})
+        with self._lock, open(self._path, "a") as f:
+            f.write(line + "\n")
+
+    def _create_with_completion(self, model=None, messages=(), temperature=1.0, **kwargs):
+        response, completion = self._client.chat.completions.create_with_completion(
+            model=model, messages=messages, temperature=temperature, **kwargs
+        )
+        self._record(model, temperature, messages, response)
+        return response, completion
+
+    def _create(self, model=None, messages=(), temperature=1.0, **kwargs):
+        response = self._client.chat.completions.create(
+            model=model, messages=messages, temperature=temperature, **kwargs
+        )
+        self._record(model, temperature, messages, response)
+        return response
+
+    def _create_partial(self, model=None, messages=(), temperature=1.0, **kwargs):
+        partial = None
+        for partial in self._client.chat.completions.create_partial(
+            model=model, messages=messages, temperature=temperature, **kwargs
+        ):
+            yield partial
+        if partial is not None:
+            self._record(model, temperature, messages, partial)
+
+
+def _azure_client(asynchronous: bool = False):
+    # the client libraries take most of the startup time, only load them when needed
+    from instructor import from_openai
+    from openai import AsyncAzureOpenAI, AzureOpenAI
+
+    client_class = AsyncAzureOpenAI if asynchronous else AzureOpenAI
+    return from_openai(
+        client_class(
+            api_key=os.getenv("API_KEY"),
+            api_version=os.getenv("LLM_API_VERSION"),
+            azure_endpoint=os.getenv("BASE_URL"),
+            azure_deployment=os.getenv("MODEL_DEPLOYMENT"),
+        )
+    )
+
+
+_fake_llm = None
+
+
+def _fake_client(asynchronous: bool = False):
+    # the sync and async clients share the answers and the attempt counters
+    global _fake_llm
+    if _fake_llm is None:
+        _fake_llm = FakeLLM()
+    return FakeClient(_fake_llm, asynchronous)
+
+
+CLIENT_FACTORIES: Dict[str, Callable] = {"azure": _azure_client, "fake": _fake_client}
+
+
+def register_client_factory(name: str, factory: Callable):
+    """
+    Make factory(asynchronous=False) available as LLM_BACKEND=name.
+    """
+    CLIENT_FACTORIES[name] = factory
+
+
+def make_client(asynchronous: bool = False, backend: Optional[str] = None):
+    """
+    The chat completion client of the configured backend. With LLM_RECORD=1
+    the answers of a synchronous client are also saved for replay.
+    """
+    backend = backend or LLM_BACKEND
+    if backend not in CLIENT_FACTORIES:
+        raise ValueError(
+            f"Unknown LLM_BACKEND {backend!r}, expected one of {', '.join(CLIENT_FACTORIES)}"
+        )
+    client = CLIENT_FACTORIES[backend](asynchronous=asynchronous)
+    if LLM_RECORD and not asynchronous:
+        client = RecordingClient(client)
+    return client
+
+
+@lru_cache(maxsize=None)
+def get_client(asynchronous: bool = False):
+    """
+    The client of the configured backend, created on the first LLM request
+    and shared afterwards. Runs that need no request, like --revert or tests
+    that pass on the first try, never load the client libraries.
+    """
+    return make_client(asynchronous=asynchronous)
@@ -0,0 +1,173 @@
+import ast
+import os
+from typing import Dict, List, Set, Tuple
+
+from .failed_tests import definition_span, failed_test_spans, number_lines
+from .languages import module_path
+
+# Approximate number of tokens of imported source code sent with each repair request
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 4000))
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Rough token count, about four characters per token.
+    """
+    return max(1, len(text) // 4)
+
+
+def _used_names(node: ast.AST) -> Set[str]:
+    names = set()
+    for child in ast.walk(node):
+        if isinstance(child, ast.Name):
+            names.add(child.id)
+        elif isinstance(child, ast.Attribute):
+            names.add(child.attr)
+    return names
+
+
+def referenced_names(test_file: str, spans: List[Tuple[int, int]]) -> Set[str]:
+    """
+    Names used on the given lines of test_file, with "from x import a as b"
+    aliases mapped back to the imported name.
+    """
+    with open(test_file, "r") as f:
+        try:
+            tree = ast.parse(f.read())
+        except SyntaxError:
+            return set()
+    aliases = {
+        alias.asname: alias.name
+        for node in ast.walk(tree)
+        if isinstance(node, ast.ImportFrom)
+        for alias in node.names
+        if alias.asname
+    }
+    lines = {n for start, end in spans for n in range(start, end + 1)}
+    names = set()
+    for node in ast.walk(tree):
+        if getattr(node, "lineno", None) in lines:
+            if isinstance(node, ast.Name):
+                names.add(aliases.get(node.id, node.id))
+            elif isinstance(node, ast.Attribute):
+                names.add(node.attr)
+    return names
+
+
+def _definitions(tree: ast.Module) -> Dict[str, ast.AST]:
+    """
+    Top level functions, classes and assigned names of a module.
+    """
+    definitions = {}
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            definitions[node.name] = node
+        elif isinstance(node, (ast.Assign, ast.AnnAssign)):
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            for target in targets:
+                if isinstance(target, ast.Name):
+                    definitions[target.id] = node
+    return definitions
+
+
+def slice_module(source: str, names: Set[str]) -> List[Tuple[Tuple[int, int], bool]]:
+    """
+    Spans of the module needed to understand the given names: its imports,
+    the definitions of the names (required) and, breadth first, the
+    definitions they use in turn. Empty when none of the names is defined in
+    the module.
+    """
+    tree = ast.parse(source)
+    definitions = _definitions(tree)
+    roots = [name for name in definitions if name in names]
+    if not roots:
+        return []
+
+    parts = [
+        (definition_span(node), True)
+        for node in tree.body
+        if isinstance(node, (ast.Import, ast.ImportFrom))
+    ]
+    seen_nodes = set()
+    queue = [(name, True) for name in roots]
+    while queue:
+        name, required = queue.pop(0)
+        node = definitions[name]
+        if id(node) in seen_nodes:
+            continue
+        seen_nodes.add(id(node))
+        parts.append((definition_span(node), required))
+        queue.extend(
+            (used, False)
+            for used in sorted(_used_names(node))
+            if used in definitions and used != name
+        )
+    return parts
+
+
+def build_source_context(
+    test_file: str,
+    failed_test_case: str,
+    imported_files: List[str],
+    token_budget: int = CONTEXT_TOKEN_BUDGET,
+) -> str:
+    """
+    Code of the imported testfiles modules for the repair prompt, limited to
+    the functions and classes the failing tests use and their callees. Lines
+    keep their number in the file so edits can be applied to it. Callees are
+    dropped once token_budget is spent; when the failing tests can't be found,
+    the top level definitions are added in file order within the budget.
+    """
+    return build_batch_source_context(
+        [(test_file, failed_test_case)], imported_files, token_budget
+    )
+
+
+def build_batch_source_context(
+    failures: List[Tuple[str, str]],
+    imported_files: List[str],
+    token_budget: int = CONTEXT_TOKEN_BUDGET,
+) -> str:
+    """
+    Same as build_source_context for the failing tests of several test files,
+    given as (test_file, failed_test_case) pairs. Each module is sent once.
+    """
+    names = set()
+    for test_file, failed_test_case in failures:
+        spans = failed_test_spans(test_file, failed_test_case)
+        if spans:
+            names |= referenced_names(test_file, spans)
+
+    context = ""
+    remaining = token_budget
+    importer = failures[0][0] if failures else ""
+    for module in dict.fromkeys(imported_files):
+        file_path = module_path(module, importer)
+        if not file_path:
+            continue
+        with open(file_path, "r") as f:
+            lines = f.readlines()
+
+        try:
+            parts = slice_module("".join(lines), names)
+            if not parts:
+                parts = [(definition_span(node), False) for node in ast.parse("".join(lines)).body]
+        except SyntaxError:
+            parts = [((1, len(lines)), True)]
+
+        selected, omitted = [], 0
+        for (start, end), required in parts:
+            cost = estimate_tokens("".join(lines[start - 1:end]))
+            if not required and cost > remaining:
+                omitted += 1
+                continue
+            selected.append((start, end))
+            remaining -= cost
+
+        context += f"Code from {file_path}:\n"
+        context += number_lines(lines, selected)
+        if not context.endswith("\n"):
+            context += "\n"
+        if omitted:
+            context += f"... ({omitted} more definitions left out)\n"
+    return context
@@ -0,0 +1,139 @@
+import hashlib
+import os
+import time
+from typing import Dict, Iterable, List, Optional
+
+from . import telemetry
+from .languages import get_backend, module_path
+
+# Limits of a single repair session, 0 disables a limit
+MAX_ITERATIONS = int(os.getenv("MAX_ITERATIONS", 10))
+MAX_REPAIR_SECONDS = float(os.getenv("MAX_REPAIR_SECONDS", 0))
+MAX_REPAIR_TOKENS = int(os.getenv("MAX_REPAIR_TOKENS", 0))
+# Rounds without fewer failing tests before giving up, 0 never gives up
+CONVERGENCE_PATIENCE = int(os.getenv("CONVERGENCE_PATIENCE", 3))
+
+# Why a repair session stopped
+PASSED = "passed"
+MAX_ITERATIONS_REACHED = "max_iterations"
+TIME_BUDGET_EXCEEDED = "time_budget"
+TOKEN_BUDGET_EXCEEDED = "token_budget"
+REPEATED_STATE = "repeated_state"
+NO_PROGRESS = "no_progress"
+LLM_ERROR = "llm_error"
+
+
+def error_set(output: str, test_file: str) -> List[str]:
+    """
+    The failing tests named in a test output, or its last line (usually the
+    exception) when no test is named, e.g. for an import error.
+    """
+    names = get_backend(test_file).failed_tests(output, test_file)
+    if names:
+        return sorted(set(names))
+    lines = [line for line in output.strip().splitlines() if line.strip()]
+    return lines[-1:]
+
+
+def source_paths(imported_files: Iterable[str], importer: str) -> List[str]:
+    """
+    Paths of the modules imported by importer that are part of the project.
+    """
+    paths = []
+    for module in imported_files:
+        path = module_path(module, importer)
+        if path:
+            paths.append(path)
+    return paths
+
+
+def state_hash(paths: Iterable[str], errors: Iterable[str]) -> str:
+    """
+    Hash of the content of the files a session edits and of the errors they
+    produce. The same hash twice means the repair went round in a circle.
+    """
+    digest = hashlib.sha256()
+    for path in sorted(set(paths)):
+        digest.update(path.encode())
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                digest.update(f.read())
+    for error in sorted(errors):
+        digest.update(b"\0" + error.encode())
+    return digest.hexdigest()
+
+
+class RepairBudget:
+    """
+    Decides when a repair session should stop: on success, once it used up
+    its iterations, time or tokens, when the files and errors come back to a
+    state already seen, or when the number of failing tests stopped going
+    down for `patience` rounds.
+    """
+
+    def __init__(
+        self,
+        file: str,
+        max_iterations: int = MAX_ITERATIONS,
+        max_seconds: float = MAX_REPAIR_SECONDS,
+        max_tokens: int = MAX_REPAIR_TOKENS,
+        patience: int = CONVERGENCE_PATIENCE,
+    ):
+        self.file = file
+        self.max_iterations = max_iterations
+        self.max_seconds = max_seconds
+        self.max_tokens = max_tokens
+        self.patience = patience
+        self.start = time.monotonic()
+        self.tokens_before = telemetry.total_tokens(file)
+        self.iterations = 0
+        self.seen = set()
+        self.fewest_errors = None
+        self.stalled = 0
+        self.last_errors: List[str] = []
+
+    def tokens(self) -> int:
+        return telemetry.total_tokens(self.file) - self.tokens_before
+
+    def observe(self, paths: Iterable[str], errors: List[str], note: str = "") -> Optional[str]:
+        """
+        Record the outcome of a test run and return why the session should
+        stop, or None to send another request. note is what the next request
+        adds to the errors (e.g. why the last edits were rejected), a state
+        with a new note is not a repeat.
+        """
+        self.last_errors = errors
+        if not errors:
+            return PASSED
+
+        state = state_hash(paths, errors + [note])
+        if state in self.seen:
+            return REPEATED_STATE
+        self.seen.add(state)
+
+        if self.fewest_errors is None or len(errors) < self.fewest_errors:
+            self.fewest_errors = len(errors)
+            self.stalled = 0
+        else:
+            self.stalled += 1
+            if self.patience and self.stalled >= self.patience:
+                return NO_PROGRESS
+
+        if self.max_iterations and self.iterations >= self.max_iterations:
+            return MAX_ITERATIONS_REACHED
+        if self.max_seconds and time.monotonic() - self.start >= self.max_seconds:
+            return TIME_BUDGET_EXCEEDED
+        if self.max_tokens and self.tokens() >= self.max_tokens:
+            return TOKEN_BUDGET_EXCEEDED
+        self.iterations += 1
+        return None
+
+    def report(self, reason: str) -> Dict:
+        return {
+            "file": self.file,
+            "reason": reason,
+            "iterations": self.iterations,
+            "seconds": round(time.monotonic() - self.start, 2),
+            "tokens": self.tokens(),
+            "remaining_errors": self.last_errors,
+        }
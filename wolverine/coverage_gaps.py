@@ -0,0 +1,160 @@
+import ast
+import importlib.util
+import json
+import os
+import tempfile
+from typing import Dict, List
+
+from . import telemetry
+from .failed_tests import definition_span, index_tests
+from .inprocess import run_tests_in_process
+
+# Line and branch coverage (percent) at which no more tests are requested, 0 disables it
+COVERAGE_TARGET = float(os.getenv("COVERAGE_TARGET", 0))
+
+# Follow-up requests per module at most, whatever coverage they reach
+COVERAGE_ROUNDS = int(os.getenv("COVERAGE_ROUNDS", 3))
+
+
+def coverage_available() -> bool:
+    return importlib.util.find_spec("coverage") is not None
+
+
+def measure_coverage(source_file: str, test_file: str) -> Dict:
+    """
+    Run test_file with pytest in this process and return the line and branch
+    coverage of source_file: the percentage, the lines never run and the
+    branches never taken, as (line, destination) pairs where a negative
+    destination leaves the function.
+    """
+    import coverage
+
+    source_path = os.path.abspath(source_file)
+    cov = coverage.Coverage(data_file=None, branch=True, include=[source_path])
+    with telemetry.span("subprocess", mode="coverage") as run_span:
+        cov.start()
+        try:
+            results = run_tests_in_process(test_file)
+        finally:
+            cov.stop()
+        run_span["tests"] = len(results)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        report_path = os.path.join(workdir, "coverage.json")
+        try:
+            cov.json_report(outfile=report_path)
+        except coverage.CoverageException:
+            # the tests never imported it
+            _, statements, _, missing, _ = cov.analysis2(source_path)
+            return {"percent": 0.0 if statements else 100.0, "missing_lines": missing, "missing_branches": []}
+        with open(report_path, "r") as f:
+            report = json.load(f)
+    data = next(iter(report["files"].values()))
+    return {
+        "percent": data["summary"]["percent_covered"],
+        "missing_lines": data["missing_lines"],
+        "missing_branches": [tuple(branch) for branch in data["missing_branches"]],
+    }
+
+
+def uncovered_functions(source: str, missing_lines: List[int], missing_branches: List) -> List[Dict]:
+    """
+    The functions and methods of source with lines that never ran or
+    branches never taken, keyed "Class.method" for methods. Code outside
+    functions runs on import and is left out.
+    """
+    tree = ast.parse(source)
+    functions = (ast.FunctionDef, ast.AsyncFunctionDef)
+    gaps = []
+
+    def visit(body, prefix=""):
+        for node in body:
+            if isinstance(node, ast.ClassDef):
+                visit(node.body, f"{prefix}{node.name}.")
+            elif isinstance(node, functions):
+                start, end = definition_span(node)
+                lines = [line for line in missing_lines if start <= line <= end]
+                branches = [branch for branch in missing_branches if start <= branch[0] <= end]
+                if lines or branches:
+                    gaps.append(
+                        {
+                            "name": prefix + node.name,
+                            "span": (start, end),
+                            "missing_lines": lines,
+                            "missing_branches": branches,
+                        }
+                    )
+
+    visit(tree.body)
+    return gaps
+
+
+def format_gaps(source: str, gaps: List[Dict]) -> str:
+    """
+    The source of the uncovered functions with their line numbers, each line
+    that never ran or whose branch was never taken marked with a comment.
+    """
+    lines = source.splitlines()
+    blocks = []
+    for gap in gaps:
+        notes = {line: ["never runs"] for line in gap["missing_lines"]}
+        for line, destination in gap["missing_branches"]:
+            where = "out of the function" if destination < 0 else f"to line {destination}"
+            notes.setdefault(line, []).append(f"never jumps {where}")
+        start, end = gap["span"]
+        block = []
+        for number in range(start, end + 1):
+            text = f"{number}: {lines[number - 1]}"
+            if number in notes:
+                text += f"  # {', '.join(notes[number])}"
+            block.append(text)
+        blocks.append("\n".join(block))
+    return "\n...\n".join(blocks)
+
+
+def existing_tests(test_script: str) -> List[str]:
+    try:
+        return list(index_tests(test_script))
+    except SyntaxError:
+        return []
+
+
+def _is_main_guard(node: ast.AST) -> bool:
+    # if __name__ == "__main__":
+    return (
+        isinstance(node, ast.If)
+        and isinstance(node.test, ast.Compare)
+        and isinstance(node.test.left, ast.Name)
+        and node.test.left.id == "__name__"
+    )
+
+
+def append_tests(test_script: str, new_tests: str) -> str:
+    """
+    test_script with new_tests added at the end, or before its
+    'if __name__ == "__main__":' block, which would run the tests before the
+    new ones are defined.
+    """
+    lines = test_script.rstrip("\n").split("\n")
+    guard = next((node for node in ast.parse(test_script).body if _is_main_guard(node)), None)
+    insert_at = guard.lineno - 1 if guard is not None else len(lines)
+    before, after = lines[:insert_at], lines[insert_at:]
+    while before and not before[-1].strip():
+        before.pop()
+    added = ["", ""] + new_tests.strip("\n").split("\n") + (["", ""] if after else [])
+    return "\n".join(before + added + after) + "\n"
+
+
+def print_coverage_summary(results: List[Dict]):
+    if not results:
+        return
+    print("\n===== Coverage =====")
+    for result in results:
+        line = (
+            f"{result['source']}: {result['before']:.0f}% -> {result['after']:.0f}% "
+            f"({result['rounds']} follow-up request(s), {result['added']} test(s) added)"
+        )
+        if result["stop"]:
+            line += f", {result['stop']}"
+        print(line)
+    print("====================")
@@ -0,0 +1,157 @@
+import ast
+import os
+import re
+from typing import Dict, List, Optional, Tuple
+
+# Methods run around every test of a unittest.TestCase
+SETUP_METHODS = {"setUp", "setUpClass", "asyncSetUp", "tearDown", "tearDownClass"}
+
+# "FAIL: test_divide (calculator_test.TestCalculator.test_divide)"
+UNITTEST_FAILURE = re.compile(r"^(?:FAIL|ERROR): (\w+) \(([\w.]+)\)", re.MULTILINE)
+# "tests/unit/calculator_test.py::TestCalculator::test_divide"
+PYTEST_NODE_ID = re.compile(r"[\w./\\-]+\.py::(\w+)(?:::(\w+))?")
+# 'File "tests/unit/calculator_test.py", line 59, in test_divide'
+TRACEBACK_FRAME = re.compile(r'File "([^"]+)", line \d+, in (\w+)')
+
+
+def definition_span(node: ast.AST) -> Tuple[int, int]:
+    """
+    First and last line of a definition, decorators included.
+    """
+    start = min([node.lineno] + [d.lineno for d in getattr(node, "decorator_list", [])])
+    return start, node.end_lineno
+
+
+def _is_fixture(node: ast.AST) -> bool:
+    for decorator in node.decorator_list:
+        target = decorator.func if isinstance(decorator, ast.Call) else decorator
+        name = target.attr if isinstance(target, ast.Attribute) else getattr(target, "id", "")
+        if name == "fixture":
+            return True
+    return False
+
+
+def index_tests(source: str) -> Dict:
+    """
+    Map each test of a test file to the lines it spans.
+    Tests are keyed "Class.test_name" for methods and "test_name" for
+    functions. Each entry also lists the spans of its class header and setUp
+    methods and of the pytest fixtures it takes as arguments.
+    """
+    tree = ast.parse(source)
+    functions = (ast.FunctionDef, ast.AsyncFunctionDef)
+    fixtures = {
+        node.name: definition_span(node)
+        for node in tree.body
+        if isinstance(node, functions) and _is_fixture(node)
+    }
+
+    def entry(node, class_node=None):
+        context = []
+        if class_node is not None:
+            context.append((class_node.lineno, class_node.lineno))
+            context.extend(
+                definition_span(m)
+                for m in class_node.body
+                if isinstance(m, functions) and m.name in SETUP_METHODS
+            )
+        arguments = [arg.arg for arg in node.args.args]
+        context.extend(fixtures[arg] for arg in arguments if arg in fixtures)
+        return {
+            "class": class_node.name if class_node is not None else None,
+            "span": definition_span(node),
+            "context": context,
+        }
+
+    tests = {}
+    for node in tree.body:
+        if isinstance(node, functions) and node.name.startswith("test"):
+            tests[node.name] = entry(node)
+        elif isinstance(node, ast.ClassDef):
+            for member in node.body:
+                if isinstance(member, functions) and member.name.startswith("test"):
+                    tests[f"{node.name}.{member.name}"] = entry(member, node)
+    return tests
+
+
+def failed_test_names(output: str, test_file: str) -> List[Tuple[Optional[str], str]]:
+    """
+    Pull the (class, test name) of each failing test out of unittest or pytest
+    output. Falls back to the frames of test_file in the tracebacks, and to
+    the output itself when it is a bare test name.
+    """
+    names = []
+    for name, qualifier in UNITTEST_FAILURE.findall(output):
+        parts = qualifier.split(".")
+        if parts[-1] == name:
+            parts = parts[:-1]
+        names.append((parts[-1] if parts else None, name))
+    for first, second in PYTEST_NODE_ID.findall(output):
+        names.append((first, second) if second else (None, first))
+    if not names:
+        test_basename = os.path.basename(test_file)
+        for path, function in TRACEBACK_FRAME.findall(output):
+            if os.path.basename(path) == test_basename and function != "<module>":
+                names.append((None, function))
+    if not names and re.fullmatch(r"\w+", output.strip()):
+        names.append((None, output.strip()))
+    return list(dict.fromkeys(names))
+
+
+def _lookup(tests: Dict, class_name: Optional[str], name: str) -> Optional[Dict]:
+    if class_name and f"{class_name}.{name}" in tests:
+        return tests[f"{class_name}.{name}"]
+    if name in tests:
+        return tests[name]
+    for key, test in tests.items():
+        if key.endswith(f".{name}"):
+            return test
+    return None
+
+
+def failed_test_spans(test_file: str, failed_test_case: str) -> List[Tuple[int, int]]:
+    """
+    Line spans of the failing tests of test_file and of their class header,
+    setUp methods and fixtures. Empty when the file can't be parsed or no
+    failing test is found in it.
+    """
+    with open(test_file, "r") as f:
+        source = f.read()
+    try:
+        tests = index_tests(source)
+    except SyntaxError:
+        return []
+    spans = []
+    for class_name, name in failed_test_names(failed_test_case, test_file):
+        test = _lookup(tests, class_name, name)
+        if test is not None:
+            spans.extend(test["context"])
+            spans.append(test["span"])
+    return spans
+
+
+def number_lines(lines: List[str], spans: List[Tuple[int, int]]) -> str:
+    """
+    The lines covered by spans, prefixed with their line number, with "..."
+    marking the lines left out.
+    """
+    selected = sorted({n for start, end in spans for n in range(start, end + 1)})
+    numbered = []
+    for previous, number in zip([None] + selected, selected):
+        if previous is not None and number != previous + 1:
+            numbered.append("...\n")
+        numbered.append(f"{number}: {lines[number - 1]}")
+    return "".join(numbered)
+
+
+def failed_test_source(test_file: str, failed_test_case: str) -> str:
+    """
+    Source of the failing tests of test_file, with their class header, setUp
+    methods and fixtures, numbered with the line numbers of the file.
+    The whole file is returned when it can't be parsed or no failing test is
+    found in it, e.g. for import errors.
+    """
+    with open(test_file, "r") as f:
+        lines = f.readlines()
+    spans = failed_test_spans(test_file, failed_test_case) or [(1, len(lines))]
+    return number_lines(lines, spans)
@@ -0,0 +1,107 @@
+import os
+import sys
+from typing import Dict, List, Optional
+
+from . import telemetry
+
+
+class _ResultCollector:
+    """
+    pytest plugin recording one result per test: its id, outcome, traceback
+    and duration. Collection errors (e.g. a syntax error in the test file) are
+    recorded as failures of the file itself.
+    """
+
+    def __init__(self):
+        self.results: List[Dict] = []
+
+    def pytest_runtest_logreport(self, report):
+        if report.when == "call" or report.failed or (
+            report.skipped and report.when == "setup"
+        ):
+            self.results.append(
+                {
+                    "id": report.nodeid,
+                    "outcome": report.outcome,
+                    "traceback": report.longreprtext if report.failed else "",
+                    "duration": report.duration,
+                }
+            )
+
+    def pytest_collectreport(self, report):
+        if report.failed:
+            self.results.append(
+                {
+                    "id": report.nodeid,
+                    "outcome": "failed",
+                    "traceback": report.longreprtext,
+                    "duration": 0.0,
+                }
+            )
+
+
+def _is_project_module(module) -> bool:
+    """
+    Modules loaded from the project (the tests and the code under test), as
+    opposed to the standard library, installed packages and wolverine itself.
+    """
+    path = getattr(module, "__file__", None)
+    if not path:
+        return False
+    path = os.path.abspath(path)
+    return (
+        path.startswith(os.getcwd() + os.sep)
+        and not path.startswith(os.path.dirname(__file__) + os.sep)
+        and "site-packages" not in path
+    )
+
+
+def run_tests_in_process(
+    test_file: str, test_ids: Optional[List[str]] = None
+) -> List[Dict]:
+    """
+    Run test_file (or only the given test ids of it) with pytest inside the
+    current interpreter and return the per-test results.
+    Modules imported by the run are dropped afterwards, so the next run sees
+    the edits made in between.
+    """
+    import pytest
+
+    modules_before = set(sys.modules)
+    path_before = list(sys.path)
+    collector = _ResultCollector()
+    try:
+        with telemetry.span("subprocess", mode="in_process") as run_span:
+            pytest.main(
+                [
+                    "-q",
+                    "-p",
+                    "no:cacheprovider",
+                    # keep the test ids relative to the working directory
+                    f"--rootdir={os.getcwd()}",
+                    *(test_ids or [test_file]),
+                ],
+                plugins=[collector],
+            )
+            run_span["tests"] = len(collector.results)
+            run_span["failed_tests"] = len(failed_results(collector.results))
+    finally:
+        for name in set(sys.modules) - modules_before:
+            if _is_project_module(sys.modules[name]):
+                del sys.modules[name]
+        sys.path[:] = path_before
+    return collector.results
+
+
+def failed_results(results: List[Dict]) -> List[Dict]:
+    return [result for result in results if result["outcome"] == "failed"]
+
+
+def format_failures(failures: List[Dict]) -> str:
+    """
+    Error message sent to the model: the traceback of each failing test.
+    """
+    return "\n\n".join(
+        f"{failure['id']} ({failure['duration']:.3f}s)\n{failure['traceback']}"
+        for failure in failures
+    )
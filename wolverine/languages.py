@@ -0,0 +1,442 @@
+import ast
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import textwrap
+import warnings
+from abc import ABC, abstractmethod
+from functools import lru_cache
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from .failed_tests import failed_test_names
+from .validation import validate_test_script
+
+# Where the code to test lives, and where its tests are written
+SOURCE_DIR = "testfiles"
+TEST_DIR = "tests/unit"
+
+
+class GitignoreRules:
+    """
+    The patterns of the .gitignore files met while walking a tree. Each
+    pattern applies below the directory of its .gitignore, and the last
+    matching pattern decides, so "!pattern" can re-include a path.
+    """
+
+    def __init__(self, rules: Tuple = ()):
+        self.rules = rules
+
+    @staticmethod
+    def _regex(pattern: str) -> str:
+        regex = ""
+        i = 0
+        while i < len(pattern):
+            if pattern.startswith("**/", i):
+                regex += "(?:.*/)?"
+                i += 3
+            elif pattern.startswith("**", i):
+                regex += ".*"
+                i += 2
+            elif pattern[i] == "*":
+                regex += "[^/]*"
+                i += 1
+            elif pattern[i] == "?":
+                regex += "[^/]"
+                i += 1
+            elif pattern[i] == "[" and "]" in pattern[i + 1:]:
+                end = pattern.index("]", i + 1)
+                chars = pattern[i + 1:end]
+                if chars.startswith("!"):
+                    chars = "^" + chars[1:]
+                regex += "[" + chars.replace("\\", "\\\\") + "]"
+                i = end + 1
+            else:
+                regex += re.escape(pattern[i])
+                i += 1
+        return regex
+
+    def extend(self, directory: str) -> "GitignoreRules":
+        """
+        The rules with those of directory/.gitignore added, if it has one.
+        """
+        path = os.path.join(directory, ".gitignore")
+        if not os.path.isfile(path):
+            return self
+        rules = list(self.rules)
+        with open(path, "r") as f:
+            for line in f:
+                pattern = line.rstrip("\n").rstrip()
+                if not pattern or pattern.startswith("#"):
+                    continue
+                negated = pattern.startswith("!")
+                pattern = pattern[1:] if negated else pattern
+                dir_only = pattern.endswith("/")
+                pattern = pattern.rstrip("/")
+                # a slash anywhere but at the end anchors the pattern to its directory
+                anchored = "/" in pattern
+                regex = self._regex(pattern.lstrip("/"))
+                if not anchored:
+                    regex = "(?:.*/)?" + regex
+                rules.append((os.path.abspath(directory), re.compile(regex + r"\Z"), negated, dir_only))
+        return GitignoreRules(tuple(rules))
+
+    def ignored(self, path: str, is_dir: bool) -> bool:
+        path = os.path.abspath(path)
+        ignored = False
+        for base, regex, negated, dir_only in self.rules:
+            if dir_only and not is_dir:
+                continue
+            relative = os.path.relpath(path, base)
+            if relative.startswith(".."):
+                continue
+            if regex.match(relative.replace(os.sep, "/")):
+                ignored = not negated
+        return ignored
+
+
+def discover_files(root: str = SOURCE_DIR) -> Iterator[str]:
+    """
+    Yield the path, relative to root, of every file below root that a
+    language backend handles, skipping what the .gitignore files of the
+    project and of the tree exclude. Files are yielded as the tree is walked,
+    in a stable order.
+    """
+    rules = GitignoreRules().extend(os.getcwd())
+    # .gitignore files between the project root and root apply too
+    relative_root = os.path.relpath(os.path.abspath(root), os.getcwd())
+    if not relative_root.startswith(".."):
+        directory = os.getcwd()
+        for part in relative_root.split(os.sep)[:-1]:
+            directory = os.path.join(directory, part)
+            rules = rules.extend(directory)
+
+    pending = [(root, rules)]
+    while pending:
+        directory, rules = pending.pop()
+        rules = rules.extend(directory)
+        try:
+            entries = sorted(os.scandir(directory), key=lambda entry: entry.name)
+        except OSError:
+            continue
+        subdirs = []
+        for entry in entries:
+            if entry.name in (".git", "__pycache__", "node_modules"):
+                continue
+            if entry.is_dir():
+                if not rules.ignored(entry.path, True):
+                    subdirs.append(entry.path)
+            elif backend_for(entry.name) and not rules.ignored(entry.path, False):
+                yield os.path.relpath(entry.path, root)
+        pending.extend((subdir, rules) for subdir in reversed(subdirs))
+
+
+@lru_cache(maxsize=None)
+def _sources_by_stem(source_dir: str) -> Dict[str, str]:
+    stems = {}
+    for rel_path in discover_files(source_dir):
+        stem = os.path.splitext(os.path.basename(rel_path))[0]
+        path = os.path.join(source_dir, rel_path)
+        if stem in stems:
+            # imports are resolved by module name, only the first file can be found
+            warnings.warn(f"{path} has the same module name as {stems[stem]}, imports of {stem!r} resolve to the latter")
+            continue
+        stems[stem] = path
+    return stems
+
+
+@lru_cache(maxsize=None)
+def _sources_by_test_name(source_dir: str) -> Dict[str, str]:
+    sources = {}
+    for rel_path in discover_files(source_dir):
+        test_name = os.path.basename(get_backend(rel_path).test_path(rel_path))
+        sources.setdefault(test_name, rel_path)
+    return sources
+
+
+def source_name(path: str, source_dir: str = SOURCE_DIR) -> str:
+    """
+    The name a file is reported under: a source relative to source_dir, and
+    a test file as the source it tests, so that generating, running and
+    repairing the tests of a module add up. Other files keep their path.
+    """
+    relative = os.path.relpath(path, source_dir)
+    if not relative.startswith(os.pardir + os.sep) and not os.path.isabs(relative):
+        return relative
+    if is_test_file(path):
+        return _sources_by_test_name(source_dir).get(os.path.basename(path), path)
+    return path
+
+
+def invalidate_source_index():
+    """
+    Forget the sources found so far, e.g. after files were added or renamed
+    under a long running process.
+    """
+    _sources_by_stem.cache_clear()
+    _sources_by_test_name.cache_clear()
+
+
+class LanguageBackend(ABC):
+    """
+    What the pipeline needs to know about a language: which sources it
+    handles, how to ask for their tests and where to save them, how to run a
+    test file, find what it imports and read its failures.
+    """
+
+    name = ""
+    extensions: Tuple[str, ...] = ()
+    fence = ""
+
+    def handles(self, path: str) -> bool:
+        return path.endswith(self.extensions)
+
+    @abstractmethod
+    def is_test_file(self, path: str) -> bool:
+        ...
+
+    @abstractmethod
+    def test_path(self, source_name: str, test_dir: str = TEST_DIR) -> str:
+        """
+        Test file of a source, given relative to the source directory. Tests
+        of nested sources stay in test_dir, their directories joined with "__".
+        """
+
+    @abstractmethod
+    def generation_prompt(self, code_snippet: str, source_name: str) -> str:
+        ...
+
+    def coverage_prompt(self, uncovered_code: str, source_name: str, existing_tests: List[str]) -> Optional[str]:
+        """
+        Prompt asking for tests of the uncovered code only, to be appended to
+        the existing test file. None for languages without coverage-guided
+        generation.
+        """
+        return None
+
+    def check_test(self, source_name: str, source: str, test_script: str) -> List[str]:
+        """
+        Problems that make a generated test unusable, empty if it can be saved.
+        """
+        return []
+
+    def save_test(self, source_name: str, test_script: str, test_dir: str = TEST_DIR) -> str:
+        test_path = self.test_path(source_name, test_dir)
+        os.makedirs(os.path.dirname(test_path), exist_ok=True)
+        with open(test_path, "w") as f:
+            f.write(test_script)
+        return test_path
+
+    @abstractmethod
+    def run_command(self, script: str, args: List[str]) -> List[str]:
+        ...
+
+    @abstractmethod
+    def imported_modules(self, test_file: str) -> List[str]:
+        ...
+
+    @abstractmethod
+    def module_path(self, module: str, importer: str, source_dir: str = SOURCE_DIR) -> Optional[str]:
+        """
+        The project file an import of importer refers to, None for modules
+        outside the project.
+        """
+
+    @abstractmethod
+    def failed_tests(self, output: str, test_file: str) -> List[str]:
+        ...
+
+    @staticmethod
+    def _flat_name(source_name: str) -> str:
+        return os.path.splitext(source_name)[0].replace(os.sep, "__").replace("/", "__")
+
+
+class PythonBackend(LanguageBackend):
+    name = "python"
+    extensions = (".py",)
+    fence = "python"
+
+    # Snippet every generated test starts with
+    preamble = """import sys
+import os
+
+# Make the project's modules importable through the cached path index
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))  # Adjust path to project root
+from project_paths import install_paths
+install_paths()
+"""
+
+    def is_test_file(self, path: str) -> bool:
+        return path.endswith("_test.py")
+
+    def test_path(self, source_name: str, test_dir: str = TEST_DIR) -> str:
+        return f"{test_dir}/{self._flat_name(source_name)}_test.py"
+
+    def generation_prompt(self, code_snippet: str, source_name: str) -> str:
+        return f"""
+    Understand the code snippet well and write unit test cases that cover all possible edge cases and scenarios in the manner below:
+     Write a comprehensive, almost exhaustive unit test script for the following code:
+    ```{code_snippet}```
+    Only return the python test script, no extra messages. Inline comments are allowed.
+    Add the below snippet at the beginning of the test script:
+    ```
+{textwrap.indent(self.preamble, "    ")}    ```
+    """
+
+    def coverage_prompt(self, uncovered_code: str, source_name: str, existing_tests: List[str]) -> str:
+        module_name = os.path.splitext(os.path.basename(source_name))[0]
+        return f"""
+    The existing unit tests of the module {module_name} leave the lines marked below untested.
+    Write additional unit test cases for these functions only, so that every marked line runs and every marked branch is taken:
+    ```{uncovered_code}```
+    The test script already has these tests, don't repeat them: {', '.join(existing_tests) or 'none'}.
+    The new tests are appended to that script, after its sys.path setup. Start with the imports they need,
+    e.g. "import unittest" and "from {module_name} import ...", and put them in new unittest.TestCase classes.
+    Only return the python code to append, no extra messages. Inline comments are allowed.
+    """
+
+    def check_test(self, source_name: str, source: str, test_script: str) -> List[str]:
+        module_name = os.path.splitext(os.path.basename(source_name))[0]
+        source_dir = os.path.join(SOURCE_DIR, os.path.dirname(source_name))
+        return validate_test_script(test_script, module_name, source, source_dir)
+
+    def run_command(self, script: str, args: List[str]) -> List[str]:
+        return [sys.executable, script, *args]
+
+    def imported_modules(self, test_file: str) -> List[str]:
+        imported_files = []
+        with open(test_file, "r") as file:
+            tree = ast.parse(file.read())
+            for node in ast.walk(tree):
+                if isinstance(node, ast.Import):
+                    for alias in node.names:
+                        imported_files.append(alias.name)
+                elif isinstance(node, ast.ImportFrom):
+                    imported_files.append(node.module)
+        return imported_files
+
+    def module_path(self, module: str, importer: str, source_dir: str = SOURCE_DIR) -> Optional[str]:
+        if not module:  # relative "from . import x"
+            return None
+        path = os.path.join(source_dir, module.replace(".", os.sep) + ".py")
+        if os.path.exists(path):
+            return path
+        # nested sources are importable by their name through the path index
+        path = _sources_by_stem(source_dir).get(module.split(".")[-1])
+        return path if path and self.handles(path) and os.path.exists(path) else None
+
+    def failed_tests(self, output: str, test_file: str) -> List[str]:
+        return [
+            f"{class_name}.{name}" if class_name else name
+            for class_name, name in failed_test_names(output, test_file)
+        ]
+
+
+class JavaScriptBackend(LanguageBackend):
+    name = "javascript"
+    extensions = (".js",)
+    fence = "javascript"
+
+    REQUIRE = re.compile(r"""(?:require\(\s*|\bfrom\s+|\bimport\s+)['"]([^'"]+)['"]""")
+    # "not ok 1 - name" in TAP output, "✖ name (1.2ms)" with the spec reporter
+    FAILURE = re.compile(r"^\s*(?:not ok \d+ - (.+?)|✖ (.+?)(?: \([\d.]+m?s\))?)\s*$", re.MULTILINE)
+
+    def is_test_file(self, path: str) -> bool:
+        return path.endswith(".test.js")
+
+    def test_path(self, source_name: str, test_dir: str = TEST_DIR) -> str:
+        return f"{test_dir}/{self._flat_name(source_name)}.test.js"
+
+    def generation_prompt(self, code_snippet: str, source_name: str) -> str:
+        module_path = "/".join(["..", "..", SOURCE_DIR, os.path.splitext(source_name)[0]])
+        return f"""
+    Understand the code snippet well and write unit test cases that cover all possible edge cases and scenarios in the manner below:
+     Write a comprehensive, almost exhaustive unit test script for the following code:
+    ```{code_snippet}```
+    Only return the javascript test script, no extra messages. Inline comments are allowed.
+    Use the built-in node:test runner and node:assert, and import the code under test with:
+    ```
+    const {{ test }} = require('node:test');
+    const assert = require('node:assert');
+    const tested = require('{module_path}');
+    ```
+    """
+
+    def check_test(self, source_name: str, source: str, test_script: str) -> List[str]:
+        node = shutil.which("node")
+        if node is None:
+            return []
+        with tempfile.NamedTemporaryFile("w", suffix=".js", delete=False) as f:
+            f.write(test_script)
+        try:
+            result = subprocess.run([node, "--check", f.name], capture_output=True, text=True)
+        finally:
+            os.unlink(f.name)
+        if result.returncode != 0:
+            lines = [line for line in result.stderr.splitlines() if "Error" in line]
+            return [f"Syntax error: {lines[0] if lines else result.stderr.strip()}"]
+        return []
+
+    def run_command(self, script: str, args: List[str]) -> List[str]:
+        return ["node", script, *args]
+
+    def imported_modules(self, test_file: str) -> List[str]:
+        with open(test_file, "r") as f:
+            return self.REQUIRE.findall(f.read())
+
+    def module_path(self, module: str, importer: str, source_dir: str = SOURCE_DIR) -> Optional[str]:
+        if not module.startswith("."):
+            return None  # node:test, packages from node_modules
+        path = os.path.normpath(os.path.join(os.path.dirname(importer), module))
+        for candidate in (path, path + ".js", os.path.join(path, "index.js")):
+            if os.path.isfile(candidate):
+                return os.path.relpath(candidate)
+        return None
+
+    def failed_tests(self, output: str, test_file: str) -> List[str]:
+        names = [tap or spec for tap, spec in self.FAILURE.findall(output)]
+        return sorted(set(names))
+
+
+BACKENDS: List[LanguageBackend] = [PythonBackend(), JavaScriptBackend()]
+
+
+def register_backend(backend: LanguageBackend):
+    """
+    Add a language, or replace the backend of one, ahead of the built-in ones.
+    """
+    BACKENDS[:] = [backend] + [b for b in BACKENDS if b.name != backend.name]
+    invalidate_source_index()
+
+
+def backend_for(path: str) -> Optional[LanguageBackend]:
+    for backend in BACKENDS:
+        if backend.handles(path):
+            return backend
+    return None
+
+
+def get_backend(path: str) -> LanguageBackend:
+    """
+    The backend of path, raising ValueError for unsupported files.
+    """
+    backend = backend_for(path)
+    if backend is None:
+        raise ValueError(f"No language backend handles {path}")
+    return backend
+
+
+def is_test_file(path: str) -> bool:
+    backend = backend_for(path)
+    return backend is not None and backend.is_test_file(path)
+
+
+def module_path(module: str, importer: str, source_dir: str = SOURCE_DIR) -> Optional[str]:
+    """
+    The project file an import of importer refers to, resolved by the
+    backend of importer.
+    """
+    backend = backend_for(importer)
+    return backend.module_path(module, importer, source_dir) if backend else None
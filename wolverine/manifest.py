@@ -0,0 +1,109 @@
+import hashlib
+import json
+import os
+from typing import Dict, Iterable, List, Optional
+
+from .languages import backend_for, module_path
+from .wolverine import get_imported_files
+
+# Where the hashes of the last generation run are kept
+MANIFEST_PATH = os.getenv("MANIFEST_PATH", "tests/manifest.json")
+
+
+def file_hash(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def source_dependencies(source_file: str, source_dir: str = "testfiles") -> List[str]:
+    """
+    Return the files under source_dir that source_file imports, directly or
+    through another module of source_dir.
+    """
+    if backend_for(source_file) is None:
+        return []
+    seen = set()
+    pending = [source_file]
+    while pending:
+        current = pending.pop()
+        try:
+            modules = get_imported_files(current)
+        except SyntaxError:
+            continue
+        for module in modules:
+            path = module_path(module, current, source_dir)
+            if path and path != source_file and path not in seen:
+                seen.add(path)
+                pending.append(path)
+    return sorted(seen)
+
+
+class Manifest:
+    """
+    Record of the source, dependency and test hashes each test file was
+    generated from, used to regenerate only the modules that changed.
+    """
+
+    def __init__(self, path: str = MANIFEST_PATH, source_dir: str = "testfiles"):
+        self.path = path
+        self.source_dir = source_dir
+        self.entries: Dict[str, Dict] = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.entries = json.load(f)
+
+    def _hashes(self, file_name: str) -> Dict:
+        source_file = os.path.join(self.source_dir, file_name)
+        return {
+            "source": file_hash(source_file),
+            "dependencies": {
+                dep: file_hash(dep) for dep in source_dependencies(source_file, self.source_dir)
+            },
+        }
+
+    def is_stale(self, file_name: str, test_file: str) -> bool:
+        """
+        A test is stale when it is missing or when its source or one of the
+        source's dependencies changed since it was generated. Tests that
+        predate the manifest are adopted as they are.
+        """
+        if not os.path.exists(test_file):
+            return True
+        entry = self.entries.get(file_name)
+        if entry is None:
+            return False
+        current = self._hashes(file_name)
+        return (
+            entry["source"] != current["source"]
+            or entry["dependencies"] != current["dependencies"]
+        )
+
+    def record(self, file_name: str, test_file: str):
+        entry = self._hashes(file_name)
+        entry["test_file"] = test_file
+        entry["test"] = file_hash(test_file) if os.path.exists(test_file) else None
+        self.entries[file_name] = entry
+
+    def refresh(self, file_names: Optional[Iterable[str]] = None):
+        """
+        Re-hash the entries of file_names (every entry when None) after the
+        tests were run. wolverine may have edited both the tests and the
+        sources, and the result is what the next run should compare against.
+        Only pass the modules whose tests are current: a module whose
+        regeneration failed must keep its old hashes to stay stale.
+        """
+        names = self.entries if file_names is None else set(file_names)
+        for file_name, entry in list(self.entries.items()):
+            if file_name in names and os.path.exists(os.path.join(self.source_dir, file_name)):
+                self.record(file_name, entry["test_file"])
+
+    def prune(self, file_names: List[str]):
+        """Forget the sources that no longer exist."""
+        for name in list(self.entries):
+            if name not in file_names:
+                del self.entries[name]
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "w") as f:
+            json.dump(self.entries, f, indent=2, sort_keys=True)
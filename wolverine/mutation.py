@@ -0,0 +1,399 @@
+import ast
+import importlib.util
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from . import telemetry
+from .languages import SOURCE_DIR, TEST_DIR, discover_files, get_backend, is_test_file, source_name
+from .parallel import files_for_test
+
+# Number of mutants run at the same time, 0 uses one per CPU core
+MUTATION_WORKERS = int(os.getenv("MUTATION_WORKERS", 0))
+
+# Seconds a mutant's tests may run before it counts as detected (e.g. an endless loop)
+MUTATION_TIMEOUT = float(os.getenv("MUTATION_TIMEOUT", 60))
+
+# Where the mutation scores are written
+MUTATION_REPORT = os.getenv("MUTATION_REPORT", "mutation_report.json")
+
+# Outcomes of a mutant
+KILLED = "killed"
+SURVIVED = "survived"
+TIMEOUT = "timeout"
+NO_COVERAGE = "no_coverage"
+
+BINARY_SWAPS = {
+    ast.Add: ("+", "-"),
+    ast.Sub: ("-", "+"),
+    ast.Mult: ("*", "/"),
+    ast.Div: ("/", "*"),
+    ast.FloorDiv: ("//", "/"),
+    ast.Mod: ("%", "//"),
+    ast.Pow: ("**", "*"),
+}
+
+COMPARE_SWAPS = {
+    ast.Eq: ("==", "!="),
+    ast.NotEq: ("!=", "=="),
+    ast.Lt: ("<", "<="),
+    ast.LtE: ("<=", "<"),
+    ast.Gt: (">", ">="),
+    ast.GtE: (">=", ">"),
+    ast.Is: ("is", "is not"),
+    ast.IsNot: ("is not", "is"),
+    ast.In: ("in", "not in"),
+    ast.NotIn: ("not in", "in"),
+}
+
+BOOLEAN_SWAPS = {ast.And: ("and", "or"), ast.Or: ("or", "and")}
+
+
+def _docstrings(tree: ast.AST) -> set:
+    nodes = set()
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Module, ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)):
+            body = node.body
+            if body and isinstance(body[0], ast.Expr) and isinstance(body[0].value, ast.Constant):
+                nodes.add(id(body[0].value))
+    return nodes
+
+
+def _between(left: ast.AST, right: ast.AST) -> Tuple[Tuple[int, int], Tuple[int, int]]:
+    # the text between two operands holds the operator, and maybe parentheses
+    return (left.end_lineno, left.end_col_offset), (right.lineno, right.col_offset)
+
+
+def find_mutations(source: str) -> List[Dict]:
+    """
+    The mutants of a Python source: operators swapped, numbers changed,
+    booleans flipped, strings emptied and negations dropped. Each mutant
+    replaces one span of the source, given as (line, column) positions in
+    the way ast reports them, with new text.
+    """
+    tree = ast.parse(source)
+    docstrings = _docstrings(tree)
+    in_fstring = {
+        id(value) for node in ast.walk(tree) if isinstance(node, ast.JoinedStr) for value in node.values
+    }
+    mutations = []
+
+    def add(start, end, old, new, node, description):
+        mutations.append(
+            {"line": node.lineno, "start": start, "end": end, "old": old, "new": new, "description": description}
+        )
+
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.BinOp, ast.AugAssign)) and type(node.op) in BINARY_SWAPS:
+            old, new = BINARY_SWAPS[type(node.op)]
+            left, right = (node.left, node.right) if isinstance(node, ast.BinOp) else (node.target, node.value)
+            start, end = _between(left, right)
+            add(start, end, old, new, node, f"{old} -> {new}")
+        elif isinstance(node, ast.Compare):
+            operands = [node.left] + node.comparators
+            for index, op in enumerate(node.ops):
+                if type(op) in COMPARE_SWAPS:
+                    old, new = COMPARE_SWAPS[type(op)]
+                    start, end = _between(operands[index], operands[index + 1])
+                    add(start, end, old, new, node, f"{old} -> {new}")
+        elif isinstance(node, ast.BoolOp):
+            old, new = BOOLEAN_SWAPS[type(node.op)]
+            start, end = _between(node.values[0], node.values[1])
+            add(start, end, old, new, node, f"{old} -> {new}")
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.Not, ast.USub)):
+            start = (node.lineno, node.col_offset)
+            end = (node.operand.lineno, node.operand.col_offset)
+            old = "not" if isinstance(node.op, ast.Not) else "-"
+            add(start, end, None, "", node, f"{old} removed")
+        elif isinstance(node, ast.Constant) and id(node) not in docstrings and id(node) not in in_fstring:
+            start, end = (node.lineno, node.col_offset), (node.end_lineno, node.end_col_offset)
+            value = node.value
+            if isinstance(value, bool):
+                add(start, end, None, repr(not value), node, f"{value} -> {not value}")
+            elif isinstance(value, (int, float)):
+                add(start, end, None, repr(value + 1), node, f"{value!r} -> {value + 1!r}")
+            elif isinstance(value, str) and value:
+                add(start, end, None, '""', node, f"{value[:20]!r} -> ''")
+    mutations.sort(key=lambda mutation: (mutation["start"], mutation["description"]))
+    return mutations
+
+
+def mutant_source(source: str, mutation: Dict) -> Optional[str]:
+    """
+    The source with the mutation applied, None if the result doesn't parse
+    or doesn't change the code (e.g. the operator sat in a comment).
+    """
+    # ast columns are utf-8 byte offsets
+    lines = source.encode("utf-8").splitlines(keepends=True)
+    offsets = [0]
+    for line in lines:
+        offsets.append(offsets[-1] + len(line))
+    data = source.encode("utf-8")
+    start = offsets[mutation["start"][0] - 1] + mutation["start"][1]
+    end = offsets[mutation["end"][0] - 1] + mutation["end"][1]
+    segment = data[start:end].decode("utf-8")
+    if mutation["old"] is None:
+        replaced = mutation["new"]
+    else:
+        if mutation["old"] not in segment:
+            return None
+        replaced = segment.replace(mutation["old"], mutation["new"], 1)
+    mutated = (data[:start] + replaced.encode("utf-8") + data[end:]).decode("utf-8")
+    try:
+        if ast.dump(ast.parse(mutated)) == ast.dump(ast.parse(source)):
+            return None
+    except SyntaxError:
+        return None
+    return mutated
+
+
+def tests_by_module(source_dir: str = SOURCE_DIR, test_dir: str = TEST_DIR) -> Dict[str, List[str]]:
+    """
+    Map each Python module of source_dir to the test files that import it,
+    directly or through another module.
+    """
+    tests = {}
+    if not os.path.isdir(test_dir):
+        return tests
+    for rel_path in discover_files(test_dir):
+        test_file = os.path.join(test_dir, rel_path)
+        if not is_test_file(test_file) or not test_file.endswith(".py"):
+            continue
+        for path in files_for_test(test_file, source_dir)[1:]:
+            if os.path.normpath(path).startswith(os.path.normpath(source_dir) + os.sep):
+                tests.setdefault(os.path.normpath(path), []).append(test_file)
+    return tests
+
+
+def _workdir(files: List[str], root: str) -> str:
+    workdir = tempfile.mkdtemp(prefix="wolverine-mutant-")
+    for rel_path in files:
+        target = os.path.join(workdir, rel_path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copy2(os.path.join(root, rel_path), target)
+    return workdir
+
+
+def _pytest_command(
+    args: List[str], coverage_file: Optional[str] = None, first_failure: bool = True
+) -> List[str]:
+    command = [sys.executable]
+    if coverage_file:
+        # record which test executed each line
+        rcfile = coverage_file + ".rc"
+        with open(rcfile, "w") as f:
+            f.write("[run]\ndynamic_context = test_function\n")
+        command += ["-m", "coverage", "run", f"--rcfile={rcfile}", f"--data-file={coverage_file}"]
+    # a mutant is detected by its first failing test, no need to run the others
+    stop = ["-x"] if first_failure else []
+    return command + ["-m", "pytest", "-q", *stop, "-p", "no:cacheprovider", *args]
+
+
+def _run(command: List[str], cwd: str, timeout: Optional[float] = None) -> subprocess.CompletedProcess:
+    env = dict(os.environ)
+    # mutants often keep the size of the file, stale bytecode would hide them
+    env["PYTHONDONTWRITEBYTECODE"] = "1"
+    return subprocess.run(
+        command, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, timeout=timeout
+    )
+
+
+def baseline(module: str, test_files: List[str], root: str = ".") -> Dict:
+    """
+    Run the tests of module on the unmutated code. Returns the test files
+    that can run, the tests that fail already, which can't tell mutants
+    apart, and, when coverage is installed, the tests that executed each line
+    of module. A line run while importing (module level code) maps to None:
+    every test depends on it.
+    """
+    use_coverage = importlib.util.find_spec("coverage") is not None
+    usable, failing = [], {}
+    lines = {} if use_coverage else None
+    for test_file in test_files:
+        workdir = _workdir(files_for_test(test_file), root)
+        coverage_file = os.path.join(workdir, ".mutation_coverage") if use_coverage else None
+        try:
+            result = _run(_pytest_command([test_file], coverage_file, first_failure=False), workdir)
+            # 0: passed, 1: some tests failed, anything else: the file can't run
+            if result.returncode not in (0, 1):
+                print(f"Skipping {test_file}: it doesn't run on the original code.")
+                continue
+            usable.append(test_file)
+            failing[test_file] = set(get_backend(test_file).failed_tests(result.stdout, test_file))
+            if use_coverage:
+                _read_coverage(coverage_file, os.path.join(workdir, module), test_file, lines)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return {"test_files": usable, "failing": failing, "lines": lines}
+
+
+def _read_coverage(coverage_file: str, measured: str, test_file: str, lines: Dict):
+    from coverage import CoverageData
+
+    if not os.path.exists(coverage_file):
+        return
+    data = CoverageData(basename=coverage_file)
+    data.read()
+    measured = os.path.realpath(measured)
+    stem = os.path.splitext(os.path.basename(test_file))[0]
+    for path in data.measured_files():
+        if os.path.realpath(path) != measured:
+            continue
+        for line, contexts in data.contexts_by_lineno(path).items():
+            for context in contexts:
+                # "calculator_test.TestCalculator.test_add" -> "TestCalculator.test_add"
+                parts = context.split(".")
+                if stem not in parts:
+                    lines[line] = None
+                    continue
+                if lines.get(line, set()) is not None:
+                    lines.setdefault(line, set()).add((test_file, ".".join(parts[parts.index(stem) + 1:])))
+
+
+def select_tests(line: int, test_files: List[str], covered: Optional[Dict], failing: Dict) -> List[str]:
+    """
+    The pytest ids of the tests to run against a mutant of line: the passing
+    tests that executed it, or every test file when there is no coverage data.
+    """
+    if covered is None or covered.get(line, set()) is None:
+        ids = []
+        for test_file in test_files:
+            if not failing.get(test_file):
+                ids.append(test_file)
+            else:
+                ids.extend(
+                    f"{test_file}::{name.replace('.', '::')}"
+                    for name in _test_names(test_file)
+                    if name not in failing[test_file]
+                )
+        return ids
+    return sorted(
+        f"{test_file}::{name.replace('.', '::')}"
+        for test_file, name in covered.get(line, set())
+        if name and name not in failing.get(test_file, set())
+    )
+
+
+def _test_names(test_file: str) -> List[str]:
+    from .failed_tests import index_tests
+
+    with open(test_file, "r") as f:
+        return list(index_tests(f.read()))
+
+
+def run_mutant(module: str, source: str, mutation: Dict, test_ids: List[str], files: List[str], root: str = ".") -> Dict:
+    """
+    Run the selected tests against one mutant, in a copy of the files they need.
+    """
+    result = {"line": mutation["line"], "description": mutation["description"], "tests": len(test_ids)}
+    if not test_ids:
+        result["outcome"] = NO_COVERAGE
+        return result
+    workdir = _workdir(files, root)
+    try:
+        with open(os.path.join(workdir, module), "w") as f:
+            f.write(mutant_source(source, mutation))
+        try:
+            run = _run(_pytest_command(test_ids), workdir, MUTATION_TIMEOUT)
+            result["outcome"] = SURVIVED if run.returncode == 0 else KILLED
+        except subprocess.TimeoutExpired:
+            result["outcome"] = TIMEOUT
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+def mutation_test_module(module: str, test_files: List[str], workers: int, root: str = ".") -> Dict:
+    with open(os.path.join(root, module), "r") as f:
+        source = f.read()
+    mutations = [m for m in find_mutations(source) if mutant_source(source, m) is not None]
+    with telemetry.span("mutation", source_name(module), mutants=len(mutations)) as mutation_span:
+        base = baseline(module, test_files, root)
+        test_files = base["test_files"]
+        files = []
+        for test_file in test_files:
+            files.extend(path for path in files_for_test(test_file) if path not in files)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(
+                executor.map(
+                    lambda mutation: run_mutant(
+                        module,
+                        source,
+                        mutation,
+                        select_tests(mutation["line"], test_files, base["lines"], base["failing"]),
+                        files,
+                        root,
+                    ),
+                    mutations,
+                )
+            )
+        counts = {outcome: 0 for outcome in (KILLED, SURVIVED, TIMEOUT, NO_COVERAGE)}
+        for result in results:
+            counts[result["outcome"]] += 1
+        detected = counts[KILLED] + counts[TIMEOUT]
+        score = 100.0 * detected / len(results) if results else None
+        mutation_span.update(killed=detected, score=score)
+    return {
+        "module": module,
+        "tests": test_files,
+        "coverage": base["lines"] is not None,
+        "mutants": len(results),
+        **counts,
+        "score": score,
+        "tests_run": sum(result["tests"] for result in results),
+        "survivors": [r for r in results if r["outcome"] in (SURVIVED, NO_COVERAGE)],
+    }
+
+
+def print_scores(reports: List[Dict]):
+    print("\n===== Mutation scores =====")
+    for report in reports:
+        if report["score"] is None:
+            print(f"{report['module']}: no mutants")
+            continue
+        print(
+            f"{report['module']}: {report['score']:.0f}% "
+            f"({report['killed'] + report['timeout']}/{report['mutants']} mutants detected, "
+            f"{report['no_coverage']} not covered)"
+        )
+        for survivor in report["survivors"]:
+            note = " (no test runs it)" if survivor["outcome"] == NO_COVERAGE else ""
+            print(f"  line {survivor['line']}: {survivor['description']} survived{note}")
+    print("===========================")
+
+
+def run_mutation_testing(
+    *modules, source_dir=SOURCE_DIR, test_dir=TEST_DIR, workers=MUTATION_WORKERS, report=MUTATION_REPORT
+) -> List[Dict]:
+    """
+    Measure how many mutants of each module of source_dir (or of the given
+    modules) its tests detect. A mutant counts as detected when one of the
+    tests that execute the mutated line fails or times out.
+    """
+    workers = workers or os.cpu_count() or 1
+    tests = tests_by_module(source_dir, test_dir)
+    wanted = [os.path.normpath(module) for module in modules] or sorted(tests)
+    reports = []
+    for module in wanted:
+        if module not in tests:
+            print(f"Skipping {module}: no test imports it.")
+            continue
+        print(f"Mutation testing {module} against {', '.join(tests[module])}")
+        reports.append(mutation_test_module(module, tests[module], workers))
+    print_scores(reports)
+    with open(report, "w") as f:
+        json.dump(reports, f, indent=2)
+    print(f"Mutation report saved as {report}")
+    return reports
+
+
+if __name__ == "__main__":
+    import fire
+
+    # the scores are printed already, not the returned reports
+    fire.Fire(run_mutation_testing, serialize=lambda reports: None)
@@ -0,0 +1,178 @@
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional
+
+from . import telemetry
+from .languages import module_path, source_name
+from .manifest import source_dependencies
+from .wolverine import get_imported_files
+
+# Number of test files repaired at the same time, 0 uses one per CPU core
+TEST_WORKERS = int(os.getenv("TEST_WORKERS", 0))
+
+# The conflict check and the copy of merge_back must not interleave between threads
+_merge_lock = threading.Lock()
+
+
+def _hash(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _snapshot(workdir: str) -> Dict[str, str]:
+    """
+    Map every file of workdir (relative path) to its hash.
+    """
+    hashes = {}
+    for dirpath, dirnames, filenames in os.walk(workdir):
+        dirnames[:] = [d for d in dirnames if d != "__pycache__"]
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            hashes[os.path.relpath(path, workdir)] = _hash(path)
+    return hashes
+
+
+def files_for_test(test_file: str, source_dir: str = "testfiles") -> List[str]:
+    """
+    The test file and the source files it needs, relative to the project root.
+    """
+    files = [test_file]
+    for module in get_imported_files(test_file):
+        path = module_path(module, test_file, source_dir)
+        if module == "project_paths":
+            # the path index helper of the generated tests lives at the root
+            path = "project_paths.py"
+        if path and os.path.exists(path) and path not in files:
+            files.append(path)
+            files.extend(
+                dep for dep in source_dependencies(path, source_dir) if dep not in files
+            )
+    return files
+
+
+def prepare_workdir(test_file: str, root: str = ".") -> str:
+    """
+    Copy the test file and the sources it imports into a fresh directory, so
+    that the edits made while repairing it don't touch the shared tree.
+    """
+    workdir = tempfile.mkdtemp(prefix="wolverine-")
+    for rel_path in files_for_test(test_file):
+        target = os.path.join(workdir, rel_path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copy2(os.path.join(root, rel_path), target)
+    return workdir
+
+
+def run_isolated(test_file: str, root: str = ".") -> Dict:
+    """
+    Run "python -m wolverine test_file" inside its own working copy.
+    """
+    root = os.path.abspath(root)
+    workdir = prepare_workdir(test_file, root)
+    snapshot = _snapshot(workdir)
+
+    env = dict(os.environ)
+    # the package and the shared cache stay in the real project
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [package_root, env.get("PYTHONPATH")]))
+    env.setdefault("LLM_CACHE_PATH", os.path.join(root, ".llm_cache.sqlite3"))
+
+    start = time.monotonic()
+    with telemetry.span("subprocess", source_name(test_file), stage="wolverine") as run_span:
+        result = subprocess.run(
+            [sys.executable, "-m", "wolverine", test_file],
+            cwd=workdir,
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+        )
+        run_span["failed"] = result.returncode != 0
+    return {
+        "test_file": test_file,
+        "returncode": result.returncode,
+        "output": result.stdout,
+        "duration": time.monotonic() - start,
+        "workdir": workdir,
+        "snapshot": snapshot,
+    }
+
+
+def merge_back(result: Dict, root: str = ".") -> Dict:
+    """
+    Copy the sources and tests changed in a working copy back into the
+    project. A file that was already changed by another worker is left alone
+    and reported as a conflict. Files the run created (backups, the patch
+    history, the path index) stay in the working copy. Safe to call from
+    several threads, the merges run one at a time.
+    """
+    workdir = result["workdir"]
+    snapshot = result["snapshot"]
+    merged, conflicts = [], []
+    changes = _snapshot(workdir).items()
+    with _merge_lock:
+        for rel_path, new_hash in changes:
+            old_hash = snapshot.get(rel_path)
+            # only the copied files are merged, edited ones must be untouched upstream
+            if old_hash is None or new_hash == old_hash:
+                continue
+            target = os.path.join(root, rel_path)
+            current_hash = _hash(target) if os.path.exists(target) else None
+            if current_hash != old_hash:
+                conflicts.append(rel_path)
+                continue
+            os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+            shutil.copy2(os.path.join(workdir, rel_path), target)
+            merged.append(rel_path)
+    shutil.rmtree(workdir, ignore_errors=True)
+    result["merged"] = merged
+    result["conflicts"] = conflicts
+    return result
+
+
+def run_tests_parallel(
+    test_files: List[str], workers: Optional[int] = None, root: str = "."
+) -> List[Dict]:
+    """
+    Run wolverine on several test files at once, each in an isolated working
+    copy, and merge the edits back as the runs finish. Results are returned in
+    the order of test_files.
+    """
+    workers = workers or TEST_WORKERS or os.cpu_count() or 1
+    results = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(run_isolated, test_file, root): test_file
+            for test_file in test_files
+        }
+        for future in as_completed(futures):
+            result = merge_back(future.result(), root)
+            print(f"===== {result['test_file']} =====")
+            print(result["output"])
+            results[result["test_file"]] = result
+    return [results[test_file] for test_file in test_files]
+
+
+def print_summary(results: List[Dict]):
+    print("\n===== Test run summary =====")
+    for result in results:
+        status = "passed" if result["returncode"] == 0 else "failed"
+        if result.get("error"):
+            print(f"{result['test_file']}: {status}, {result['error']}")
+            continue
+        line = f"{result['test_file']}: {status} in {result['duration']:.1f}s"
+        if result["merged"]:
+            line += f", updated {', '.join(result['merged'])}"
+        if result["conflicts"]:
+            line += f", conflicts in {', '.join(result['conflicts'])}"
+        print(line)
+    passed = sum(1 for result in results if result["returncode"] == 0)
+    print(f"{passed}/{len(results)} test files passed")
+    print("============================")
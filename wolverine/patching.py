@@ -0,0 +1,208 @@
+import ast
+import os
+import shutil
+import tempfile
+from typing import Dict, List, Optional, Tuple
+
+# Number of repair iterations whose snapshots are kept, on top of the originals
+PATCH_HISTORY = int(os.getenv("PATCH_HISTORY", 10))
+PATCH_HISTORY_DIR = os.getenv("PATCH_HISTORY_DIR", ".wolverine_history")
+
+ORIGINAL = "original"
+
+
+class PatchError(ValueError):
+    """
+    Raised when edits name a missing file or line or would leave a file that
+    doesn't parse, or when a revert asks for an iteration that is not in the
+    history.
+    """
+
+
+def atomic_write(path: str, lines: List[str]):
+    """
+    Write to a temporary file next to path, then rename it over path, so
+    readers never see a half written file.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.writelines(lines)
+        if os.path.exists(path):
+            shutil.copymode(path, temp_path)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+
+def resolve_inside(root: str, path: str) -> str:
+    """
+    The absolute path of path taken relative to root. Raises PatchError when
+    it points outside root, e.g. an absolute or "../" path from the model.
+    """
+    root = os.path.realpath(root)
+    resolved = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, resolved]) != root:
+        raise PatchError(f"{path} is outside of the project")
+    return resolved
+
+
+class PatchEngine:
+    """
+    Keeps the files edited during a repair session in memory, validates each
+    edit before it reaches the disk and keeps an undo history per iteration.
+
+    The history of a session lives in PATCH_HISTORY_DIR/<session>: "original"
+    holds every file as it was before the session first edited it, and one
+    numbered directory per iteration holds the files as they were before that
+    iteration's edits. Only the last history_size iterations are kept.
+    """
+
+    def __init__(
+        self,
+        session: str,
+        history_size: int = PATCH_HISTORY,
+        history_dir: str = PATCH_HISTORY_DIR,
+    ):
+        self.session = session
+        self.session_dir = os.path.join(
+            history_dir, os.path.normpath(session).replace(os.sep, "__")
+        )
+        self.history_size = history_size
+        self.iteration = 0
+        self._files: Dict[str, Tuple[int, List[str]]] = {}
+        self._snapshots = set()
+        # files written since pop_modified() was last called
+        self._modified = set()
+
+    def reset(self):
+        """Start a new session, dropping the history of the previous one."""
+        shutil.rmtree(self.session_dir, ignore_errors=True)
+        self.iteration = 0
+        self._snapshots.clear()
+
+    def read(self, path: str) -> List[str]:
+        """
+        Lines of path, from memory unless the file changed on disk since it
+        was last read or written. Raises PatchError if it doesn't exist.
+        """
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            raise PatchError(f"{path} doesn't exist") from None
+        cached = self._files.get(path)
+        if cached is None or cached[0] != mtime:
+            with open(path, "r") as f:
+                cached = (mtime, f.readlines())
+            self._files[path] = cached
+        return list(cached[1])
+
+    def validate(self, path: str, lines: List[str]):
+        if not path.endswith(".py"):
+            return
+        try:
+            ast.parse("".join(lines), filename=path)
+        except SyntaxError as e:
+            raise PatchError(f"{path}, line {e.lineno}: {e.msg}") from e
+
+    def commit(self, path: str, lines: List[str]):
+        """
+        Validate the new content of path, record the current one in the
+        history and write the new one atomically. Only files of the project
+        (the working directory) can be written.
+        """
+        resolve_inside(os.getcwd(), path)
+        self.validate(path, lines)
+        current = self.read(path)
+        self._snapshot(ORIGINAL, path, current)
+        self._snapshot(str(self.iteration), path, current)
+        atomic_write(path, lines)
+        self._files[path] = (os.stat(path).st_mtime_ns, list(lines))
+        self._modified.add(path)
+
+    def pop_modified(self) -> List[str]:
+        """Files written since the last call, e.g. to reload their modules."""
+        modified = sorted(self._modified)
+        self._modified.clear()
+        return modified
+
+    def _snapshot(self, label: str, path: str, lines: List[str]):
+        target = os.path.join(self.session_dir, label, os.path.relpath(path))
+        if (label, path) in self._snapshots or os.path.exists(target):
+            return
+        atomic_write(target, lines)
+        self._snapshots.add((label, path))
+        if label != ORIGINAL:
+            for old in self.iterations()[: -self.history_size]:
+                shutil.rmtree(os.path.join(self.session_dir, str(old)), ignore_errors=True)
+                with open(os.path.join(self.session_dir, "pruned"), "w") as f:
+                    f.write(str(old))
+
+    def _last_pruned(self) -> int:
+        path = os.path.join(self.session_dir, "pruned")
+        if not os.path.exists(path):
+            return 0
+        with open(path, "r") as f:
+            return int(f.read())
+
+    def has_history(self) -> bool:
+        """Whether this session edited any file that can be reverted."""
+        return os.path.isdir(self.session_dir)
+
+    def iterations(self) -> List[int]:
+        if not os.path.isdir(self.session_dir):
+            return []
+        return sorted(int(d) for d in os.listdir(self.session_dir) if d.isdigit())
+
+    def _snapshot_files(self, label: str) -> List[str]:
+        root = os.path.join(self.session_dir, label)
+        files = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            for filename in filenames:
+                files.append(os.path.relpath(os.path.join(dirpath, filename), root))
+        return files
+
+    def revert(self, iteration: Optional[int] = None) -> List[str]:
+        """
+        Restore every file of the session to its state before the given
+        iteration, or to its original state when iteration is None or 0.
+        Returns the restored paths.
+        """
+        if not iteration:
+            sources = {path: ORIGINAL for path in self._snapshot_files(ORIGINAL)}
+        else:
+            if iteration <= self._last_pruned():
+                raise PatchError(f"Iteration {iteration} is no longer in the history")
+            later = [n for n in self.iterations() if n >= iteration]
+            if not later:
+                raise PatchError(f"No edits were made in iteration {iteration} or later")
+            sources = {}
+            # a file's state before the iteration is the one saved by the
+            # first later iteration that edited it
+            for number in reversed(later):
+                for path in self._snapshot_files(str(number)):
+                    sources[path] = str(number)
+        for path, label in sources.items():
+            with open(os.path.join(self.session_dir, label, path), "r") as f:
+                atomic_write(path, f.readlines())
+        self._files.clear()
+        self._modified.update(sources)
+        return sorted(sources)
+
+
+_engine = None
+
+
+def get_engine(session: Optional[str] = None) -> PatchEngine:
+    """
+    The patch engine of the current repair session. Passing a session
+    switches to an engine for that session.
+    """
+    global _engine
+    if _engine is None or (session is not None and _engine.session != session):
+        _engine = PatchEngine(session or "default")
+    return _engine
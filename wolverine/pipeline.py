@@ -0,0 +1,88 @@
+import os
+import queue
+import threading
+from typing import Any, Callable, Iterable, List, Tuple
+
+# Items waiting between two stages, which bounds the memory of a run
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", 4))
+
+# Marks the end of a stage's input
+_DONE = object()
+
+# A stage function gets one item and an emit function to pass any number of
+# results on to the next stage
+Stage = Tuple[str, Callable[[Any, Callable[[Any], None]], None], int]
+
+
+def run_pipeline(source: Iterable, stages: List[Stage], maxsize: int = PIPELINE_QUEUE_SIZE):
+    """
+    Run the items of source through stages, given as (name, function, workers).
+    Each stage runs in its own threads and reads from a bounded queue filled by
+    the previous one, so the stages overlap and at most maxsize items wait
+    between two of them. source is only consumed as fast as the first stage
+    keeps up.
+
+    The first exception raised by a stage stops the pipeline: the remaining
+    items are dropped and the exception is raised again here.
+    """
+    queues = [queue.Queue(maxsize) for _ in stages]
+    errors = []
+    stopped = threading.Event()
+    lock = threading.Lock()
+    remaining_workers = [workers for _, _, workers in stages]
+
+    def put(index: int, item):
+        if index < len(queues):
+            queues[index].put(item)
+
+    def close(index: int):
+        # the stage's last worker tells every worker of the next stage to finish
+        if index < len(queues):
+            for _ in range(stages[index][2]):
+                queues[index].put(_DONE)
+
+    def feed():
+        try:
+            for item in source:
+                if stopped.is_set():
+                    break
+                put(0, item)
+        except BaseException as e:
+            errors.append(e)
+            stopped.set()
+        finally:
+            close(0)
+
+    def work(index: int, function: Callable):
+        emit = lambda item: put(index + 1, item)  # noqa: E731
+        while True:
+            item = queues[index].get()
+            if item is _DONE:
+                break
+            # after an error, keep reading so the stages upstream never block
+            if stopped.is_set():
+                continue
+            try:
+                function(item, emit)
+            except BaseException as e:
+                with lock:
+                    errors.append(e)
+                stopped.set()
+        with lock:
+            remaining_workers[index] -= 1
+            last = remaining_workers[index] == 0
+        if last:
+            close(index + 1)
+
+    threads = [threading.Thread(target=feed, name="pipeline-source", daemon=True)]
+    for index, (name, function, workers) in enumerate(stages):
+        threads += [
+            threading.Thread(target=work, args=(index, function), name=f"pipeline-{name}-{n}", daemon=True)
+            for n in range(workers)
+        ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
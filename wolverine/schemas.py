@@ -0,0 +1,64 @@
+from typing import Dict, List, Literal, Optional, Type, TypeVar
+
+from pydantic import BaseModel, Field, ValidationError
+
+Model = TypeVar("Model", bound=BaseModel)
+
+
+class Edit(BaseModel):
+    """
+    One line edit. Edits are applied in reverse line order, so every line
+    number refers to the file as it was sent.
+    """
+
+    operation: Literal["Replace", "Delete", "InsertAfter"]
+    line: int = Field(ge=1, description="Line number the edit applies to, the first line of the file is 1")
+    content: str = Field(
+        "",
+        description="Code that replaces the line or is inserted after it, with its indentation and "
+        "'\\n' between lines. Empty for Delete.",
+    )
+    file: Optional[str] = Field(
+        None, description="Path of the file the edit applies to, when it is not the file of the response"
+    )
+
+
+class RepairResponse(BaseModel):
+    """
+    Changes that fix the failing tests, in the test file or in the code it
+    tests.
+    """
+
+    # no length constraints: they would also reject the partial answers of a stream
+    explanations: List[str] = Field(description="Short explanations of what went wrong, at least one")
+    file: str = Field(description="Path of the file to change, e.g. testfiles/calculator.py")
+    edits: List[Edit]
+
+    def edits_by_file(self) -> Dict[str, List[Edit]]:
+        """
+        The edits grouped by the file they apply to, in the order the files
+        first appear.
+        """
+        by_file: Dict[str, List[Edit]] = {}
+        for edit in self.edits:
+            by_file.setdefault(edit.file or self.file, []).append(edit)
+        return by_file
+
+
+class GeneratedTest(BaseModel):
+    """
+    Test code written for a source file.
+    """
+
+    code: str = Field(description="The test code only, without markdown code fences or comments around it")
+
+
+def parse_cached(content: str, response_model: Type[Model]) -> Optional[Model]:
+    """
+    A cached answer validated by response_model, or None if it doesn't fit,
+    e.g. a free text answer cached before structured output.
+    """
+    try:
+        return response_model.model_validate_json(content)
+    except ValidationError:
+        return None
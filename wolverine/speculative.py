@@ -0,0 +1,147 @@
+import ast
+import os
+import shutil
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+from termcolor import cprint
+
+from . import telemetry
+from .convergence import error_set
+from .languages import get_backend
+from .parallel import prepare_workdir
+from .patching import PatchError, resolve_inside
+from .wolverine import edit_lines, json_validated_response
+from .worker import WORKER_TIMEOUT
+
+if TYPE_CHECKING:
+    from .schemas import RepairResponse
+
+# Temperature of the most adventurous candidate, the first one keeps the usual 0.1
+SPECULATIVE_MAX_TEMPERATURE = float(os.getenv("SPECULATIVE_MAX_TEMPERATURE", 1.0))
+
+
+def candidate_temperatures(count: int, max_temperature: float = SPECULATIVE_MAX_TEMPERATURE) -> List[float]:
+    """
+    count temperatures spread from 0.1 to max_temperature, so the candidates
+    differ while the first one is the answer a single request would get.
+    """
+    if count == 1:
+        return [0.1]
+    step = (max_temperature - 0.1) / (count - 1)
+    return [round(0.1 + step * index, 2) for index in range(count)]
+
+
+def evaluate_candidate(test_file: str, test_args: List, response: "RepairResponse", root: str = ".") -> Dict:
+    """
+    Apply the edits of response to a temporary copy of the test file and the
+    sources it imports, and run the test there. The shared tree is left
+    untouched.
+    """
+    workdir = prepare_workdir(test_file, root)
+    try:
+        for target, edits in response.edits_by_file().items():
+            try:
+                # the edits must stay in the copy, never reach the shared tree
+                path = resolve_inside(workdir, target)
+            except PatchError as e:
+                return {"error": str(e)}
+            if not os.path.exists(path):
+                if not os.path.exists(os.path.join(root, target)):
+                    return {"error": f"{target} doesn't exist"}
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                shutil.copy2(os.path.join(root, target), path)
+            with open(path, "r") as f:
+                lines = f.readlines()
+            try:
+                lines = edit_lines(lines, edits)
+                if target.endswith(".py"):
+                    ast.parse("".join(lines), filename=target)
+            except (PatchError, SyntaxError) as e:
+                return {"error": f"the edits of {target} can't be applied ({e})"}
+            with open(path, "w") as f:
+                f.writelines(lines)
+
+        command = get_backend(test_file).run_command(test_file, [str(arg) for arg in test_args])
+        try:
+            run = subprocess.run(
+                command,
+                cwd=workdir,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+                timeout=WORKER_TIMEOUT,
+            )
+        except subprocess.TimeoutExpired:
+            return {"passed": False, "failures": float("inf")}
+        errors = error_set(run.stdout, test_file) if run.returncode else []
+        return {
+            "passed": run.returncode == 0,
+            "failures": len(errors) or (1 if run.returncode else 0),
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def speculative_fix(
+    messages: List[Dict],
+    model: str,
+    test_file: str,
+    test_args: List,
+    count: int,
+    max_temperature: float = SPECULATIVE_MAX_TEMPERATURE,
+) -> Optional["RepairResponse"]:
+    """
+    Ask for count fixes at once, at different temperatures, and test each
+    one in its own copy as soon as it arrives. Returns the answer of the
+    first candidate whose tests pass, or else that of the candidate with the
+    fewest failing tests, or None if no candidate could be applied.
+
+    Once a candidate passes, the candidates that haven't started are
+    cancelled and the answers still arriving are not tested. A request
+    already sent can't be cancelled: it runs to completion in the background
+    and its tokens are spent, so count bounds the cost of each iteration.
+    """
+    settled = threading.Event()
+
+    def attempt(temperature: float) -> Dict:
+        response = json_validated_response(model, messages, temperature=temperature)
+        if settled.is_set():
+            return {"error": "a candidate already passed", "temperature": temperature}
+        with telemetry.span("subprocess", mode="candidate", temperature=temperature) as run_span:
+            result = evaluate_candidate(test_file, test_args, response)
+            run_span.update(failed=not result.get("passed"), failures=result.get("failures"))
+        return dict(result, response=response, temperature=temperature)
+
+    executor = ThreadPoolExecutor(max_workers=count)
+    futures = [executor.submit(attempt, t) for t in candidate_temperatures(count, max_temperature)]
+    results = []
+    try:
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                cprint(f"A candidate fix failed: {e}", "yellow")
+                continue
+            if "error" in result:
+                cprint(f"Candidate at temperature {result['temperature']} rejected: {result['error']}", "yellow")
+                continue
+            if result["passed"]:
+                cprint(f"Candidate at temperature {result['temperature']} passes the tests.", "blue")
+                return result["response"]
+            cprint(
+                f"Candidate at temperature {result['temperature']} leaves {result['failures']} failure(s).",
+                "yellow",
+            )
+            results.append(result)
+    finally:
+        # the requests in flight finish in the background without running the tests
+        settled.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+    if not results:
+        return None
+    best = min(results, key=lambda result: (result["failures"], result["temperature"]))
+    cprint(f"No candidate passes, keeping the one at temperature {best['temperature']}.", "blue")
+    return best["response"]
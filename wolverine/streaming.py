@@ -0,0 +1,80 @@
+from typing import Callable, List, Optional, Tuple, Type
+
+
+def _retryable_errors() -> Tuple[Type[BaseException], ...]:
+    """
+    Errors that mean the answer didn't fit the response model, including the
+    one instructor raises once its own retries are exhausted.
+    """
+    from pydantic import ValidationError
+
+    try:
+        from instructor.exceptions import InstructorRetryException
+    except ImportError:
+        return (ValidationError,)
+    return (ValidationError, InstructorRetryException)
+
+
+def stream_repair_response(
+    client,
+    model: str,
+    messages: List,
+    response_model,
+    on_item: Optional[Callable] = None,
+    temperature: float = 0.1,
+    max_retries: int = 1,
+):
+    """
+    Stream a repair answer as partial response_model objects, and pass each
+    edit to on_item as soon as the next one starts, i.e. once it is
+    complete. Each complete edit is validated on arrival and the stream is
+    abandoned on the first invalid one, without waiting for the rest of the
+    answer. The complete answer is validated and returned. An invalid answer
+    is sent back with the errors, like instructor does without streaming,
+    max_retries times at most.
+    """
+    from .schemas import Edit
+
+    request = list(messages)
+    for attempt in range(max(1, max_retries)):
+        partial = None
+        reported = 0
+        stream = client.chat.completions.create_partial(
+            model=model,
+            response_model=response_model,
+            messages=request,
+            temperature=temperature,
+            max_retries=1,
+        )
+        try:
+            try:
+                for partial in stream:
+                    edits = partial.edits or []
+                    # the last edit may still be arriving
+                    while reported < len(edits) - 1:
+                        edit = Edit.model_validate(edits[reported].model_dump())
+                        if on_item is not None:
+                            on_item(edit)
+                        reported += 1
+            finally:
+                # stops reading an answer that was rejected half way
+                close = getattr(stream, "close", None)
+                if close is not None:
+                    close()
+            response = response_model.model_validate(partial.model_dump() if partial is not None else {})
+        except _retryable_errors() as e:
+            if attempt >= max_retries - 1:
+                raise
+            rejected = partial.model_dump_json() if partial is not None else ""
+            request = list(messages) + [
+                {"role": "assistant", "content": rejected},
+                {
+                    "role": "user",
+                    "content": f"Validation Error found:\n{e}\nRecall the function correctly, fix the errors",
+                },
+            ]
+            continue
+        for edit in response.edits[reported:]:
+            if on_item is not None:
+                on_item(edit)
+        return response
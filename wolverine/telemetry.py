@@ -0,0 +1,155 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+# Spans are appended to this file (inherited by the wolverine subprocesses)
+# and aggregated into the report at the end of a run
+TELEMETRY_FILE = os.getenv("TELEMETRY_FILE", ".telemetry.jsonl")
+TELEMETRY_REPORT = os.getenv("TELEMETRY_REPORT", "telemetry_report.json")
+
+_spans: List[Dict] = []
+_current_file = None
+
+
+def set_file(file: Optional[str]):
+    """
+    File the following spans are attributed to when they don't name one.
+    """
+    global _current_file
+    _current_file = file
+
+
+def _emit(record: Dict):
+    _spans.append(record)
+    # only runs started with start_run() write to disk
+    path = os.environ.get("TELEMETRY_FILE")
+    if path:
+        with open(path, "a") as f:
+            f.write(json.dumps(record, default=str) + "\n")
+
+
+@contextmanager
+def span(kind: str, file: Optional[str] = None, **attributes):
+    """
+    Time a block and record it with its attributes. The yielded dict can be
+    updated inside the block, e.g. with token counts once they are known.
+    kind is one of "llm", "subprocess", "patch" or "repair".
+    """
+    record = {"kind": kind, "file": file or _current_file, **attributes}
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record["duration"] = time.perf_counter() - start
+        _emit(record)
+
+
+def record_usage(record: Dict, response):
+    """
+    Copy the token usage of a completion into a span.
+    """
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        record["prompt_tokens"] = usage.prompt_tokens
+        record["completion_tokens"] = usage.completion_tokens
+
+
+def total_tokens(file: Optional[str] = None) -> int:
+    """
+    Tokens used by the LLM calls of this process, only those attributed to
+    file when one is given.
+    """
+    return sum(
+        record.get("prompt_tokens", 0) + record.get("completion_tokens", 0)
+        for record in _spans
+        if record["kind"] == "llm" and (file is None or record.get("file") == file)
+    )
+
+
+def start_run(path: str = TELEMETRY_FILE):
+    """
+    Start collecting spans of this process and its subprocesses in path.
+    """
+    path = os.path.abspath(path)
+    open(path, "w").close()
+    os.environ["TELEMETRY_FILE"] = path
+    _spans.clear()
+
+
+def load_spans(path: Optional[str] = None) -> List[Dict]:
+    path = path or os.environ.get("TELEMETRY_FILE")
+    if not path or not os.path.exists(path):
+        return list(_spans)
+    with open(path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def aggregate(spans: List[Dict]) -> Dict[str, Dict[str, Dict]]:
+    """
+    Per file and per kind of span: the number of spans and the sum of every
+    numeric attribute (duration, tokens, sizes, retries, iterations...).
+    Boolean attributes count the spans where they are true.
+    """
+    totals = {}
+    for record in spans:
+        file = record.get("file") or "(none)"
+        entry = totals.setdefault(file, {}).setdefault(record["kind"], {"count": 0})
+        entry["count"] += 1
+        for key, value in record.items():
+            if isinstance(value, (int, float)):
+                entry[key] = entry.get(key, 0) + value
+    return totals
+
+
+def stop_reasons(spans: List[Dict]) -> Dict[str, Dict]:
+    """
+    Why the repair of each file stopped, from its last repair span.
+    """
+    return {record["file"]: record["stop"] for record in spans if "stop" in record}
+
+
+def print_summary(totals: Dict[str, Dict[str, Dict]], stops: Optional[Dict[str, Dict]] = None):
+    stops = stops or {}
+    columns = ["LLM calls", "LLM s", "prompt tok", "completion tok", "runs", "run s", "patches", "iterations", "stop"]
+    rows = []
+    for file, kinds in sorted(totals.items()):
+        llm = kinds.get("llm", {})
+        runs = kinds.get("subprocess", {})
+        rows.append(
+            [
+                file,
+                llm.get("count", 0),
+                f"{llm.get('duration', 0):.1f}",
+                llm.get("prompt_tokens", 0),
+                llm.get("completion_tokens", 0),
+                runs.get("count", 0),
+                f"{runs.get('duration', 0):.1f}",
+                kinds.get("patch", {}).get("count", 0),
+                kinds.get("repair", {}).get("iterations", 0),
+                stops.get(file, {}).get("reason", ""),
+            ]
+        )
+    header = ["file"] + columns
+    widths = [max(len(str(row[i])) for row in rows + [header]) for i in range(len(header))]
+    print("\n===== Telemetry =====")
+    for row in [header] + rows:
+        print("  ".join(str(cell).ljust(width) for cell, width in zip(row, widths)))
+    print("=====================")
+
+
+def write_report(path: str = TELEMETRY_REPORT, spans_path: Optional[str] = None) -> Dict:
+    """
+    Aggregate the spans of the run, write them to a JSON report along with
+    the reason each repair stopped, and print a summary table.
+    """
+    spans = load_spans(spans_path)
+    totals = aggregate(spans)
+    stops = stop_reasons(spans)
+    report = {"generated_at": time.time(), "files": totals, "stops": stops, "spans": len(spans)}
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print_summary(totals, stops)
+    print(f"Telemetry report saved as {path}")
+    return report
@@ -0,0 +1,117 @@
+import ast
+import importlib.util
+import os
+from typing import List, Optional, Set
+
+
+def defined_names(source: str) -> Set[str]:
+    """
+    Names a module defines at its top level: functions, classes, assigned
+    names and imports.
+    """
+    names = set()
+    for node in ast.parse(source).body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                names.add((alias.asname or alias.name).split(".")[0])
+        elif isinstance(node, (ast.Assign, ast.AnnAssign, ast.AugAssign)):
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            for target in targets:
+                for child in ast.walk(target):
+                    if isinstance(child, ast.Name):
+                        names.add(child.id)
+    return names
+
+
+def _module_source(module: str, source_dir: str) -> Optional[str]:
+    path = os.path.join(source_dir, module.replace(".", os.sep) + ".py")
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return f.read()
+
+
+def _touches_sys_path(node: ast.AST) -> bool:
+    for child in ast.walk(node):
+        if (
+            isinstance(child, ast.Attribute)
+            and child.attr == "path"
+            and isinstance(child.value, ast.Name)
+            and child.value.id == "sys"
+        ):
+            return True
+    return False
+
+
+def validate_test_script(
+    test_script: str,
+    module_name: str,
+    module_source: str,
+    source_dir: str = "testfiles",
+) -> List[str]:
+    """
+    Check a generated test script before it is saved and return the problems
+    found, if any: syntax errors, imports of names the tested modules don't
+    define, unknown modules, and a missing sys.path preamble before the tested
+    module is imported.
+    """
+    try:
+        tree = ast.parse(test_script)
+    except SyntaxError as e:
+        return [f"Syntax error on line {e.lineno}: {e.msg}"]
+
+    problems = []
+    preamble_seen = False
+    imports_module = False
+    # "import module" style aliases of testfiles modules, checked on attribute access
+    module_aliases = {}
+    for node in tree.body:
+        if not isinstance(node, (ast.Import, ast.ImportFrom)):
+            preamble_seen = preamble_seen or _touches_sys_path(node)
+            continue
+        if isinstance(node, ast.ImportFrom):
+            modules = [node.module] if node.module and not node.level else []
+        else:
+            modules = [alias.name for alias in node.names]
+
+        for module in modules:
+            imports_module = imports_module or module == module_name
+            source = (
+                module_source if module == module_name else _module_source(module, source_dir)
+            )
+            if source is None:
+                if importlib.util.find_spec(module.split(".")[0]) is None:
+                    problems.append(f"Module {module!r} does not exist")
+                continue
+            if not preamble_seen:
+                problems.append(
+                    f"{module!r} is imported before the sys.path setup snippet"
+                )
+            try:
+                available = defined_names(source)
+            except SyntaxError:
+                continue
+            if isinstance(node, ast.ImportFrom):
+                for alias in node.names:
+                    if alias.name != "*" and alias.name not in available:
+                        problems.append(f"{module!r} has no name {alias.name!r}")
+            else:
+                for alias in node.names:
+                    if alias.name == module and "." not in module:
+                        module_aliases[alias.asname or module] = (module, available)
+
+    for child in ast.walk(tree):
+        if (
+            isinstance(child, ast.Attribute)
+            and isinstance(child.value, ast.Name)
+            and child.value.id in module_aliases
+        ):
+            module, available = module_aliases[child.value.id]
+            if child.attr not in available:
+                problems.append(f"{module!r} has no name {child.attr!r}")
+
+    if not imports_module:
+        problems.append(f"The tested module {module_name!r} is never imported")
+    return list(dict.fromkeys(problems))
@@ -0,0 +1,194 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+from typing import Dict, Iterator, Optional, Set, Tuple
+
+from .languages import backend_for
+
+# "inotify", "polling", or "auto" for inotify where the system has it
+WATCHER = os.getenv("WATCHER", "auto")
+# Seconds between two scans of the polling watcher
+POLL_INTERVAL = float(os.getenv("POLL_INTERVAL", 0.5))
+
+IGNORED_DIRS = {".git", "__pycache__", "node_modules"}
+
+
+def _watched(path: str) -> bool:
+    # sources only: editor swap files, backups and bytecode are left out
+    return backend_for(path) is not None and not path.endswith(".bak")
+
+
+class PollingWatcher:
+    """
+    Finds changes by comparing the size and mtime of every file below root
+    between two scans. Works everywhere, at the cost of a scan per interval.
+    """
+
+    name = "polling"
+
+    def __init__(self, root: str, interval: float = POLL_INTERVAL):
+        self.root = root
+        self.interval = interval
+        self._files = self._scan()
+
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        files = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if d not in IGNORED_DIRS]
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if not _watched(path):
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files[path] = (stat.st_mtime_ns, stat.st_size)
+        return files
+
+    def changes(self, timeout: Optional[float] = None) -> Set[str]:
+        """
+        Paths created, modified or deleted since the last call, waiting up to
+        timeout seconds (forever with None) for the first one.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            files = self._scan()
+            changed = {
+                path for path in set(files) | set(self._files) if files.get(path) != self._files.get(path)
+            }
+            self._files = files
+            if changed:
+                return changed
+            if deadline is not None and time.monotonic() >= deadline:
+                return set()
+            wait = self.interval if deadline is None else min(self.interval, deadline - time.monotonic())
+            time.sleep(max(0.0, wait))
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """
+    Linux inotify through libc: the kernel reports each write, move and
+    delete, so nothing is scanned while the tree is quiet. Every directory
+    below root is watched, including the ones created later.
+    """
+
+    name = "inotify"
+
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self, root: str):
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux")
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.root = root
+        self._dirs: Dict[int, str] = {}
+        self._watch_tree(root)
+
+    def _watch_tree(self, top: str):
+        for dirpath, dirnames, _ in os.walk(top):
+            dirnames[:] = [d for d in dirnames if d not in IGNORED_DIRS]
+            wd = self._libc.inotify_add_watch(self.fd, os.fsencode(dirpath), self.MASK)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {dirpath}")
+            self._dirs[wd] = dirpath
+
+    def _read_events(self) -> Set[str]:
+        changed = set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+        offset = 0
+        while offset + self.EVENT.size <= len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0").decode("utf-8", "replace")
+            offset += length
+            directory = self._dirs.get(wd)
+            if directory is None:
+                continue
+            if mask & self.IN_DELETE_SELF:
+                del self._dirs[wd]
+                continue
+            path = os.path.join(directory, name)
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO) and name not in IGNORED_DIRS:
+                    # files written before the watch was added are picked up too
+                    self._watch_tree(path)
+                    for dirpath, _, filenames in os.walk(path):
+                        changed.update(os.path.join(dirpath, f) for f in filenames)
+                continue
+            # a creation is followed by the close of the write, which is the one that counts
+            if mask & self.IN_CREATE:
+                continue
+            changed.add(path)
+        return {path for path in changed if _watched(path)}
+
+    def changes(self, timeout: Optional[float] = None) -> Set[str]:
+        """
+        Paths written, moved or deleted since the last call, waiting up to
+        timeout seconds (forever with None) for the first one.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = None if deadline is None else max(0.0, deadline - time.monotonic())
+            ready, _, _ = select.select([self.fd], [], [], wait)
+            if not ready:
+                return set()
+            changed = self._read_events()
+            if changed:
+                return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def make_watcher(root: str, kind: str = WATCHER):
+    """
+    An inotify watcher of root, or a polling one when inotify is not
+    available or kind is "polling".
+    """
+    if kind != "polling":
+        try:
+            return InotifyWatcher(root)
+        except (OSError, AttributeError) as e:
+            if kind == "inotify":
+                raise
+            print(f"inotify is not available ({e}), polling {root} every {POLL_INTERVAL}s instead.")
+    return PollingWatcher(root)
+
+
+def debounced_changes(watcher, quiet: float) -> Iterator[Set[str]]:
+    """
+    Yield the paths changed by each burst of saves, once no change has
+    arrived for quiet seconds.
+    """
+    while True:
+        changed = watcher.changes()
+        while True:
+            more = watcher.changes(timeout=quiet)
+            if not more:
+                break
+            changed |= more
+        yield changed
@@ -4,173 +4,161 @@ import os
 import shutil
 import subprocess
 import sys
-import ast
+from functools import lru_cache
 
-import openai
-from openai import AzureOpenAI
-from typing import List, Dict
+from typing import TYPE_CHECKING, List, Dict
 from termcolor import cprint
 from dotenv import load_dotenv
-from instructor import from_openai
+
+from .cache import get_cache
+from .clients import client_errors, get_client
+from .inprocess import failed_results, format_failures, run_tests_in_process
+from .context import build_source_context, estimate_tokens
+from .convergence import (
+    LLM_ERROR,
+    MAX_ITERATIONS,
+    MAX_REPAIR_SECONDS,
+    MAX_REPAIR_TOKENS,
+    PASSED,
+    RepairBudget,
+    error_set,
+    source_paths,
+)
+from .failed_tests import failed_test_source
+from .languages import get_backend, source_name
+from .patching import PatchEngine, PatchError, get_engine
+from .streaming import stream_repair_response
+from .worker import WARM_WORKER, WorkerError, get_worker
+from . import telemetry
+
+if TYPE_CHECKING:
+    # pydantic is only loaded with the first request
+    from .schemas import Edit, RepairResponse
 
 # Load environment variables
 load_dotenv()
 
-# Set up the Azure OpenAI client
-client = from_openai(
-    AzureOpenAI(
-        api_key=os.getenv("API_KEY"),
-        api_version=os.getenv("LLM_API_VERSION"),
-        azure_endpoint=os.getenv("BASE_URL"),
-        azure_deployment=os.getenv("MODEL_DEPLOYMENT"),
-    )
-)
-
 # Default model is GPT-4
 DEFAULT_MODEL = os.environ.get("MODEL_NAME")
 
-# Nb retries for json_validated_response, default to -1, infinite
+# Nb retries for json_validated_response, -1 retries until the answer is valid
 VALIDATE_JSON_RETRY = int(os.getenv("VALIDATE_JSON_RETRY", 5))
 
-# Read the system prompt
-with open(os.path.join(os.path.dirname(__file__), "..", "prompt.txt"), "r") as f:
-    SYSTEM_PROMPT = f.read()
+# Run Python tests with pytest inside this process instead of a new interpreter
+IN_PROCESS_TESTS = os.getenv("IN_PROCESS_TESTS", "0") == "1"
+
+# Stream repair answers and validate the json while it arrives
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "0") == "1"
+
+# Fixes requested and tested at once per repair iteration, 1 asks for one at a time
+SPECULATIVE_CANDIDATES = int(os.getenv("SPECULATIVE_CANDIDATES", 1))
+
+
+@lru_cache(maxsize=None)
+def get_system_prompt() -> str:
+    with open(os.path.join(os.path.dirname(__file__), "..", "prompt.txt"), "r") as f:
+        return f.read()
 
 
 def get_imported_files(test_file: str) -> List[str]:
     """
     Given a test file, return a list of files it imports.
     """
-    imported_files = []
-    with open(test_file, "r") as file:
-        tree = ast.parse(file.read())
-        for node in ast.walk(tree):
-            if isinstance(node, ast.Import):
-                for alias in node.names:
-                    imported_files.append(alias.name)
-            elif isinstance(node, ast.ImportFrom):
-                imported_files.append(node.module)
-    
+    imported_files = get_backend(test_file).imported_modules(test_file)
+
     print(f"Imported files: {imported_files}")
     return imported_files
 
 
 def run_script(script_name: str, script_args: List) -> str:
     """
-    If script_name.endswith(".py") then run with python
-    else run with node
+    Run script_name with the interpreter of its language backend
+    (python for .py, node for .js)
     """
     script_args = [str(arg) for arg in script_args]
-    subprocess_args = (
-        [sys.executable, script_name, *script_args]
-        if script_name.endswith(".py")
-        else ["node", script_name, *script_args]
-    )
+    subprocess_args = get_backend(script_name).run_command(script_name, script_args)
 
-    try:
-        result = subprocess.check_output(subprocess_args, stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as error:
-        return error.output.decode("utf-8"), error.returncode
+    with telemetry.span("subprocess", mode="script") as run_span:
+        try:
+            result = subprocess.check_output(subprocess_args, stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as error:
+            run_span.update(failed=True, bytes=len(error.output))
+            return error.output.decode("utf-8"), error.returncode
+        run_span.update(failed=False, bytes=len(result))
     return result.decode("utf-8"), 0
 
 
 def json_validated_response(
-    model: str, messages: List[Dict], nb_retry: int = VALIDATE_JSON_RETRY
-) -> Dict:
+    model: str,
+    messages: List[Dict],
+    nb_retry: int = VALIDATE_JSON_RETRY,
+    stream: bool = STREAM_RESPONSES,
+    temperature: float = 0.1,
+) -> "RepairResponse":
     """
-    This function is needed because the API can return a non-json response.
-    This will run recursively VALIDATE_JSON_RETRY times.
-    If VALIDATE_JSON_RETRY is -1, it will run recursively until a valid json
-    response is returned.
+    Ask for a fix as a RepairResponse. The client fills the function call
+    described by the model's schema, and an answer that doesn't validate is
+    sent back with the validation errors, nb_retry times at most (-1 keeps
+    asking). With stream=True each edit is shown as soon as it is complete.
     """
-    json_response = {}
-    if nb_retry != 0:
-        response = client.chat.completions.create(
-            model=model,
-            response_model=None,
-            messages=messages,
-            temperature=0.1,
-        )
-        messages.append(response.choices[0].message)
-        content = response.choices[0].message.content
-        # see if json can be parsed
-        try:
-            json_start_index = content.index(
-                "["
-            )  # find the starting position of the JSON data
-            json_data = content[
-                json_start_index:
-            ]  # extract the JSON data from the response string
-            json_response = json.loads(json_data)
-            return json_response
-        except (json.decoder.JSONDecodeError, ValueError) as e:
-            cprint(f"{e}. Re-running the query.", "red")
-            # debug
-            cprint(f"\nGPT RESPONSE:\n\n{content}\n\n", "yellow")
-            # append a user message that says the json is invalid
-            messages.append(
-                {
-                    "role": "user",
-                    "content": (
-                        "Your response could not be parsed by json.loads. "
-                        "Please restate your last message as pure JSON."
-                    ),
-                }
+    from .schemas import RepairResponse, parse_cached
+
+    cache = get_cache()
+    max_retries = sys.maxsize if nb_retry < 0 else max(1, nb_retry)
+    # identical prompts are answered from the on-disk cache
+    cache_key = cache.key(model, temperature, messages) if cache else None
+    content = cache.get(cache_key) if cache else None
+    response = parse_cached(content, RepairResponse) if content is not None else None
+    if response is not None:
+        with telemetry.span("llm", stage="repair", cached=True):
+            pass
+        return response
+
+    if stream:
+        with telemetry.span("llm", stage="repair") as llm_span:
+            response = stream_repair_response(
+                get_client(),
+                model,
+                messages,
+                RepairResponse,
+                on_item=lambda edit: cprint(f"Received: {edit}", "cyan"),
+                temperature=temperature,
+                max_retries=max_retries,
             )
-            # dec nb_retry
-            nb_retry -= 1
-            # rerun the api call
-            return json_validated_response(model, messages, nb_retry)
-        except Exception as e:
-            cprint(f"Unknown error: {e}", "red")
-            cprint(f"\nGPT RESPONSE:\n\n{content}\n\n", "yellow")
-            raise e
-    raise Exception(
-        f"No valid json response found after {VALIDATE_JSON_RETRY} tries. Exiting."
-    )
+            # streamed answers carry no usage, estimate it
+            llm_span["prompt_tokens"] = estimate_tokens("".join(m["content"] for m in messages))
+            llm_span["completion_tokens"] = estimate_tokens(response.model_dump_json())
+    else:
+        with telemetry.span("llm", stage="repair") as llm_span:
+            response, completion = get_client().chat.completions.create_with_completion(
+                model=model,
+                response_model=RepairResponse,
+                messages=messages,
+                temperature=temperature,
+                max_retries=max_retries,
+            )
+            telemetry.record_usage(llm_span, completion)
+    if cache:
+        cache.set(cache_key, response.model_dump_json())
+    return response
 
 
-def send_error_to_gpt(
+def repair_messages(
     test_file: str,
     imported_files: List[str],
     args: List,
     error_message: str,
-    failed_test_case: str,  # New parameter to pass the failed test case
-    model: str = DEFAULT_MODEL,
-) -> Dict:
+    failed_test_case: str,  # Test ids, or the test output to find them in
+) -> List[Dict]:
     """
-    Send the error, the failed test case, and related imported files to the LLM for suggestions.
+    The messages of a repair request: the error, the failed test case, and
+    the related parts of the imported files.
     """
-    # Extract the failed test case content
-    with open(test_file, "r") as f:
-        test_file_lines = f.readlines()
-
-    # Search for the failed test case in the script
-    test_case_content = []
-    inside_failed_test = False
-    for line in test_file_lines:
-        if failed_test_case in line:  # Start of the failed test case
-            inside_failed_test = True
-        if inside_failed_test:
-            test_case_content.append(line)
-            if line.strip() == "":  # Assume a blank line marks the end of the test case
-                break
-
-    test_case_with_lines = []
-    for i, line in enumerate(test_case_content):
-        test_case_with_lines.append(str(i + 1) + ": " + line)
-    test_case_with_lines = "".join(test_case_with_lines)
-
-    # Include imported file content as before
-    imported_file_contents = {}
-    for file in imported_files:
-        file_path = os.path.join("testfiles", file + ".py")
-        if os.path.exists(file_path):
-            with open(file_path, "r") as f:
-                imported_file_contents[file_path] = f.readlines()
+    # Extract the failing tests, with their setUp and fixtures, from the test file
+    test_case_with_lines = failed_test_source(test_file, failed_test_case)
 
     prompt = (
-        "Here is the failed test case:\n\n"
+        f"Here is the failed test case from {test_file}:\n\n"
         f"{test_case_with_lines}\n\n"
         "Here are the arguments it was provided:\n\n"
         f"{args}\n\n"
@@ -179,17 +167,13 @@ def send_error_to_gpt(
         "Here is the code from the imported files:\n\n"
     )
 
-    # Add imported files content to the prompt
-    for file_path, file_content in imported_file_contents.items():
-        prompt += f"Code from {file_path}:\n"
-        for i, line in enumerate(file_content):
-            prompt += f"{i + 1}: {line}"
+    # Add the parts of the imported files the failing tests use
+    prompt += build_source_context(test_file, failed_test_case, imported_files)
 
-    # Send the prompt to GPT
-    messages = [
+    return [
         {
             "role": "system",
-            "content": SYSTEM_PROMPT,
+            "content": get_system_prompt(),
         },
         {
             "role": "user",
@@ -197,48 +181,62 @@ def send_error_to_gpt(
         },
     ]
 
-    return json_validated_response(model, messages)
 
+def send_error_to_gpt(
+    test_file: str,
+    imported_files: List[str],
+    args: List,
+    error_message: str,
+    failed_test_case: str,  # Test ids, or the test output to find them in
+    model: str = DEFAULT_MODEL,
+) -> "RepairResponse":
+    """
+    Send the error, the failed test case, and related imported files to the LLM for suggestions.
+    """
+    messages = repair_messages(test_file, imported_files, args, error_message, failed_test_case)
+    return json_validated_response(model, messages)
 
 
-def apply_changes(file_path: dict, changes: List, confirm: bool = False):
+def edit_lines(lines: List[str], edits: List["Edit"]) -> List[str]:
+    """
+    A copy of lines with the edits applied. Raises PatchError when an edit
+    names a line the file doesn't have.
     """
-    Pass changes as loaded json (list of dicts)
+    for edit in edits:
+        if edit.line > len(lines):
+            raise PatchError(f"line {edit.line} is past the end of the file ({len(lines)} lines)")
+    file_lines = lines.copy()
+    # Apply the edits in reverse line order
+    for edit in sorted(edits, key=lambda edit: edit.line, reverse=True):
+        if edit.operation == "Replace":
+            file_lines[edit.line - 1] = edit.content + "\n"
+        elif edit.operation == "Delete":
+            del file_lines[edit.line - 1]
+        elif edit.operation == "InsertAfter":
+            file_lines.insert(edit.line, edit.content + "\n")
+    return file_lines
+
+
+def apply_changes(
+    file_path: str,
+    edits: List["Edit"],
+    explanations: List[str] = (),
+    confirm: bool = False,
+    engine: PatchEngine = None,
+):
     """
-    # Extract the actual file path from the response (if it's in dictionary format)
+    Apply edits to file_path.
+    The file is read and written through the patch engine of the current
+    session: edits that don't parse raise PatchError and leave it untouched.
+    """
+    engine = engine or get_engine()
     print(file_path)
-    file_path = file_path.get('file', '')
-
-    if not file_path:
-        raise ValueError("File path is missing or invalid.")
-    
-    with open(file_path) as f:
-        original_file_lines = f.readlines()
-
-    # Filter out explanation elements
-    operation_changes = [change for change in changes if "operation" in change]
-    explanations = [
-        change["explanation"] for change in changes if "explanation" in change
-    ]
-
-    # Sort the changes in reverse line order
-    operation_changes.sort(key=lambda x: x["line"], reverse=True)
-
-    file_lines = original_file_lines.copy()
-    for change in operation_changes:
-        operation = change["operation"]
-        line = change["line"]
-        content = change["content"]
-
-        if operation == "Replace":
-            file_lines[line - 1] = content + "\n"
-        elif operation == "Delete":
-            del file_lines[line - 1]
-        elif operation == "InsertAfter":
-            file_lines.insert(line, content + "\n")
+    original_file_lines = engine.read(file_path)
+    file_lines = edit_lines(original_file_lines, edits)
 
     # Print explanations
-    cprint("Explanations:", "blue")
+    if explanations:
+        cprint("Explanations:", "blue")
     for explanation in explanations:
         cprint(f"- {explanation}", "blue")
 
@@ -260,13 +258,74 @@ def apply_changes(file_path: dict, changes: List, confirm: bool = False):
             print("Changes not applied")
             sys.exit(0)
 
-    with open(file_path, "w") as f:
-        f.writelines(file_lines)
+    with telemetry.span("patch", path=file_path, edits=len(edits)):
+        engine.commit(file_path, file_lines)
     print("Changes applied.")
 
 
-def main(test_file, *test_args, revert=False, model=DEFAULT_MODEL, confirm=False):
-    if revert:
+def apply_response(response: "RepairResponse", confirm: bool = False) -> List[str]:
+    """
+    Apply the edits of response to each file they name, the explanations
+    shown with the first one. Returns why the edits of some files were
+    rejected, empty if every file was changed.
+    """
+    rejected = []
+    explanations = response.explanations
+    for file_path, edits in response.edits_by_file().items():
+        if not file_path:
+            rejected.append("some edits name no file")
+            continue
+        try:
+            apply_changes(file_path, edits, explanations, confirm=confirm)
+        except PatchError as e:
+            cprint(f"Changes to {file_path} rejected: {e}", "red")
+            rejected.append(f"the changes to {file_path} were rejected ({e})")
+        explanations = []
+    return rejected
+
+
+def main(
+    test_file,
+    *test_args,
+    revert=False,
+    model=DEFAULT_MODEL,
+    confirm=False,
+    in_process=IN_PROCESS_TESTS,
+    warm=WARM_WORKER,
+    batch=False,
+    max_iterations=MAX_ITERATIONS,
+    max_seconds=MAX_REPAIR_SECONDS,
+    max_tokens=MAX_REPAIR_TOKENS,
+    candidates=SPECULATIVE_CANDIDATES,
+):
+    budget_limits = dict(
+        max_iterations=max_iterations, max_seconds=max_seconds, max_tokens=max_tokens
+    )
+    if batch:
+        # every positional argument is a test file to repair together
+        from .batch import batch_repair
+
+        stops = batch_repair([test_file, *test_args], model=model, confirm=confirm, **budget_limits)
+        if any(stop["reason"] != PASSED for stop in stops):
+            sys.exit(1)
+        return
+
+    engine = get_engine(test_file)
+
+    # --revert restores the original files, --revert=N their state before iteration N
+    if revert is not False:
+        try:
+            reverted = engine.revert(0 if revert is True else int(revert))
+        except PatchError as e:
+            print(e)
+            sys.exit(1)
+        if engine.has_history():
+            if reverted:
+                print(f"Reverted changes to {', '.join(reverted)}")
+            else:
+                print(f"No changes to revert for {test_file}")
+            sys.exit(0)
+        # runs from before the patch history only left a backup of the test file
         backup_file = test_file + ".bak"
         if os.path.exists(backup_file):
             shutil.copy(backup_file, test_file)
@@ -278,29 +337,120 @@ def main(test_file, *test_args, revert=False, model=DEFAULT_MODEL, confirm=False
 
     # Make a backup of the original test file
     shutil.copy(test_file, test_file + ".bak")
+    engine.reset()
 
     # Get the list of imported files in the test script
     imported_files = get_imported_files(test_file)
 
-    while True:
-        output, returncode = run_script(test_file, test_args)
+    # In-process runs only apply to Python tests without script arguments
+    in_process = in_process and test_file.endswith(".py") and not test_args
+    # The warm worker runs Python scripts, anything else gets a new interpreter
+    warm = warm and test_file.endswith(".py")
+    # Ids of the tests that failed last time, None runs the whole file
+    failing_ids = None
+    # Why the last edits were rejected, sent along with the next request
+    rejected = None
+    # Stops the loop once it passes, runs out of budget or stops converging
+    # the spans of the repair are attributed to the source the test file tests
+    source = source_name(test_file)
+    budget = RepairBudget(source, **budget_limits)
+    paths = [test_file] + source_paths(imported_files, test_file)
+
+    telemetry.set_file(source)
+    with telemetry.span("repair", source) as repair_span:
+        while True:
+            if in_process:
+                results = run_tests_in_process(test_file, failing_ids)
+                failures = failed_results(results)
+                if not failures and failing_ids:
+                    # the fixed tests pass, make sure nothing else broke
+                    cprint("Failing tests pass. Rerunning the whole file...", "blue")
+                    failing_ids = None
+                    continue
+                output = format_failures(failures)
+                returncode = 1 if failures else 0
+                failing_ids = [failure["id"] for failure in failures]
+                failed_test_case = "\n".join(failing_ids)
+            elif warm:
+                try:
+                    output, returncode = get_worker().run(
+                        test_file, test_args, engine.pop_modified()
+                    )
+                except WorkerError as e:
+                    cprint(f"{e}, running the test in a new interpreter.", "yellow")
+                    output, returncode = run_script(test_file, test_args)
+                failed_test_case = output
+            else:
+                output, returncode = run_script(test_file, test_args)
+                failed_test_case = output
+
+            if returncode == 0:
+                errors = []
+            elif in_process:
+                errors = sorted(failing_ids)
+            else:
+                errors = error_set(output, test_file) or [f"exit code {returncode}"]
+            stop_reason = budget.observe(paths, errors, rejected or "")
+
+            if stop_reason == PASSED:
+                repair_span["passed"] = True
+                cprint("Test ran successfully.", "blue")
+                print("Output:", output)
+                cache = get_cache()
+                if cache:
+                    cprint(f"LLM cache: {cache.hits} hits, {cache.misses} misses", "blue")
+                break
 
-        if returncode == 0:
-            cprint("Test ran successfully.", "blue")
-            print("Output:", output)
-            break
+            elif stop_reason:
+                cprint(f"Test still failing, giving up: {stop_reason}.", "red")
+                print("Output:", output)
+                break
 
-        else:
-            cprint("Test failed. Trying to fix...", "blue")
-            print("Output:", output)
-            json_response = send_error_to_gpt(
-                test_file=test_file,
-                imported_files=imported_files,
-                args=test_args,
-                error_message=output,
-                model=model,
-                failed_test_case=output
-            )
-            #print(json_response)
-            apply_changes(json_response[-1], json_response, confirm=confirm)
-            cprint("Changes applied. Rerunning...", "blue")
+            else:
+                cprint("Test failed. Trying to fix...", "blue")
+                print("Output:", output)
+                if rejected:
+                    output += f"\n\nYour previous changes were not applied: {rejected}\n"
+                    rejected = None
+                engine.iteration += 1
+                repair_span["iterations"] = engine.iteration
+                try:
+                    if candidates > 1:
+                        # several fixes tested in parallel copies, the best one is applied
+                        from .speculative import speculative_fix
+
+                        messages = repair_messages(
+                            test_file, imported_files, test_args, output, failed_test_case
+                        )
+                        response = speculative_fix(
+                            messages, model, test_file, test_args, candidates
+                        )
+                        if response is None:
+                            cprint("No candidate fix could be applied. Rerunning...", "red")
+                            rejected = "none of them could be applied to the files"
+                            continue
+                    else:
+                        response = send_error_to_gpt(
+                            test_file=test_file,
+                            imported_files=imported_files,
+                            args=test_args,
+                            error_message=output,
+                            model=model,
+                            failed_test_case=failed_test_case
+                        )
+                except client_errors() as e:
+                    cprint(f"The repair request failed, giving up: {e}", "red")
+                    stop_reason = LLM_ERROR
+                    break
+                problems = apply_response(response, confirm=confirm)
+                if problems:
+                    cprint("Changes rejected. Rerunning...", "red")
+                    rejected = "; ".join(problems)
+                    continue
+                cprint(f"Changes applied (iteration {engine.iteration}). Rerunning...", "blue")
+
+        stop = budget.report(stop_reason)
+        repair_span["stop"] = stop
+    print(f"Repair stopped: {json.dumps(stop)}")
+    if stop_reason != PASSED:
+        sys.exit(1)
@@ -0,0 +1,122 @@
+import atexit
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+from typing import Iterable, List, Optional, Set, Tuple
+
+from termcolor import cprint
+
+from . import telemetry
+
+# Run Python tests in a long-lived interpreter that reloads the edited modules
+WARM_WORKER = os.getenv("WARM_WORKER", "0") == "1"
+# Seconds a test run may take in the worker before it is killed
+WORKER_TIMEOUT = float(os.getenv("WORKER_TIMEOUT", 300))
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "worker_process.py")
+
+
+class WorkerError(RuntimeError):
+    """
+    Raised when the worker died or didn't answer in time.
+    """
+
+
+class WarmWorker:
+    """
+    A Python interpreter kept alive between test runs. Unittest and the tested
+    modules stay imported, and only the files edited since the last run are
+    reloaded. When a reload is not safe, e.g. another module still holds
+    objects from the old version, the worker is replaced by a fresh one.
+    """
+
+    def __init__(self, timeout: float = WORKER_TIMEOUT):
+        self.timeout = timeout
+        self.process: Optional[subprocess.Popen] = None
+        self._answers: "queue.Queue[Optional[str]]" = queue.Queue()
+        # files changed outside the repair sessions, reloaded before the next run
+        self._stale: Set[str] = set()
+
+    def invalidate(self, paths: Iterable[str]):
+        self._stale.update(paths)
+
+    def start(self):
+        self.process = subprocess.Popen(
+            [sys.executable, WORKER_SCRIPT],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+            bufsize=1,
+        )
+        self._answers = queue.Queue()
+        threading.Thread(
+            target=self._read, args=(self.process.stdout, self._answers), daemon=True
+        ).start()
+
+    @staticmethod
+    def _read(stream, answers: "queue.Queue[Optional[str]]"):
+        for line in stream:
+            answers.put(line)
+        # end of output: the worker exited
+        answers.put(None)
+
+    def stop(self):
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+    def _request(self, request: dict) -> dict:
+        if self.process is None or self.process.poll() is not None:
+            self.start()
+        try:
+            self.process.stdin.write(json.dumps(request) + "\n")
+            self.process.stdin.flush()
+            line = self._answers.get(timeout=self.timeout)
+        except (BrokenPipeError, queue.Empty) as e:
+            self.stop()
+            raise WorkerError(f"no answer from the test worker ({type(e).__name__})") from e
+        if line is None:
+            self.stop()
+            raise WorkerError("the test worker exited")
+        return json.loads(line)
+
+    def run(self, test_file: str, args: List = (), changed: Iterable[str] = ()) -> Tuple[str, int]:
+        """
+        Run test_file after reloading the changed files, and return its
+        output and return code like run_script.
+        """
+        reload = sorted(set(changed) | self._stale)
+        self._stale.clear()
+        request = {"run": test_file, "args": [str(arg) for arg in args], "reload": reload}
+        with telemetry.span("subprocess", mode="worker", reloaded=len(request["reload"])) as run_span:
+            answer = self._request(request)
+            if "restart" in answer:
+                cprint(f"Restarting the test worker: {answer['restart']}", "yellow")
+                run_span["restarted"] = True
+                self.stop()
+                # a fresh interpreter imports everything again
+                request["reload"] = []
+                answer = self._request(request)
+            run_span["failed"] = answer["returncode"] != 0
+        return answer["output"], answer["returncode"]
+
+
+_worker = None
+
+
+def get_worker() -> WarmWorker:
+    """
+    The worker shared by the repair sessions of this process, stopped when
+    the process exits.
+    """
+    global _worker
+    if _worker is None:
+        _worker = WarmWorker()
+        atexit.register(_worker.stop)
+    return _worker
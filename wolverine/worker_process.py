@@ -0,0 +1,130 @@
+"""
+The warm test worker. Runs as a plain script (not through the wolverine
+package, which would create an API client) and reads one JSON request per
+line on stdin:
+
+    {"run": "tests/unit/x_test.py", "args": [], "reload": ["testfiles/x.py"]}
+
+The modules loaded from the "reload" files are reloaded, the test script is
+run as __main__ and one JSON line with its output and return code is written
+back. When a module can't be reloaded safely the test is not run and the
+answer is {"restart": reason}, the caller then starts a fresh worker.
+"""
+import contextlib
+import importlib
+import io
+import json
+import os
+import runpy
+import sys
+import traceback
+from typing import Dict, List, Optional
+
+
+def _project_modules() -> Dict[str, object]:
+    root = os.getcwd() + os.sep
+    modules = {}
+    for name, module in list(sys.modules.items()):
+        path = getattr(module, "__file__", None)
+        if path and os.path.abspath(path).startswith(root):
+            modules[name] = module
+    return modules
+
+
+def _dependents(module, project_modules: Dict[str, object]) -> List[str]:
+    """
+    Project modules holding the module, or objects defined in it, in their
+    globals. A reload leaves them with the old objects.
+    """
+    dependents = []
+    for name, other in project_modules.items():
+        if other is module or name == "__main__":
+            continue
+        for value in vars(other).values():
+            if value is module or getattr(value, "__module__", None) == module.__name__:
+                dependents.append(name)
+                break
+    return dependents
+
+
+def reload_files(paths: List[str]) -> Optional[str]:
+    """
+    Reload the modules loaded from paths. Returns why a fresh interpreter is
+    needed instead, if it is.
+    """
+    project_modules = _project_modules()
+    by_path = {
+        os.path.abspath(module.__file__): module for module in project_modules.values()
+    }
+    for path in paths:
+        module = by_path.get(os.path.abspath(path))
+        if module is None:
+            # never imported, the next import reads the new version
+            continue
+        if not path.endswith(".py") or os.path.basename(path) == "__init__.py":
+            return f"{path} is not a plain module"
+        dependents = _dependents(module, project_modules)
+        if dependents:
+            return f"{', '.join(dependents)} hold objects from {module.__name__}"
+        # drop the old names so that deleted functions don't linger
+        for name in [name for name in vars(module) if not name.startswith("__")]:
+            delattr(module, name)
+        # the test's sys.path setup is gone, put the module's root back for the reload
+        root = os.path.dirname(os.path.abspath(module.__file__))
+        for _ in range(module.__name__.count(".")):
+            root = os.path.dirname(root)
+        sys.path.insert(0, root)
+        try:
+            importlib.reload(module)
+        except Exception as e:
+            return f"reloading {module.__name__} failed: {e}"
+        finally:
+            sys.path.remove(root)
+    return None
+
+
+def run_test(test_file: str, args: List[str]) -> Dict:
+    output = io.StringIO()
+    path_before = list(sys.path)
+    argv_before = sys.argv
+    sys.argv = [test_file, *args]
+    # like "python test_file", which puts the script's directory first
+    sys.path.insert(0, os.path.dirname(os.path.abspath(test_file)))
+    returncode = 0
+    try:
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            try:
+                runpy.run_path(test_file, run_name="__main__")
+            except SystemExit as e:
+                if isinstance(e.code, int):
+                    returncode = e.code
+                elif e.code is not None:
+                    print(e.code)
+                    returncode = 1
+            except BaseException:
+                traceback.print_exc()
+                returncode = 1
+    finally:
+        sys.path[:] = path_before
+        sys.argv = argv_before
+    return {"output": output.getvalue(), "returncode": returncode}
+
+
+def serve(requests=sys.stdin, answers=sys.stdout):
+    for line in requests:
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        reason = reload_files(request.get("reload", []))
+        if reason:
+            answer = {"restart": reason}
+        else:
+            answer = run_test(request["run"], request.get("args", []))
+        answers.write(json.dumps(answer) + "\n")
+        answers.flush()
+
+
+if __name__ == "__main__":
+    # the wolverine directory must not shadow the project's modules
+    sys.path.pop(0)
+    serve()